@@ -1,17 +1,26 @@
 import streamlit as st
 import folium
 from streamlit_folium import folium_static
-import requests
+import streamlit.components.v1 as components
 import googlemaps
 from dotenv import load_dotenv
 import os
-import math
 import pandas as pd
 import io
-import csv
-import concurrent.futures
-import threading
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from cache_geocoding import cache_condivisa
+from cache_edifici import cache_edifici_condivisa
+from archivio_edifici import archivio_edifici_condiviso
+from concorrenza import riepilogo_limiti
+from metriche import metriche_condivise, cronometrato, misura, avvia_server_condiviso
+from overpass import calcola_superficie_punto, client_condiviso
+from estratto_locale import backend_locale_attivo, estratto_condiviso, calcola_superfici_lotto
+from streaming import leggi_indirizzi
+from journal import journal_condiviso, id_lavoro
+from lavori import (coda_lavori_condivisa, elabora_indirizzi, elabora_file_su_disco, elabora_censimento,
+                    STATO_IN_CODA, UNITA_TILE)
+from censimento import Confine, anteprima_censimento
+from cartografia import mappa_edificio, mappa_panoramica, html_mappa
+from archivio_mappe import TOLLERANZA_PANORAMICA
 
 # Carica le variabili d'ambiente
 load_dotenv()
@@ -23,11 +32,35 @@ if not os.getenv('GOOGLE_MAPS_API_KEY'):
 
 # Inizializza il client Google Maps
 try:
-    gmaps = googlemaps.Client(key=os.getenv('GOOGLE_MAPS_API_KEY'))
+    gmaps = googlemaps.Client(key=os.getenv('GOOGLE_MAPS_API_KEY'),
+                              base_url=os.getenv('GOOGLE_MAPS_BASE_URL', 'https://maps.googleapis.com'),
+                              queries_per_second=int(os.getenv('GOOGLE_MAPS_QPS', 60)),
+                              # OVER_QUERY_LIMIT arriva alla cache, che riduce il limite adattivo e ripete
+                              retry_over_query_limit=False)
 except Exception as e:
     st.error(f"❌ Errore nell'inizializzazione del client Google Maps: {str(e)}")
     st.stop()
 
+# Cache del geocoding condivisa con la CLI e tra i thread
+cache_geocoding = cache_condivisa()
+
+# Secondi tra un aggiornamento e l'altro dell'avanzamento dei lavori in background
+INTERVALLO_AGGIORNAMENTO = 1
+
+# Righe completate mostrate nella tabella durante l'elaborazione
+RIGHE_ANTEPRIMA = 1000
+
+# Dimensioni delle mappe dei risultati e pagine HTML delle mappe tenute in cache
+LARGHEZZA_MAPPA = 800
+ALTEZZA_MAPPA = 500
+MAPPE_IN_CACHE = 500
+
+# Formati dei risultati del censimento di un'area: estensione del file e tipo MIME
+FORMATI_CENSIMENTO = {
+    "GeoJSON lines": ('.geojsonl', 'application/geo+json-seq'),
+    "Parquet": ('.parquet', 'application/vnd.apache.parquet'),
+}
+
 # Inizializza lo stato della sessione se non esiste
 if 'selected_row' not in st.session_state:
     st.session_state.selected_row = None
@@ -52,312 +85,310 @@ def cambia_mappa(direzione):
     if 0 <= nuovo_indice < len(st.session_state.mappe):
         st.session_state.mappa_selezionata = nuovo_indice
 
+def seleziona_mappa():
+    """Seleziona la mappa scelta con lo slider."""
+    st.session_state.mappa_selezionata = st.session_state.mappa_slider
+
+@cronometrato('geocoding')
+def geocodifica_indirizzo(indirizzo):
+    """Converte un indirizzo in (lat, lon, indirizzo_completo, numero_civico_trovato).
+
+    Non usa l'interfaccia, così da poter essere eseguita dai lavori in background;
+    gli errori del servizio vengono sollevati.
+    """
+    # Aggiungi "Italia" all'indirizzo se non specificato
+    if "italia" not in indirizzo.lower():
+        indirizzo += ", Italia"
+        
+    # Geocoding con Google Maps (passando dalla cache su disco)
+    result = cache_geocoding.geocode(gmaps, indirizzo)
+    
+    if result and len(result) > 0:
+        location = result[0]
+        lat = location['geometry']['location']['lat']
+        lon = location['geometry']['location']['lng']
+        indirizzo_completo = location['formatted_address']
+        has_street_number = any(component['types'][0] == 'street_number'
+                              for component in location['address_components'])
+        return lat, lon, indirizzo_completo, has_street_number
+    return None, None, None, False
+
 def ottieni_coordinate(indirizzo):
     """Converte un indirizzo in coordinate geografiche usando Google Maps API."""
     try:
-        # Aggiungi "Italia" all'indirizzo se non specificato
-        if "italia" not in indirizzo.lower():
-            indirizzo += ", Italia"
-            
-        # Geocoding con Google Maps
-        result = gmaps.geocode(indirizzo)
-        
-        if result and len(result) > 0:
-            location = result[0]
-            lat = location['geometry']['location']['lat']
-            lon = location['geometry']['location']['lng']
-            indirizzo_completo = location['formatted_address']
-            return lat, lon, indirizzo_completo
-        return None, None, None
+        return geocodifica_indirizzo(indirizzo)
     except Exception as e:
         st.error(f"Errore nel geocoding per l'indirizzo {indirizzo}: {str(e)}")
-        return None, None, None
+        return None, None, None, False
 
-def calcola_superficie_edificio(lat, lon):
+@cronometrato('superficie_edificio')
+def calcola_superficie_edificio(lat, lon, preciso=True):
     """Calcola la superficie esatta di un edificio utilizzando OpenStreetMap Buildings."""
     try:
-        # Cache per le risposte dell'API
-        if not hasattr(st.session_state, 'building_cache'):
-            st.session_state.building_cache = {}
-        
-        # Arrotonda le coordinate per la cache
-        cache_key = f"{round(lat, 6)},{round(lon, 6)}"
-        
-        if cache_key in st.session_state.building_cache:
-            return st.session_state.building_cache[cache_key]
-
-        # Definisci il raggio di ricerca (in gradi)
-        radius = 0.001  # circa 100 metri
-
-        # Query Overpass API ottimizzata
-        overpass_url = "http://overpass-api.de/api/interpreter"
-        overpass_query = f"""
-        [out:json][timeout:10];
-        way(around:{int(radius * 111319.9)},{lat},{lon})[building];
-        out geom qt;
-        """
-        
-        response = requests.post(overpass_url, data=overpass_query)
-        data = response.json()
-        
-        if not data.get('elements'):
-            result = (None, None, "Nessun edificio trovato a questo indirizzo.")
-            st.session_state.building_cache[cache_key] = result
-            return result
-        
-        # Trova l'edificio più vicino alle coordinate date
-        closest_building = None
-        min_distance = float('inf')
-        
-        for element in data['elements']:
-            if element.get('type') == 'way' and element.get('geometry'):
-                # Calcola il centro dell'edificio usando la media delle coordinate
-                coords = element['geometry']
-                center_lat = sum(node['lat'] for node in coords) / len(coords)
-                center_lon = sum(node['lon'] for node in coords) / len(coords)
-                
-                # Calcola la distanza euclidea (più veloce della distanza geodetica per confronti)
-                distance = (center_lat - lat)**2 + (center_lon - lon)**2
-                
-                if distance < min_distance:
-                    min_distance = distance
-                    closest_building = element
-        
-        if not closest_building:
-            result = (None, None, "Impossibile calcolare l'area dell'edificio.")
-            st.session_state.building_cache[cache_key] = result
-            return result
-        
-        # Estrai le coordinate dell'edificio
-        coordinates = [[node['lat'], node['lon']] for node in closest_building['geometry']]
-        
-        # Assicurati che il poligono sia chiuso
-        if coordinates[0] != coordinates[-1]:
-            coordinates.append(coordinates[0])
-        
-        def calculate_area(coords):
-            """Calcola l'area di un poligono usando la formula di Gauss."""
-            def haversine_distance(lat1, lon1, lat2, lon2):
-                R = 6371000  # Raggio della Terra in metri
-                
-                # Converti in radianti
-                lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
-                
-                # Differenze
-                dlat = lat2 - lat1
-                dlon = lon2 - lon1
-                
-                # Formula di Haversine
-                a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-                c = 2 * math.asin(math.sqrt(a))
-                
-                return R * c
-            
-            area = 0
-            for i in range(len(coords) - 1):
-                # Calcola la base e l'altezza del triangolo
-                base = haversine_distance(coords[i][0], coords[i][1], 
-                                       coords[i][0], coords[i+1][1])
-                height = haversine_distance(coords[i][0], coords[i+1][1], 
-                                         coords[i+1][0], coords[i+1][1])
-                
-                # Area del triangolo = (base * altezza) / 2
-                triangle_area = (base * height) / 2
-                area += triangle_area
-            
-            return area
+        # Backend offline: nessuna richiesta di rete
+        if backend_locale_attivo():
+            return estratto_condiviso().calcola_superficie_edificio(lat, lon, preciso)
 
-        area = calculate_area(coordinates)
-        
-        # Se l'edificio ha un nome in OSM, usalo
-        nome_edificio = closest_building.get('tags', {}).get('name', 'Edificio')
-        tipo_edificio = closest_building.get('tags', {}).get('building', '')
-        
-        # Aggiungi il tipo di edificio al messaggio se disponibile
-        if tipo_edificio:
-            messaggio = f"Superficie calcolata con successo per: {nome_edificio} (Tipo: {tipo_edificio})"
-        else:
-            messaggio = f"Superficie calcolata con successo per: {nome_edificio}"
-        
-        result = (area, coordinates, messaggio)
-        st.session_state.building_cache[cache_key] = result
-        return result
+        # Un edificio già misurato viene riusato dall'archivio; gli edifici del tile che contiene
+        # il punto sono condivisi tra tutte le sessioni; senza numero civico la ricerca parte
+        # subito con un raggio ampio
+        return calcola_superficie_punto(lat, lon, preciso)
         
     except Exception as e:
         st.error(f"Errore durante il calcolo della superficie: {str(e)}")
         return None, None, f"Errore durante il calcolo della superficie: {str(e)}"
 
-def processa_file(file):
-    """Processa un file di indirizzi e restituisce i risultati utilizzando parallelizzazione."""
-    risultati = []
-    mappe = []
-    
-    try:
-        # Leggi il file come DataFrame
-        if file.name.endswith('.csv'):
-            df = pd.read_csv(file)
-        elif file.name.endswith('.xlsx'):
-            df = pd.read_excel(file)
-        else:  # Assume che sia un file di testo
-            df = pd.read_csv(file, header=None, names=['Indirizzo'])
-        
-        # Assicurati che ci sia una colonna con gli indirizzi
-        colonna_indirizzi = None
-        for col in df.columns:
-            if 'indirizzo' in col.lower() or 'address' in col.lower():
-                colonna_indirizzi = col
-                break
-        
-        if not colonna_indirizzi:
-            colonna_indirizzi = df.columns[0]
-        
-        # Inizializza la progress bar e il contatore
-        total_rows = len(df)
-        progress_container = st.container()
-        with progress_container:
-            progress_bar = st.progress(0)
-            status_text = st.empty()
-        
-        # Inizializza la lista dei risultati con None per mantenere l'ordine
-        risultati = [None] * total_rows
-        coordinate_edifici = [None] * total_rows
-        
-        # Step 1: Estrai tutte le coordinate
-        status_text.text("⌛ Fase 1/2: Ricerca indirizzi...")
-        
-        # Processa gli indirizzi in batch per evitare sovraccarichi
-        batch_size = 5
-        processed = 0
-        
-        for i in range(0, total_rows, batch_size):
-            batch = df.iloc[i:min(i + batch_size, total_rows)]
-            with ThreadPoolExecutor(max_workers=5) as executor:
-                futures = []
-                for idx, row in batch.iterrows():
-                    indirizzo_input = str(row[colonna_indirizzi]).strip()
-                    futures.append((idx, executor.submit(ottieni_coordinate, indirizzo_input)))
-                
-                for idx, future in futures:
-                    try:
-                        lat, lon, indirizzo_completo = future.result()
-                        coordinate_edifici[idx] = {
-                            'indirizzo': str(df.iloc[idx][colonna_indirizzi]),
-                            'indirizzo_completo': indirizzo_completo,
-                            'lat': lat,
-                            'lon': lon
-                        }
-                    except Exception as e:
-                        coordinate_edifici[idx] = {
-                            'indirizzo': str(df.iloc[idx][colonna_indirizzi]),
-                            'indirizzo_completo': None,
-                            'lat': None,
-                            'lon': None,
-                            'error': str(e)
-                        }
-                    processed += 1
-                    progress_bar.progress(processed / (total_rows * 2))
-        
-        # Step 2: Calcola le superfici
-        status_text.text("⌛ Fase 2/2: Calcolo superfici...")
-        processed = 0
-        
-        # Processa le superfici in batch
-        for i in range(0, total_rows, batch_size):
-            batch = coordinate_edifici[i:min(i + batch_size, total_rows)]
-            with ThreadPoolExecutor(max_workers=5) as executor:
-                futures = []
-                for idx, coord in enumerate(batch, start=i):
-                    if coord['lat'] and coord['lon']:
-                        futures.append((idx, coord, executor.submit(calcola_superficie_edificio, coord['lat'], coord['lon'])))
-                    else:
-                        futures.append((idx, coord, None))
-                
-                for idx, coord, future in futures:
-                    try:
-                        if future:
-                            area, coordinates, messaggio = future.result()
-                            
-                            if coordinates:
-                                mappe.append({
-                                    'lat': coord['lat'],
-                                    'lon': coord['lon'],
-                                    'coordinates': coordinates,
-                                    'area': area,
-                                    'indirizzo': coord['indirizzo_completo'],
-                                    'indirizzo_input': coord['indirizzo']
-                                })
-                            
-                            risultati[idx] = {
-                                'Indirizzo_Input': coord['indirizzo'],
-                                'Indirizzo_Trovato': coord['indirizzo_completo'],
-                                'Latitudine': coord['lat'],
-                                'Longitudine': coord['lon'],
-                                'Superficie_m2': area if area else None,
-                                'Stato': "✅ Calcolato" if area else "❌ Calcolo non riuscito"
-                            }
-                        else:
-                            risultati[idx] = {
-                                'Indirizzo_Input': coord['indirizzo'],
-                                'Indirizzo_Trovato': None,
-                                'Latitudine': None,
-                                'Longitudine': None,
-                                'Superficie_m2': None,
-                                'Stato': '❌ Indirizzo non trovato'
-                            }
-                    except Exception as e:
-                        risultati[idx] = {
-                            'Indirizzo_Input': coord['indirizzo'],
-                            'Indirizzo_Trovato': coord['indirizzo_completo'],
-                            'Latitudine': coord['lat'],
-                            'Longitudine': coord['lon'],
-                            'Superficie_m2': None,
-                            'Stato': '❌ Errore nel calcolo'
-                        }
-                    processed += 1
-                    progress_bar.progress(0.5 + processed / (total_rows * 2))
-        
-        status_text.text("✅ Elaborazione completata!")
-        
-        # Crea il DataFrame mantenendo l'ordine originale
-        risultati_df = pd.DataFrame(risultati)
-        
-        if not risultati:
-            return pd.DataFrame(), []
-            
-        return risultati_df, mappe
-    
-    except Exception as e:
-        st.error(f"Errore durante l'elaborazione del file: {str(e)}")
-        if not risultati:
-            return pd.DataFrame(), []
-        return pd.DataFrame(risultati), mappe
+def _copia_file(file):
+    """Copia in memoria il file caricato, così che il lavoro in background non lo condivida con la sessione."""
+    copia = io.BytesIO(file.getvalue())
+    copia.name = file.name
+    return copia
+
+def invia_file(file, ripeti_fallite=False):
+    """Invia l'elaborazione del file alla coda dei lavori e restituisce il `Lavoro`.
+
+    Lo stesso file (a parità di contenuto) inviato da più sessioni mentre è in corso
+    corrisponde a un unico lavoro; le righe già completate in elaborazioni precedenti
+    vengono riprese dal journal e, di un file modificato, si elaborano solo gli
+    indirizzi nuovi o cambiati.
+    """
+    chiave = id_lavoro(file)
+    indirizzi = list(leggi_indirizzi(_copia_file(file)))
+    return coda_lavori_condivisa().invia(
+        f"tabella-{chiave}" + ("-ripeti" if ripeti_fallite else ""), file.name, len(indirizzi),
+        elabora_indirizzi, journal_condiviso(), chiave, indirizzi, geocodifica_indirizzo,
+        calcola_superfici_lotto, ripeti_fallite, tipo='tabella'
+    )
+
+def invia_file_su_disco(file, ripeti_fallite=False):
+    """Invia l'elaborazione di un file molto grande, con i risultati scritti su un CSV temporaneo."""
+    chiave = id_lavoro(file)
+    return coda_lavori_condivisa().invia(
+        f"disco-{chiave}" + ("-ripeti" if ripeti_fallite else ""), file.name, None,
+        elabora_file_su_disco, journal_condiviso(), _copia_file(file), geocodifica_indirizzo,
+        calcola_superfici_lotto, ripeti_fallite, tipo='disco'
+    )
+
+def invia_censimento(area, formato):
+    """Invia il censimento degli edifici di un'area (nome del comune o riquadro) alla coda dei lavori.
+
+    Lo stesso censimento richiesto da più sessioni mentre è in corso corrisponde a un
+    unico lavoro; richiederlo di nuovo al termine lo ripete.
+    """
+    if isinstance(area, str):
+        nome = area
+    else:
+        # Un riquadro non valido viene segnalato subito, non al momento dell'esecuzione
+        Confine.da_riquadro(*area)
+        nome = "riquadro " + ", ".join(f"{valore:.5f}" for valore in area)
+    return coda_lavori_condivisa().invia(
+        f"censimento-{nome}{formato}", f"Censimento {nome}", None, elabora_censimento, area, formato,
+        tipo='censimento', unita=UNITA_TILE
+    )
+
+@st.fragment(run_every=INTERVALLO_AGGIORNAMENTO)
+def mostra_avanzamento(id, con_mappe=False):
+    """Mostra l'avanzamento del lavoro, aggiornandolo senza rieseguire l'intera pagina.
+
+    Con `con_mappe` accanto all'avanzamento compare il navigatore delle mappe trovate finora.
+    """
+    lavoro = coda_lavori_condivisa().lavoro(id)
+    if lavoro is None:
+        return
+    if lavoro.finito:
+        # Al termine la pagina viene ridisegnata con i risultati
+        st.rerun()
+    if not con_mappe:
+        mostra_stato_lavoro(lavoro)
+        return
+    # Righe e mappe compaiono man mano che vengono completate
+    st.session_state.mappe = lavoro.mappe()
+    col1, col2 = st.columns([1, 1])
+    with col1:
+        mostra_stato_lavoro(lavoro)
+    with col2:
+        navigatore_mappe(st.session_state.mappe, lavoro.id)
+
+def mostra_stato_lavoro(lavoro):
+    """Mostra barra di avanzamento, descrizione e risultati parziali di un lavoro in corso."""
+    st.progress(min(lavoro.completate / lavoro.totale, 1.0) if lavoro.totale else 0.0)
+    testo = lavoro.descrizione()
+    if lavoro.stato == STATO_IN_CODA:
+        testo += f" ({coda_lavori_condivisa().posizione(lavoro.id)} lavori in coda prima di questo)"
+    st.text(testo)
+    if lavoro.tipo == 'censimento':
+        st.caption("Il censimento prosegue anche chiudendo la pagina: riaprendo questo indirizzo "
+                   "si ritrovano avanzamento e risultati.")
+        return
+    st.caption("L'elaborazione prosegue anche chiudendo la pagina: riaprendo questo indirizzo "
+               "o ricaricando lo stesso file si ritrovano avanzamento e risultati.")
+    if not lavoro.completate:
+        return
+    st.download_button(
+        label="📥 Scarica risultati parziali CSV",
+        data=lavoro.csv_risultati(),
+        file_name="risultati_superfici_parziali.csv",
+        mime="text/csv",
+        key="scarica_parziali"
+    )
+    if lavoro.tipo == 'tabella':
+        risultati_df, _ = lavoro.tabella(limite=RIGHE_ANTEPRIMA)
+        st.write("### Risultati parziali")
+        st.dataframe(risultati_df)
+        if lavoro.completate > RIGHE_ANTEPRIMA:
+            st.caption(f"Sono mostrate le prime {RIGHE_ANTEPRIMA} righe completate: "
+                       "le altre sono incluse nei risultati parziali da scaricare.")
+
+def navigatore_mappe(mappe, chiave):
+    """Mostra le mappe degli edifici trovati: tutte insieme o una alla volta, con i controlli per scorrerle.
+
+    `chiave` identifica i risultati (ad esempio l'id del lavoro) per la cache della panoramica.
+    """
+    if not mappe:
+        return
+    modalita = st.radio("Visualizzazione", ["Panoramica", "Singolo edificio"], horizontal=True, key="modalita_mappe")
+    if modalita == "Panoramica":
+        # Un'unica mappa con tutti gli edifici: la selezione avviene nel browser, senza rieseguire la pagina
+        st.write(f"### Tutti gli edifici ({len(mappe)})")
+        mostra_html_mappa(html_mappa_panoramica(chiave, len(mappe), mappe))
+        return
+
+    # Durante un'elaborazione le mappe aumentano: la selezione resta entro quelle disponibili
+    st.session_state.mappa_selezionata = min(st.session_state.mappa_selezionata, len(mappe) - 1)
+    st.write("### Naviga tra le mappe")
+
+    # Controlli di navigazione in riga
+    # I controlli aggiornano la selezione nei callback, prima che la pagina venga ridisegnata
+    cols = st.columns([1, 3, 1])
+    with cols[0]:
+        cols[0].button("⬅️", key="prev", disabled=st.session_state.mappa_selezionata <= 0,
+                       on_click=cambia_mappa, args=(-1,))
+
+    with cols[1]:
+        # Usa un select_slider invece di uno slider normale
+        opzioni = [f"Mappa {i+1}/{len(mappe)}" for i in range(len(mappe))]
+        st.session_state.mappa_slider = st.session_state.mappa_selezionata
+        st.select_slider(
+            "Seleziona la mappa",
+            options=range(len(mappe)),
+            format_func=lambda x: opzioni[x],
+            key="mappa_slider",
+            on_change=seleziona_mappa
+        )
+
+    with cols[2]:
+        cols[2].button("➡️", key="next", disabled=st.session_state.mappa_selezionata >= len(mappe)-1,
+                       on_click=cambia_mappa, args=(1,))
+
+    # Visualizza la mappa selezionata
+    mappa = mappe[st.session_state.mappa_selezionata]
+    visualizza_mappa(mappa, st.session_state.mappa_selezionata, len(mappe))
+
+def mostra_censimento(id):
+    """Mostra l'avanzamento del censimento o, al termine, il riepilogo e i risultati da scaricare."""
+    lavoro = coda_lavori_condivisa().lavoro(id)
+    if lavoro is None:
+        return
+    if not lavoro.finito:
+        mostra_avanzamento(lavoro.id)
+        return
+    if lavoro.errore:
+        st.error(lavoro.descrizione())
+        return
+    percorso, riepilogo = lavoro.risultato
+    st.text(f"{lavoro.descrizione()}: {riepilogo['edifici']} edifici, "
+            f"superficie totale {riepilogo['superficie_m2']:,.0f} m²")
+    if riepilogo['tile_non_riusciti']:
+        st.warning(f"{len(riepilogo['tile_non_riusciti'])} tile non sono stati scaricati: "
+                   "gli edifici che vi cadono mancano dai risultati")
+    st.write("### Anteprima edifici")
+    st.dataframe(anteprima_censimento(percorso))
+    estensione, mime = next(v for v in FORMATI_CENSIMENTO.values() if percorso.endswith(v[0]))
+    with open(percorso, 'rb') as f:
+        st.download_button(
+            label="📥 Scarica edifici",
+            data=f,
+            file_name=f"censimento_edifici{estensione}",
+            mime=mime,
+            key="scarica_censimento"
+        )
+
+def riepilogo_lavoro(lavoro):
+    """Descrive l'esito di un lavoro terminato insieme allo stato di cache e limiti adattivi."""
+    testo = lavoro.descrizione()
+    if lavoro.tipo == 'tabella' and lavoro.risultato:
+        testo += (f". {lavoro.risultato['elaborate']} indirizzi distinti elaborati, "
+                  f"{lavoro.risultato['riprese']} righe riprese da un'elaborazione interrotta, "
+                  f"{lavoro.risultato['riusate']} righe invariate riusate da file caricati in precedenza")
+    stats = cache_geocoding.statistiche()
+    stats_edifici = cache_edifici_condivisa().statistiche()
+    return (
+        f"{testo}. Cache geocoding: {stats['hits']} hit, {stats['misses']} miss. "
+        f"Cache edifici: {stats_edifici['hit_rate']:.0%} dei tile già disponibili. "
+        f"Limiti adattivi: " + riepilogo_limiti({'geocoding': cache_geocoding.concorrenza,
+                                                  'Overpass': client_condiviso().concorrenza})
+    )
+
+@st.cache_data(max_entries=MAPPE_IN_CACHE, show_spinner=False)
+def html_mappa_edificio(mappa):
+    """Pagina HTML della mappa di un risultato, generata una sola volta per risultato."""
+    with misura('mappa'):
+        return html_mappa(mappa_edificio(mappa))
+
+@st.cache_data(max_entries=20, show_spinner=False)
+def html_mappa_panoramica(chiave, numero, _mappe):
+    """Pagina HTML della mappa con tutti i risultati, rigenerata solo quando ne arrivano di nuovi."""
+    with misura('mappa_panoramica'):
+        # Con molti edifici insieme bastano poligoni semplificati
+        return html_mappa(mappa_panoramica(_mappe.semplificata(TOLLERANZA_PANORAMICA)[:numero]))
+
+def mostra_html_mappa(pagina):
+    # La stessa pagina in cache viene riconosciuta dal browser, che non ricarica la mappa
+    components.html(pagina, width=LARGHEZZA_MAPPA, height=ALTEZZA_MAPPA + 10)
 
 def visualizza_mappa(mappa, indice, totale):
     """Visualizza una singola mappa con i suoi dettagli."""
-    m = folium.Map(location=[mappa['lat'], mappa['lon']], zoom_start=19)
-    folium.Marker(
-        [mappa['lat'], mappa['lon']],
-        popup=f"Indirizzo: {mappa['indirizzo']}",
-        icon=folium.Icon(color="red", icon="info-sign"),
-    ).add_to(m)
-    folium.Polygon(
-        locations=mappa['coordinates'],
-        popup=f"Area: {mappa['area']:.1f} m²",
-        color="blue",
-        fill=True,
-        fill_color="blue",
-        fill_opacity=0.4,
-    ).add_to(m)
-    
     st.write(f"### Mappa {indice + 1}/{totale}")
     st.write(f"**Indirizzo inserito:** {mappa['indirizzo_input']}")
     st.write(f"**Indirizzo trovato:** {mappa['indirizzo']}")
     st.write(f"**Superficie:** {mappa['area']:.1f} m²")
-    folium_static(m, width=800)
+    mostra_html_mappa(html_mappa_edificio(mappa))
+
+def pannello_statistiche():
+    """Mostra nella barra laterale tempi per fase, contatori e limiti di concorrenza del processo."""
+    with st.sidebar.expander("📊 Statistiche prestazioni"):
+        riepilogo = metriche_condivise().riepilogo()
+        if not riepilogo:
+            st.write("Nessuna operazione registrata.")
+            return
+        st.write("**Tempi per fase**")
+        st.dataframe(pd.DataFrame(riepilogo).round(1), hide_index=True)
+        contatori = metriche_condivise().contatori()
+        if contatori:
+            st.write("**Contatori**")
+            st.dataframe(pd.DataFrame([
+                {'Metrica': nome, 'Dettaglio': ', '.join(f"{k}={v}" for k, v in etichette.items()), 'Valore': valore}
+                for nome, etichette, valore in contatori
+            ]), hide_index=True)
+        archivio = archivio_edifici_condiviso()
+        if archivio:
+            stats_archivio = archivio.statistiche()
+            st.write(f"**Archivio edifici:** {stats_archivio['edifici']} edifici, "
+                     f"{stats_archivio['superficie_m2']:,.0f} m² in totale")
+        st.write("**Limiti adattivi**")
+        st.write(riepilogo_limiti({'geocoding': cache_geocoding.concorrenza,
+                                   'Overpass': client_condiviso().concorrenza}))
+        coda = coda_lavori_condivisa()
+        lavori = [lavoro for lavoro in coda.lavori() if not lavoro.finito]
+        st.write(f"**Lavori in background** (al più {coda.lavoratori} contemporanei)")
+        st.write("\n".join(f"- {lavoro.descrizione()}" for lavoro in lavori) or "Nessun lavoro in corso.")
 
 def main():
     st.set_page_config(page_title="Calcolatore Superficie Edifici", layout="wide")
     
+    # Endpoint Prometheus (se configurato con METRICHE_PORTA), avviato una volta per processo
+    avvia_server_condiviso()
+    
     # Inizializza lo stato della sessione se non esiste
     if 'selected_row' not in st.session_state:
         st.session_state.selected_row = None
@@ -378,6 +409,7 @@ def main():
     1. Scegli la modalità:
        - **Singolo Indirizzo**: Inserisci un indirizzo e visualizza il risultato sulla mappa
        - **Carica File**: Carica un file con multiple indirizzi e ottieni i risultati in formato CSV
+       - **Censimento Area**: Misura tutti gli edifici di un comune o di un riquadro, senza indirizzi
     
     ### Formati file supportati:
     - CSV (con una colonna contenente gli indirizzi)
@@ -394,7 +426,7 @@ def main():
     st.markdown("---")
     
     # Tab per scegliere la modalità
-    tab1, tab2 = st.tabs(["Singolo Indirizzo", "Carica File"])
+    tab1, tab2, tab3 = st.tabs(["Singolo Indirizzo", "Carica File", "Censimento Area"])
     
     with tab1:
         col1, col2 = st.columns([2, 3])
@@ -405,39 +437,40 @@ def main():
             
             if calcola_button and indirizzo:
                 with st.spinner("Ricerca indirizzo..."):
-                    lat, lon, indirizzo_completo = ottieni_coordinate(indirizzo)
+                    lat, lon, indirizzo_completo, numero_civico_trovato = ottieni_coordinate(indirizzo)
                 
                 if lat and lon:
                     st.success(f"Indirizzo trovato: {indirizzo_completo}")
                     with st.spinner("Calcolo superficie..."):
-                        area, coordinates, messaggio = calcola_superficie_edificio(lat, lon)
+                        area, coordinates, messaggio = calcola_superficie_edificio(lat, lon, numero_civico_trovato)
                     
                     if area and coordinates:
                         st.metric("Superficie", f"{area:.1f} m²")
                         
-                        # Crea la mappa
-                        m = folium.Map(location=[lat, lon], zoom_start=19)
-                        
-                        # Aggiungi il marker della posizione cercata
-                        folium.Marker(
-                            [lat, lon],
-                            popup="Posizione cercata",
-                            icon=folium.Icon(color="red", icon="info-sign"),
-                        ).add_to(m)
-                        
-                        # Aggiungi il poligono dell'edificio
-                        folium.Polygon(
-                            locations=coordinates,
-                            popup=f"Area: {area:.1f} m²",
-                            color="blue",
-                            fill=True,
-                            fill_color="blue",
-                            fill_opacity=0.4,
-                        ).add_to(m)
-                        
-                        with col2:
-                            st.write("### Mappa dell'edificio")
-                            folium_static(m, width=800)
+                        with misura('mappa'):
+                            # Crea la mappa
+                            m = folium.Map(location=[lat, lon], zoom_start=19)
+                            
+                            # Aggiungi il marker della posizione cercata
+                            folium.Marker(
+                                [lat, lon],
+                                popup="Posizione cercata",
+                                icon=folium.Icon(color="red", icon="info-sign"),
+                            ).add_to(m)
+                            
+                            # Aggiungi il poligono dell'edificio
+                            folium.Polygon(
+                                locations=coordinates,
+                                popup=f"Area: {area:.1f} m²",
+                                color="blue",
+                                fill=True,
+                                fill_color="blue",
+                                fill_opacity=0.4,
+                            ).add_to(m)
+                            
+                            with col2:
+                                st.write("### Mappa dell'edificio")
+                                folium_static(m, width=800)
                     else:
                         st.error(messaggio)
                 else:
@@ -446,13 +479,68 @@ def main():
     with tab2:
         st.write("Carica un file CSV, Excel o di testo contenente gli indirizzi")
         file = st.file_uploader("Scegli un file", type=['csv', 'txt', 'xlsx'])
+        modalita_streaming = st.checkbox(
+            "File molto grande: scrivi i risultati direttamente su disco",
+            help="Legge il file a blocchi e scrive i risultati man mano, senza tabella né mappe"
+        )
+        ripeti_fallite = st.checkbox(
+            "Rielabora le righe non riuscite",
+            help="Gli indirizzi già calcolati in un'elaborazione precedente, anche di un altro file, vengono sempre riusati"
+        )
         
         if file:
-            # Processa il file solo se non è già stato processato o se è un nuovo file
-            if st.session_state.risultati_df is None or file.name != st.session_state.get('ultimo_file', ''):
-                st.session_state.risultati_df, st.session_state.mappe = processa_file(file)
-                st.session_state.ultimo_file = file.name
+            # Invia un nuovo lavoro solo per un nuovo caricamento o per opzioni diverse: un file
+            # modificato con lo stesso nome viene rielaborato, uno identico ritrova il lavoro esistente
+            invio = (file.file_id, modalita_streaming, ripeti_fallite)
+            if invio != st.session_state.get('ultimo_invio'):
+                try:
+                    lavoro = (invia_file_su_disco if modalita_streaming else invia_file)(file, ripeti_fallite)
+                    st.session_state.lavoro = lavoro.id
+                    st.query_params['lavoro'] = lavoro.id
+                except Exception as e:
+                    st.error(f"Errore durante la lettura del file: {str(e)}")
+                    st.session_state.lavoro = None
+                st.session_state.ultimo_invio = invio
+                st.session_state.risultati_df = None
+                st.session_state.mappe = []
                 st.session_state.mappa_selezionata = 0
+        elif 'ultimo_invio' in st.session_state:
+            # File rimosso: il lavoro precedente non viene più mostrato
+            del st.session_state['ultimo_invio']
+            st.session_state.lavoro = None
+            st.query_params.pop('lavoro', None)
+        elif 'lavoro' in st.query_params:
+            # Nuova sessione, ad esempio dopo una disconnessione: riprende il lavoro indicato nell'indirizzo
+            st.session_state.lavoro = st.query_params['lavoro']
+        
+        id_lavoro_corrente = st.session_state.get('lavoro')
+        lavoro = coda_lavori_condivisa().lavoro(id_lavoro_corrente) if id_lavoro_corrente else None
+        if id_lavoro_corrente and lavoro is None:
+            st.info("Elaborazione non più disponibile: ricarica il file per riprenderla dalle righe già completate.")
+        
+        if lavoro is not None and not lavoro.finito:
+            mostra_avanzamento(lavoro.id, con_mappe=lavoro.tipo == 'tabella')
+        
+        elif lavoro is not None and lavoro.errore:
+            st.error(lavoro.descrizione())
+        
+        elif lavoro is not None and lavoro.tipo == 'disco':
+            st.text(riepilogo_lavoro(lavoro))
+            percorso, righe = lavoro.risultato
+            st.write(f"### Anteprima risultati ({righe} righe)")
+            st.dataframe(pd.read_csv(percorso, nrows=100))
+            with open(percorso, 'rb') as f:
+                st.download_button(
+                    label="📥 Scarica risultati CSV",
+                    data=f,
+                    file_name="risultati_superfici.csv",
+                    mime="text/csv"
+                )
+        
+        elif lavoro is not None:
+            st.text(riepilogo_lavoro(lavoro))
+            if st.session_state.risultati_df is None:
+                st.session_state.risultati_df, st.session_state.mappe = lavoro.tabella()
             
             risultati_df = st.session_state.risultati_df
             mappe = st.session_state.mappe
@@ -464,7 +552,14 @@ def main():
                 with col1:
                     # Mostra i risultati in una tabella
                     st.write("### Risultati")
-                    st.dataframe(risultati_df)
+                    if 'Ricalcolata' in risultati_df and not risultati_df['Ricalcolata'].all():
+                        # Le righe riusate da elaborazioni precedenti si possono nascondere
+                        if st.checkbox("Mostra solo le righe ricalcolate", key="solo_ricalcolate"):
+                            st.dataframe(risultati_df[risultati_df['Ricalcolata']])
+                        else:
+                            st.dataframe(risultati_df)
+                    else:
+                        st.dataframe(risultati_df)
                     
                     # Prepara il file CSV per il download
                     csv = risultati_df.to_csv(index=False)
@@ -476,41 +571,38 @@ def main():
                     )
                 
                 with col2:
-                    if mappe:
-                        st.write("### Naviga tra le mappe")
-                        
-                        # Controlli di navigazione in riga
-                        cols = st.columns([1, 3, 1])
-                        with cols[0]:
-                            if cols[0].button("⬅️", key="prev", disabled=st.session_state.mappa_selezionata <= 0):
-                                cambia_mappa(-1)
-                                st.rerun()
-                        
-                        with cols[1]:
-                            # Usa un select_slider invece di uno slider normale
-                            opzioni = [f"Mappa {i+1}/{len(mappe)}" for i in range(len(mappe))]
-                            indice_selezionato = st.select_slider(
-                                "Seleziona la mappa",
-                                options=range(len(mappe)),
-                                value=st.session_state.mappa_selezionata,
-                                format_func=lambda x: opzioni[x],
-                                key="mappa_slider"
-                            )
-                            
-                            if indice_selezionato != st.session_state.mappa_selezionata:
-                                st.session_state.mappa_selezionata = indice_selezionato
-                                st.rerun()
-                        
-                        with cols[2]:
-                            if cols[2].button("➡️", key="next", disabled=st.session_state.mappa_selezionata >= len(mappe)-1):
-                                cambia_mappa(1)
-                                st.rerun()
-                        
-                        # Visualizza la mappa selezionata
-                        mappa = mappe[st.session_state.mappa_selezionata]
-                        visualizza_mappa(mappa, st.session_state.mappa_selezionata, len(mappe))
+                    navigatore_mappe(mappe, lavoro.id)
+
+    with tab3:
+        st.write("Misura tutti gli edifici di OpenStreetMap in un comune o in un riquadro")
+        tipo_area = st.radio("Area", ["Comune", "Riquadro"], horizontal=True, key="tipo_area_censimento")
+        if tipo_area == "Comune":
+            area = st.text_input("Nome del comune in OpenStreetMap", "", key="comune_censimento").strip()
+        else:
+            cols = st.columns(4)
+            area = tuple(
+                colonna.number_input(etichetta, value=predefinito, format="%.5f", key=f"censimento_{etichetta}")
+                for colonna, etichetta, predefinito in zip(cols, ("Sud", "Ovest", "Nord", "Est"),
+                                                            (45.46, 9.18, 45.47, 9.20))
+            )
+        formato = st.selectbox("Formato dei risultati", list(FORMATI_CENSIMENTO), key="formato_censimento")
+
+        if st.button("Avvia censimento", disabled=not area):
+            try:
+                censimento = invia_censimento(area, FORMATI_CENSIMENTO[formato][0])
+                st.session_state.censimento = censimento.id
+                st.query_params['censimento'] = censimento.id
+            except Exception as e:
+                st.error(f"Errore nell'avvio del censimento: {str(e)}")
+        elif 'censimento' not in st.session_state and 'censimento' in st.query_params:
+            # Chi riapre l'indirizzo di un censimento ne ritrova avanzamento e risultati
+            st.session_state.censimento = st.query_params['censimento']
+
+        if st.session_state.get('censimento'):
+            mostra_censimento(st.session_state.censimento)
 
     st.markdown("---")
+    pannello_statistiche()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
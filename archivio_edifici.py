@@ -0,0 +1,174 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from edifici import aree_poligoni, impacchetta_poligoni, coordinate_edificio, contiene_punto
+from metriche import incrementa
+
+# Percorso predefinito e durata oltre la quale un edificio archiviato non viene più riusato
+PERCORSO_PREDEFINITO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'archivio_edifici.sqlite')
+TTL_PREDEFINITO = 30 * 24 * 3600  # 30 giorni
+
+
+class ArchivioEdifici:
+    """Archivio SQLite degli edifici misurati, identificati dall'id della way OSM.
+
+    Di ogni edificio conserva geometria, area, perimetro, tag e momento dello
+    scaricamento, con un indice R-tree sui bounding box. Serve a non misurare
+    di nuovo gli edifici già incontrati (anche da altri processi o dopo un
+    riavvio) e a interrogare per riquadro gli edifici raccolti.
+    Gli edifici archiviati da più di `ttl` secondi non vengono più riusati, ma
+    restano disponibili per le interrogazioni.
+    I tag archiviati sono quelli delle way ricevute: gli edifici che arrivano dai
+    tile (`EdificiTile`) conservano solo i tag in `TAG_CONSERVATI`, quindi
+    l'archivio non sostituisce una query Overpass per gli altri tag.
+    """
+
+    def __init__(self, percorso=PERCORSO_PREDEFINITO, ttl=TTL_PREDEFINITO):
+        self.percorso = percorso
+        self.ttl = ttl
+        self._locale = threading.local()
+        if percorso == ':memory:':
+            raise ValueError("Il database deve essere un file: con ':memory:' ogni thread avrebbe il proprio, vuoto")
+        os.makedirs(os.path.dirname(percorso) or '.', exist_ok=True)
+        with self._connessione() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS edifici (
+                    id INTEGER PRIMARY KEY,
+                    area REAL NOT NULL,
+                    perimetro REAL NOT NULL,
+                    tags TEXT NOT NULL,
+                    coordinate BLOB NOT NULL,
+                    scaricato REAL NOT NULL
+                )
+            """)
+            conn.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS indice_edifici
+                USING rtree(id, min_lat, max_lat, min_lon, max_lon)
+            """)
+
+    def _connessione(self):
+        """Restituisce la connessione SQLite del thread corrente."""
+        conn = getattr(self._locale, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.percorso, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._locale.conn = conn
+        return conn
+
+    @staticmethod
+    def _edificio(riga):
+        id, area, perimetro, tags, coordinate, scaricato = riga
+        return {
+            'id': id,
+            'area': area,
+            'perimetro': perimetro,
+            'tags': json.loads(tags),
+            'coordinates': np.frombuffer(coordinate, dtype=np.float64).reshape(-1, 2).tolist(),
+            'scaricato': scaricato
+        }
+
+    def registra(self, elementi, scaricato=None):
+        """Archivia le way OSM (formato Overpass `out geom`) non ancora presenti o scadute.
+
+        Area e perimetro vengono calcolati una sola volta per edificio, in blocco.
+        Restituisce il numero di edifici archiviati.
+        """
+        elementi = {e['id']: e for e in elementi if e and e.get('geometry')}
+        if not elementi:
+            return 0
+        conn = self._connessione()
+        segnaposto = ','.join('?' * len(elementi))
+        presenti = {id for (id,) in conn.execute(
+            f"SELECT id FROM edifici WHERE id IN ({segnaposto}) AND scaricato >= ?",
+            list(elementi) + [time.time() - self.ttl])}
+        nuovi = [e for id, e in elementi.items() if id not in presenti]
+        if not nuovi:
+            return 0
+        poligoni = [coordinate_edificio(e) for e in nuovi]
+        coordinate, offsets = impacchetta_poligoni(poligoni)
+        aree, perimetri = aree_poligoni(coordinate, offsets)
+        scaricato = scaricato or time.time()
+        righe, bbox = [], []
+        for i, elemento in enumerate(nuovi):
+            vertici = coordinate[offsets[i]:offsets[i + 1]]
+            righe.append((elemento['id'], float(aree[i]), float(perimetri[i]),
+                          json.dumps(elemento.get('tags', {})), vertici.tobytes(), scaricato))
+            bbox.append((elemento['id'], float(vertici[:, 0].min()), float(vertici[:, 0].max()),
+                         float(vertici[:, 1].min()), float(vertici[:, 1].max())))
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO edifici VALUES (?, ?, ?, ?, ?, ?)", righe)
+            conn.executemany("INSERT OR REPLACE INTO indice_edifici VALUES (?, ?, ?, ?, ?)", bbox)
+        return len(nuovi)
+
+    def edificio(self, id):
+        """Restituisce l'edificio archiviato con l'id della way indicato, o None."""
+        riga = self._connessione().execute(
+            "SELECT id, area, perimetro, tags, coordinate, scaricato FROM edifici WHERE id = ?", (id,)
+        ).fetchone()
+        return self._edificio(riga) if riga else None
+
+    def edificio_in(self, lat, lon):
+        """Restituisce l'edificio archiviato (non scaduto) che contiene il punto, o None.
+
+        Tra edifici annidati sceglie il più piccolo, come `IndiceEdifici.cerca_edificio`,
+        così che la risposta non dipenda da quali edifici sono già stati archiviati.
+        Solo il contenimento è una risposta certa: per un punto esterno l'edificio
+        più vicino potrebbe non essere mai stato archiviato.
+        """
+        righe = self._connessione().execute("""
+            SELECT e.id, e.area, e.perimetro, e.tags, e.coordinate, e.scaricato,
+                   (i.max_lat - i.min_lat) * (i.max_lon - i.min_lon)
+            FROM indice_edifici i JOIN edifici e ON e.id = i.id
+            WHERE i.min_lat <= ? AND i.max_lat >= ? AND i.min_lon <= ? AND i.max_lon >= ?
+              AND e.scaricato >= ?
+            ORDER BY e.id
+        """, (lat, lat, lon, lon, time.time() - self.ttl)).fetchall()
+        contenenti = [riga for riga in righe
+                      if contiene_punto(np.frombuffer(riga[4], dtype=np.float64).reshape(-1, 2), lat, lon)]
+        if contenenti:
+            incrementa('cache_totali', cache='archivio_edifici', esito='hit')
+            return self._edificio(min(contenenti, key=lambda riga: riga[6])[:6])
+        incrementa('cache_totali', cache='archivio_edifici', esito='miss')
+        return None
+
+    def nel_riquadro(self, sud, ovest, nord, est):
+        """Genera gli edifici archiviati il cui bounding box interseca il riquadro, per le analisi."""
+        cursore = self._connessione().execute("""
+            SELECT e.id, e.area, e.perimetro, e.tags, e.coordinate, e.scaricato
+            FROM indice_edifici i JOIN edifici e ON e.id = i.id
+            WHERE i.max_lat >= ? AND i.min_lat <= ? AND i.max_lon >= ? AND i.min_lon <= ?
+        """, (sud, nord, ovest, est))
+        for riga in cursore:
+            yield self._edificio(riga)
+
+    def statistiche(self):
+        """Restituisce il numero di edifici archiviati e la superficie totale in m²."""
+        numero, superficie = self._connessione().execute(
+            "SELECT COUNT(*), COALESCE(SUM(area), 0) FROM edifici").fetchone()
+        return {'edifici': numero, 'superficie_m2': superficie}
+
+
+_archivio_condiviso = None
+_archivio_lock = threading.Lock()
+
+
+def archivio_edifici_condiviso():
+    """Restituisce l'archivio degli edifici del processo, o None se disattivato.
+
+    `ARCHIVIO_EDIFICI_PATH` vuota disattiva l'archivio.
+    """
+    global _archivio_condiviso
+    percorso = os.getenv('ARCHIVIO_EDIFICI_PATH', PERCORSO_PREDEFINITO)
+    if not percorso:
+        return None
+    with _archivio_lock:
+        if _archivio_condiviso is None:
+            _archivio_condiviso = ArchivioEdifici(percorso, ttl=float(os.getenv('ARCHIVIO_EDIFICI_TTL',
+                                                                              TTL_PREDEFINITO)))
+        return _archivio_condiviso
@@ -0,0 +1,164 @@
+import math
+import threading
+from array import array
+from collections.abc import Sequence
+
+import numpy as np
+
+from edifici import METRI_PER_GRADO
+
+# Tolleranza (in metri) con cui semplificare i poligoni mostrati tutti insieme nella panoramica
+TOLLERANZA_PANORAMICA = 0.5
+
+
+def semplifica_poligono(vertici, tolleranza):
+    """Semplifica un poligono (lista di [lat, lon]) con l'algoritmo di Douglas-Peucker.
+
+    `tolleranza` è in metri; il primo e l'ultimo vertice vengono sempre conservati.
+    Se la semplificazione lascerebbe meno di tre lati il poligono resta invariato.
+    I poligoni degli edifici hanno pochi vertici: il calcolo in Python puro evita
+    il costo fisso delle operazioni numpy su array piccoli.
+    """
+    n = len(vertici)
+    if n <= 4 or not tolleranza:
+        return vertici
+    # Proiezione locale in metri centrata sul primo vertice, come in `aree_poligoni`
+    lat0, lon0 = vertici[0]
+    scala_lon = METRI_PER_GRADO * math.cos(math.radians(lat0))
+    punti = [((lat - lat0) * METRI_PER_GRADO, (lon - lon0) * scala_lon) for lat, lon in vertici]
+    conservati = [False] * n
+    conservati[0] = conservati[-1] = True
+    da_esaminare = [(0, n - 1)]
+    while da_esaminare:
+        inizio, fine = da_esaminare.pop()
+        ax, ay = punti[inizio]
+        dx, dy = punti[fine][0] - ax, punti[fine][1] - ay
+        lunghezza = math.hypot(dx, dy)
+        distanza_max, scelto = 0.0, None
+        for i in range(inizio + 1, fine):
+            px, py = punti[i][0] - ax, punti[i][1] - ay
+            # Per un anello chiuso il primo tratto va dal primo vertice a sé stesso
+            distanza = abs(dx * py - dy * px) / lunghezza if lunghezza else math.hypot(px, py)
+            if distanza > distanza_max:
+                distanza_max, scelto = distanza, i
+        if scelto is not None and distanza_max > tolleranza:
+            conservati[scelto] = True
+            da_esaminare.append((inizio, scelto))
+            da_esaminare.append((scelto, fine))
+    ridotti = [v for v, tenuto in zip(vertici, conservati) if tenuto]
+    return ridotti if len(ridotti) >= 4 else vertici
+
+
+class ArchivioMappe:
+    """Mappe dei risultati di un'elaborazione in forma compatta.
+
+    I vertici dei poligoni sono conservati in un unico buffer con offset, come
+    scarti in float32 dal primo vertice (conservato in float64): circa 8 byte per
+    vertice invece delle liste di coppie. Gli indirizzi che cadono nello stesso
+    edificio condividono il poligono, riconosciuto dall'id della way OSM.
+    L'archivio cresce soltanto; le mappe nel formato usato dall'interfaccia
+    vengono create solo quando servono, tramite `vista`.
+    """
+
+    def __init__(self):
+        # Per poligono: origine (lat, lon), scarti dei vertici e offset nel buffer degli scarti
+        self._origini = array('d')
+        self._scarti = array('f')
+        self._offsets = array('q', [0])
+        self._poligoni_edificio = {}
+        # Per riga: indice nel file, punto cercato, superficie, poligono e indirizzi
+        self._idx = array('q')
+        self._punti = array('d')
+        self._aree = array('d')
+        self._poligoni = array('q')
+        self._indirizzi = []
+        self._indirizzi_input = []
+        self._lock = threading.Lock()
+
+    def _aggiungi_poligono(self, coordinates, edificio_id):
+        poligono = self._poligoni_edificio.get(edificio_id)
+        if poligono is not None:
+            return poligono
+        vertici = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+        self._origini.extend(vertici[0].tolist())
+        self._scarti.frombytes((vertici - vertici[0]).astype(np.float32).tobytes())
+        self._offsets.append(len(self._scarti) // 2)
+        poligono = len(self._offsets) - 2
+        if edificio_id is not None:
+            self._poligoni_edificio[edificio_id] = poligono
+        return poligono
+
+    def aggiungi(self, idx, lat, lon, coordinates, area, indirizzo, indirizzo_input, edificio_id=None):
+        """Aggiunge la mappa della riga `idx` del file."""
+        with self._lock:
+            self._poligoni.append(self._aggiungi_poligono(coordinates, edificio_id))
+            self._punti.extend((lat, lon))
+            self._aree.append(area)
+            self._indirizzi.append(indirizzo)
+            self._indirizzi_input.append(indirizzo_input)
+            # Per ultimo: chi legge considera solo le righe già complete
+            self._idx.append(idx)
+
+    def __len__(self):
+        return len(self._idx)
+
+    @property
+    def poligoni(self):
+        """Numero di poligoni distinti conservati."""
+        return len(self._offsets) - 1
+
+    @property
+    def dimensione(self):
+        """Stima in byte della memoria occupata dai dati numerici."""
+        return sum(a.itemsize * len(a) for a in (self._origini, self._scarti, self._offsets, self._idx,
+                                                  self._punti, self._aree, self._poligoni))
+
+    def vertici(self, poligono, tolleranza=None):
+        """Restituisce i vertici del poligono come lista di [lat, lon], eventualmente semplificati."""
+        inizio, fine = self._offsets[poligono], self._offsets[poligono + 1]
+        scarti = self._scarti[2 * inizio:2 * fine]
+        lat0, lon0 = self._origini[2 * poligono], self._origini[2 * poligono + 1]
+        vertici = [[lat0 + scarti[k], lon0 + scarti[k + 1]] for k in range(0, len(scarti), 2)]
+        return semplifica_poligono(vertici, tolleranza) if tolleranza else vertici
+
+    def mappa(self, riga, tolleranza=None):
+        """Restituisce la mappa della riga `riga` (in ordine di arrivo) nel formato usato dall'interfaccia."""
+        return {
+            'lat': self._punti[2 * riga],
+            'lon': self._punti[2 * riga + 1],
+            'coordinates': self.vertici(self._poligoni[riga], tolleranza),
+            'area': self._aree[riga],
+            'indirizzo': self._indirizzi[riga],
+            'indirizzo_input': self._indirizzi_input[riga]
+        }
+
+    def vista(self):
+        """Restituisce le mappe presenti, nell'ordine del file, senza crearle."""
+        with self._lock:
+            indici = np.frombuffer(self._idx[:], dtype=np.int64)
+        return VistaMappe(self, np.argsort(indici, kind='stable'))
+
+
+class VistaMappe(Sequence):
+    """Sequenza in sola lettura delle mappe di un `ArchivioMappe`, create quando vengono lette.
+
+    La vista è fissata al momento della creazione: le righe aggiunte in seguito
+    all'archivio non ne cambiano lunghezza né ordine.
+    """
+
+    def __init__(self, archivio, ordine, tolleranza=None):
+        self._archivio = archivio
+        self._ordine = ordine
+        self.tolleranza = tolleranza
+
+    def __len__(self):
+        return len(self._ordine)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return self._archivio.mappa(int(self._ordine[i]), self.tolleranza)
+
+    def semplificata(self, tolleranza):
+        """Restituisce la stessa vista con i poligoni semplificati con tolleranza `tolleranza` metri."""
+        return VistaMappe(self._archivio, self._ordine, tolleranza)
@@ -0,0 +1,263 @@
+"""Benchmark dell'elaborazione dei file, di `calcola_superficie_edificio` e del calcolo delle aree.
+
+Avvia il server di prova (`server_mock.py`) e misura ogni scenario in un
+processo separato, con cache vuote, riportando righe al secondo, latenze p50/p99
+e picco di memoria. Nessuna richiesta raggiunge i servizi reali.
+
+    python benchmark/esegui.py                          # 100, 10.000 e 100.000 righe
+    python benchmark/esegui.py --righe 100 1000 --scenari file area
+    python benchmark/esegui.py --latenza-overpass 800 --errori 0.02 --json risultati.json
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+CARTELLA_PROGETTO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, CARTELLA_PROGETTO)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from server_mock import avvia_server, ServizioMock, LATENZA_GEOCODING, LATENZA_OVERPASS
+
+SCENARI = ('file', 'superficie', 'area')
+RIGHE_PREDEFINITE = (100, 10000, 100000)
+
+# Frazioni di righe duplicate e di indirizzi che non esistono nelle fixture
+QUOTA_DUPLICATI = 0.2
+QUOTA_SCONOSCIUTI = 0.03
+
+# Forme diverse con cui lo stesso indirizzo compare nei file reali
+FORMATI = (
+    "{via} {civico}, {citta}",
+    "{via}, {civico} - {cap} {citta} ({provincia})",
+    "{via} n. {civico}, {citta}, Italia",
+    "{VIA} {civico} {CITTA}",
+)
+
+
+def genera_indirizzi(righe, seme=0):
+    """Genera `righe` indirizzi realistici sulle vie delle fixture, con duplicati e indirizzi sconosciuti."""
+    casuale = random.Random(seme)
+    strade = ServizioMock().strade
+    indirizzi = []
+    for _ in range(righe):
+        if indirizzi and casuale.random() < QUOTA_DUPLICATI:
+            indirizzi.append(casuale.choice(indirizzi))
+            continue
+        strada = casuale.choice(strade)
+        if casuale.random() < QUOTA_SCONOSCIUTI:
+            indirizzi.append(f"Via Inesistente {casuale.randint(1, 99)}, {strada['citta']}")
+            continue
+        civico = str(casuale.randint(1, strada['civici']))
+        if casuale.random() < 0.2:
+            civico += casuale.choice('abcd')
+        formato = casuale.choice(FORMATI)
+        indirizzi.append(formato.format(via=strada['via'], VIA=strada['via'].upper(), civico=civico,
+                                        citta=strada['citta'], CITTA=strada['citta'].upper(),
+                                        cap=strada['cap'], provincia=strada['provincia']))
+    return indirizzi
+
+
+def _percentili(durate):
+    if not durate:
+        return None, None
+    ordinate = sorted(durate)
+    return (ordinate[len(ordinate) // 2] * 1000,
+            ordinate[min(len(ordinate) - 1, int(len(ordinate) * 0.99))] * 1000)
+
+
+def _memoria_mb():
+    # Su Linux ru_maxrss è in kilobyte, su macOS in byte
+    massimo = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return massimo / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def _scenario_file(righe):
+    import app
+
+    class FileCaricato(io.BytesIO):
+        name = 'benchmark.csv'
+
+    indirizzi = genera_indirizzi(righe)
+    contenuto = "Indirizzo\n" + "\n".join('"' + i.replace('"', '""') + '"' for i in indirizzi)
+    inizio = time.perf_counter()
+    lavoro = app.invia_file(FileCaricato(contenuto.encode('utf-8')))
+    lavoro.attendi()
+    durata = time.perf_counter() - inizio
+    if lavoro.errore:
+        raise RuntimeError(lavoro.errore)
+    risultati_df, _ = lavoro.tabella()
+
+    from metriche import metriche_condivise
+    fasi = {fase['Fase']: fase for fase in metriche_condivise().riepilogo()}
+    geocoding = fasi.get('geocoding', {})
+    return {
+        'durata_s': durata,
+        'righe_al_secondo': righe / durata,
+        # Per la pipeline le latenze sono quelle del geocoding di ogni riga
+        'p50_ms': geocoding.get('p50_ms'),
+        'p99_ms': geocoding.get('p99_ms'),
+        'calcolate': int((risultati_df['Stato'] == "✅ Calcolato").sum()) if len(risultati_df) else 0,
+        'fasi': fasi
+    }
+
+
+def _scenario_superficie(righe):
+    import app
+
+    servizio = ServizioMock()
+    punti = []
+    for indirizzo in genera_indirizzi(righe):
+        risposta = servizio.geocode(indirizzo)
+        if risposta['results']:
+            location = risposta['results'][0]['geometry']['location']
+            punti.append((location['lat'], location['lng']))
+
+    durate = []
+    calcolate = 0
+    inizio = time.perf_counter()
+    for lat, lon in punti:
+        t = time.perf_counter()
+        area, _, _ = app.calcola_superficie_edificio(lat, lon)
+        durate.append(time.perf_counter() - t)
+        calcolate += bool(area)
+    durata = time.perf_counter() - inizio
+    p50, p99 = _percentili(durate)
+    return {'durata_s': durata, 'righe_al_secondo': len(punti) / durata, 'p50_ms': p50, 'p99_ms': p99,
+            'calcolate': calcolate}
+
+
+def _scenario_area(righe):
+    from edifici import calculate_area, aree_poligoni, impacchetta_poligoni, coordinate_edificio
+
+    elementi = ServizioMock().elementi
+    poligoni = [coordinate_edificio(elementi[i % len(elementi)]) for i in range(righe)]
+
+    durate = []
+    inizio = time.perf_counter()
+    for coordinates in poligoni:
+        t = time.perf_counter()
+        calculate_area(coordinates)
+        durate.append(time.perf_counter() - t)
+    durata = time.perf_counter() - inizio
+
+    # Stessi poligoni calcolati in blocco, come fa la pipeline
+    inizio_blocco = time.perf_counter()
+    aree_poligoni(*impacchetta_poligoni(poligoni))
+    durata_blocco = time.perf_counter() - inizio_blocco
+
+    p50, p99 = _percentili(durate)
+    return {'durata_s': durata, 'righe_al_secondo': righe / durata, 'p50_ms': p50, 'p99_ms': p99,
+            'calcolate': righe, 'righe_al_secondo_in_blocco': righe / durata_blocco}
+
+
+_FUNZIONI_SCENARI = {
+    'file': _scenario_file,
+    'superficie': _scenario_superficie,
+    'area': _scenario_area,
+}
+
+
+def _esegui_in_processo(scenario, righe, ambiente, coda):
+    """Esegue uno scenario in un processo pulito e restituisce i risultati sulla coda."""
+    os.environ.update(ambiente)
+    import logging
+    logging.disable(logging.WARNING)
+    os.chdir(CARTELLA_PROGETTO)
+    memoria_iniziale = _memoria_mb()
+    try:
+        risultato = _FUNZIONI_SCENARI[scenario](righe)
+        risultato['picco_memoria_mb'] = _memoria_mb()
+        risultato['memoria_aggiuntiva_mb'] = _memoria_mb() - memoria_iniziale
+    except Exception as e:
+        risultato = {'errore': f"{type(e).__name__}: {e}"}
+    coda.put(risultato)
+
+
+def esegui_benchmark(scenari=SCENARI, righe=RIGHE_PREDEFINITE, latenza_geocoding=LATENZA_GEOCODING,
+                     latenza_overpass=LATENZA_OVERPASS, errori=0.0):
+    """Esegue gli scenari richiesti per ogni numero di righe e restituisce la lista dei risultati."""
+    server = avvia_server(latenza_geocoding=latenza_geocoding, latenza_overpass=latenza_overpass, errori=errori)
+    contesto = multiprocessing.get_context('spawn')
+    risultati = []
+    try:
+        for n in righe:
+            for scenario in scenari:
+                with tempfile.TemporaryDirectory(prefix='benchmark_') as cartella:
+                    # Cache, journal e archivio vuoti per ogni scenario, servizi sostituiti dal server di prova
+                    ambiente = {
+                        'GOOGLE_MAPS_API_KEY': 'AIzaBenchmarkChiaveNonValida000000000000',
+                        'GOOGLE_MAPS_BASE_URL': server.url,
+                        'GOOGLE_MAPS_QPS': '100000',
+                        'OVERPASS_URL': f"{server.url}/api/interpreter",
+                        'OVERPASS_RICHIESTE_AL_SECONDO': '1000',
+                        'GEOCODING_CACHE_PATH': os.path.join(cartella, 'geocoding.sqlite'),
+                        'CACHE_EDIFICI_PATH': os.path.join(cartella, 'edifici.sqlite'),
+                        'JOURNAL_PATH': os.path.join(cartella, 'lavori.sqlite'),
+                        'ARCHIVIO_EDIFICI_PATH': os.path.join(cartella, 'archivio.sqlite'),
+                        'BACKEND_EDIFICI': 'overpass',
+                    }
+                    richieste_prima = dict(server.richieste)
+                    coda = contesto.Queue()
+                    processo = contesto.Process(target=_esegui_in_processo, args=(scenario, n, ambiente, coda))
+                    processo.start()
+                    risultato = coda.get()
+                    processo.join()
+                risultato.update({
+                    'scenario': scenario,
+                    'righe': n,
+                    'richieste_geocoding': server.richieste['geocoding'] - richieste_prima['geocoding'],
+                    'richieste_overpass': server.richieste['overpass'] - richieste_prima['overpass']
+                })
+                risultati.append(risultato)
+                _stampa(risultato)
+    finally:
+        server.shutdown()
+    return risultati
+
+
+def _formatta(valore, formato):
+    return format(valore, formato) if valore is not None else '-'
+
+
+def _stampa(risultato):
+    if 'errore' in risultato:
+        print(f"{risultato['scenario']:<11} {risultato['righe']:>7}  ❌ {risultato['errore']}")
+        return
+    print(f"{risultato['scenario']:<11} {risultato['righe']:>7} "
+          f"{_formatta(risultato['righe_al_secondo'], '>12.1f')} "
+          f"{_formatta(risultato['p50_ms'], '>9.2f')} {_formatta(risultato['p99_ms'], '>9.2f')} "
+          f"{_formatta(risultato['picco_memoria_mb'], '>10.1f')} "
+          f"{risultato['richieste_geocoding']:>9} {risultato['richieste_overpass']:>9}", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark con server di prova locale")
+    parser.add_argument('--righe', type=int, nargs='+', default=list(RIGHE_PREDEFINITE))
+    parser.add_argument('--scenari', nargs='+', choices=SCENARI, default=list(SCENARI))
+    parser.add_argument('--latenza-geocoding', type=float, default=LATENZA_GEOCODING * 1000,
+                        help="Latenza media simulata del geocoding in millisecondi")
+    parser.add_argument('--latenza-overpass', type=float, default=LATENZA_OVERPASS * 1000,
+                        help="Latenza media simulata di Overpass in millisecondi")
+    parser.add_argument('--errori', type=float, default=0.0,
+                        help="Frazione di richieste a cui il server risponde con un errore di sovraccarico")
+    parser.add_argument('--json', help="File in cui salvare i risultati completi")
+    args = parser.parse_args()
+
+    print(f"{'scenario':<11} {'righe':>7} {'righe/s':>12} {'p50 ms':>9} {'p99 ms':>9} "
+          f"{'picco MB':>10} {'geocoding':>9} {'overpass':>9}")
+    risultati = esegui_benchmark(args.scenari, args.righe, args.latenza_geocoding / 1000,
+                                 args.latenza_overpass / 1000, args.errori)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(risultati, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""Registra dai servizi reali le fixture usate dal server di prova.
+
+Legge un file di testo con una via per riga nel formato
+`Via, Città, CAP, Provincia, tipo, civici` (tipo `urbano` o `rurale`), ad esempio
+`Via Torino, Milano, 20123, MI, urbano, 200`, e per ciascuna salva le risposte del
+geocoding di Google (civico 1 e via senza civico) e gli edifici Overpass lungo la
+via. Richiede GOOGLE_MAPS_API_KEY e l'accesso alla rete:
+
+    python benchmark/registra_fixture.py strade.txt
+"""
+import argparse
+import json
+import math
+import os
+import sys
+
+import googlemaps
+from dotenv import load_dotenv
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from overpass import client_condiviso, RAGGIO_RICERCA
+
+CARTELLA_FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixture')
+
+# Civico usato insieme al primo per ricavare direzione della via e distanza tra i civici
+CIVICO_RIFERIMENTO = 21
+
+
+def _geocode_grezzo(gmaps, indirizzo):
+    """Restituisce il corpo completo della risposta, come la invierebbe Google."""
+    risultati = gmaps.geocode(indirizzo, language='it')
+    return {'results': risultati, 'status': 'OK' if risultati else 'ZERO_RESULTS'}
+
+
+def _posizione(risposta):
+    location = risposta['results'][0]['geometry']['location']
+    return location['lat'], location['lng']
+
+
+def registra_strada(gmaps, via, citta, cap, provincia, tipo, civici):
+    """Registra le risposte del geocoding di una via e ricava i parametri per gli altri civici."""
+    risposta = _geocode_grezzo(gmaps, f"{via} 1, {cap} {citta} {provincia}")
+    riferimento = _geocode_grezzo(gmaps, f"{via} {CIVICO_RIFERIMENTO}, {cap} {citta} {provincia}")
+    risposta_via = _geocode_grezzo(gmaps, f"{via}, {cap} {citta} {provincia}")
+    if not risposta['results'] or not riferimento['results'] or not risposta_via['results']:
+        raise ValueError(f"Geocoding non riuscito per {via}, {citta}")
+
+    lat1, lon1 = _posizione(risposta)
+    lat2, lon2 = _posizione(riferimento)
+    nord = (lat2 - lat1) * 111320.0
+    est = (lon2 - lon1) * 111320.0 * math.cos(math.radians(lat1))
+    passo = max(math.hypot(nord, est) / (CIVICO_RIFERIMENTO - 1), 1.0)
+    direzione = math.degrees(math.atan2(est, nord)) % 360
+    return {
+        'via': via, 'citta': citta, 'cap': cap, 'provincia': provincia, 'tipo': tipo,
+        'direzione': round(direzione, 1), 'passo_m': round(passo, 2), 'lato_m': 0.0, 'civici': civici,
+        'origine': {'lat': lat1 - nord / 111320.0 / (CIVICO_RIFERIMENTO - 1),
+                    'lng': lon1 - (lon2 - lon1) / (CIVICO_RIFERIMENTO - 1)},
+        'query': f"{via} 1, {citta}", 'risposta': risposta,
+        'query_via': f"{via}, {citta}", 'risposta_via': risposta_via
+    }
+
+
+def registra_edifici(strada):
+    """Scarica da Overpass gli edifici nel rettangolo che contiene tutti i civici della via."""
+    lat0, lon0 = strada['origine']['lat'], strada['origine']['lng']
+    lunghezza = strada['passo_m'] * strada['civici']
+    direzione = math.radians(strada['direzione'])
+    lat1 = lat0 + math.cos(direzione) * lunghezza / 111320.0
+    lon1 = lon0 + math.sin(direzione) * lunghezza / (111320.0 * math.cos(math.radians(lat0)))
+    query = f"""
+    [out:json][timeout:120];
+    way({min(lat0, lat1) - RAGGIO_RICERCA},{min(lon0, lon1) - RAGGIO_RICERCA},{max(lat0, lat1) + RAGGIO_RICERCA},{max(lon0, lon1) + RAGGIO_RICERCA})[building];
+    out geom;
+    """
+    return client_condiviso().esegui(query)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Registra le fixture dei benchmark dai servizi reali")
+    parser.add_argument('strade', help="File con una via per riga: Via, Città, CAP, Provincia, tipo, civici")
+    parser.add_argument('--cartella', default=CARTELLA_FIXTURE, help="Cartella in cui scrivere le fixture")
+    args = parser.parse_args()
+
+    load_dotenv()
+    gmaps = googlemaps.Client(key=os.getenv('GOOGLE_MAPS_API_KEY'))
+
+    strade = []
+    elementi = {}
+    risposta_overpass = None
+    with open(args.strade, encoding='utf-8') as f:
+        for riga in f:
+            if not riga.strip() or riga.startswith('#'):
+                continue
+            via, citta, cap, provincia, tipo, civici = [parte.strip() for parte in riga.split(',')]
+            strada = registra_strada(gmaps, via, citta, cap, provincia, tipo, int(civici))
+            strade.append(strada)
+            risposta_overpass = registra_edifici(strada)
+            for elemento in risposta_overpass.get('elements', []):
+                if elemento.get('type') == 'way' and elemento.get('geometry'):
+                    elementi[elemento['id']] = elemento
+            print(f"✅ {via}, {citta}: {len(risposta_overpass.get('elements', []))} edifici")
+
+    os.makedirs(args.cartella, exist_ok=True)
+    with open(os.path.join(args.cartella, 'geocoding.json'), 'w', encoding='utf-8') as f:
+        json.dump({'strade': strade}, f, ensure_ascii=False, indent=1)
+    intestazione = {k: v for k, v in (risposta_overpass or {}).items() if k != 'elements'}
+    with open(os.path.join(args.cartella, 'overpass.json'), 'w', encoding='utf-8') as f:
+        json.dump(dict(intestazione, elements=list(elementi.values())), f, ensure_ascii=False, separators=(',', ':'))
+    print(f"📁 Fixture salvate in {args.cartella}: {len(strade)} vie, {len(elementi)} edifici")
+
+
+if __name__ == "__main__":
+    main()
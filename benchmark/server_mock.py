@@ -0,0 +1,244 @@
+"""Server HTTP locale che imita il geocoding di Google Maps e l'API Overpass.
+
+Risponde con le fixture in `benchmark/fixture`, con latenza configurabile ed
+errori iniettati (OVER_QUERY_LIMIT per Google, 429/504 per Overpass), così che
+i benchmark non dipendano dai servizi reali. Uso autonomo:
+
+    python benchmark/server_mock.py --porta 8765 --latenza-overpass 400 --errori 0.02
+
+e poi, nel file .env, `OVERPASS_URL=http://127.0.0.1:8765/api/interpreter` e
+`GOOGLE_MAPS_BASE_URL=http://127.0.0.1:8765`.
+"""
+import argparse
+import copy
+import json
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from normalizzazione import normalizza_indirizzo
+
+CARTELLA_FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixture')
+
+# Latenze predefinite (in secondi) dei servizi simulati, con variazione casuale relativa
+LATENZA_GEOCODING = 0.06
+LATENZA_OVERPASS = 0.4
+VARIAZIONE_LATENZA = 0.5
+
+_BBOX = re.compile(r'way\(\s*([-\d.]+)\s*,\s*([-\d.]+)\s*,\s*([-\d.]+)\s*,\s*([-\d.]+)\s*\)')
+_AROUND = re.compile(r'around:\s*([\d.]+)\s*,\s*([-\d.]+)\s*,\s*([-\d.]+)')
+
+
+def _sposta(lat, lon, nord, est):
+    """Sposta un punto di `nord` ed `est` metri."""
+    return lat + nord / 111320.0, lon + est / (111320.0 * math.cos(math.radians(lat)))
+
+
+class ServizioMock:
+    """Risposte simulate costruite dalle fixture registrate.
+
+    Per ogni via le fixture contengono la risposta del geocoding per il civico 1
+    e per la via senza civico, insieme alla direzione della via e alla distanza
+    tra i civici: le risposte per gli altri civici vengono ricavate spostando la
+    posizione lungo la via.
+    """
+
+    def __init__(self, cartella=CARTELLA_FIXTURE):
+        with open(os.path.join(cartella, 'geocoding.json'), encoding='utf-8') as f:
+            self.strade = json.load(f)['strade']
+        for strada in self.strade:
+            strada['chiave_via'] = normalizza_indirizzo(strada['via'])
+            strada['chiave_citta'] = normalizza_indirizzo(strada['citta'])
+
+        with open(os.path.join(cartella, 'overpass.json'), encoding='utf-8') as f:
+            risposta = json.load(f)
+        self._intestazione = {k: v for k, v in risposta.items() if k != 'elements'}
+        elementi = risposta['elements']
+        self._json_elementi = [json.dumps(e, separators=(',', ':')) for e in elementi]
+        self._bbox = np.array([[e['bounds']['minlat'], e['bounds']['minlon'],
+                                e['bounds']['maxlat'], e['bounds']['maxlon']] for e in elementi])
+        self.elementi = elementi
+
+    def trova_strada(self, indirizzo):
+        """Restituisce (strada, civico) per un indirizzo, o (None, None) se non è nelle fixture."""
+        chiave = normalizza_indirizzo(indirizzo)
+        for strada in self.strade:
+            if not chiave.startswith(strada['chiave_via']) or strada['chiave_citta'] not in chiave:
+                continue
+            resto = chiave[len(strada['chiave_via']):]
+            civico = re.match(r'\s*,?\s*(\d+)([a-z]?)\b', resto)
+            if civico:
+                numero = int(civico.group(1))
+                if 1 <= numero <= strada['civici']:
+                    return strada, civico.group(1) + civico.group(2).upper()
+                return strada, None
+            if not resto or resto.startswith((',', ' ')):
+                return strada, None
+        return None, None
+
+    def posizione(self, strada, civico):
+        """Coordinate del civico: i dispari a sinistra della via, i pari a destra."""
+        numero = int(re.match(r'\d+', civico).group(0))
+        direzione = math.radians(strada['direzione'])
+        lungo = numero * strada['passo_m']
+        laterale = strada['lato_m'] * (1 if numero % 2 else -1)
+        nord = math.cos(direzione) * lungo + math.sin(direzione) * laterale
+        est = math.sin(direzione) * lungo - math.cos(direzione) * laterale
+        return _sposta(strada['origine']['lat'], strada['origine']['lng'], nord, est)
+
+    def geocode(self, indirizzo):
+        """Restituisce il corpo JSON della risposta del geocoding per l'indirizzo."""
+        strada, civico = self.trova_strada(indirizzo)
+        if strada is None:
+            return {'results': [], 'status': 'ZERO_RESULTS'}
+        if civico is None:
+            return strada['risposta_via']
+        risposta = copy.deepcopy(strada['risposta'])
+        risultato = risposta['results'][0]
+        lat, lon = self.posizione(strada, civico)
+        risultato['geometry']['location'] = {'lat': round(lat, 7), 'lng': round(lon, 7)}
+        risultato['address_components'][0]['long_name'] = civico
+        risultato['address_components'][0]['short_name'] = civico
+        risultato['formatted_address'] = risultato['formatted_address'].replace(', 1,', f', {civico},', 1)
+        return risposta
+
+    def overpass(self, query):
+        """Restituisce il corpo JSON (testo) della risposta Overpass per una query sugli edifici."""
+        bbox = _BBOX.search(query)
+        if bbox:
+            sud, ovest, nord, est = map(float, bbox.groups())
+        else:
+            intorno = _AROUND.search(query)
+            if not intorno:
+                return None
+            raggio, lat, lon = map(float, intorno.groups())
+            sud, ovest = _sposta(lat, lon, -raggio, -raggio)
+            nord, est = _sposta(lat, lon, raggio, raggio)
+        b = self._bbox
+        selezionati = np.flatnonzero((b[:, 0] <= nord) & (b[:, 2] >= sud) & (b[:, 1] <= est) & (b[:, 3] >= ovest))
+        intestazione = json.dumps(self._intestazione)[:-1]
+        return intestazione + ',"elements":[' + ','.join(self._json_elementi[i] for i in selezionati) + ']}'
+
+
+class _Gestore(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _attendi(self, latenza):
+        if latenza:
+            time.sleep(latenza * random.uniform(1 - VARIAZIONE_LATENZA, 1 + VARIAZIONE_LATENZA))
+
+    def _rispondi(self, stato, corpo, intestazioni=()):
+        corpo = corpo.encode('utf-8')
+        self.send_response(stato)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(corpo)))
+        for nome, valore in intestazioni:
+            self.send_header(nome, valore)
+        self.end_headers()
+        self.wfile.write(corpo)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != '/maps/api/geocode/json':
+            self._rispondi(404, '{}')
+            return
+        server = self.server
+        self._attendi(server.latenza_geocoding)
+        server.conta('geocoding')
+        if random.random() < server.errori:
+            self._rispondi(200, json.dumps({'results': [], 'status': 'OVER_QUERY_LIMIT',
+                                            'error_message': 'Errore iniettato dal server di prova'}))
+            return
+        indirizzo = parse_qs(url.query).get('address', [''])[0]
+        self._rispondi(200, json.dumps(server.servizio.geocode(indirizzo)))
+
+    def do_POST(self):
+        lunghezza = int(self.headers.get('Content-Length', 0))
+        corpo = self.rfile.read(lunghezza).decode('utf-8')
+        query = parse_qs(corpo).get('data', [corpo])[0]
+        server = self.server
+        self._attendi(server.latenza_overpass)
+        server.conta('overpass')
+        if random.random() < server.errori:
+            if random.random() < 0.5:
+                self._rispondi(429, '{}', [('Retry-After', '1')])
+            else:
+                self._rispondi(504, '{}')
+            return
+        risposta = server.servizio.overpass(query)
+        if risposta is None:
+            self._rispondi(400, '{}')
+            return
+        self._rispondi(200, risposta)
+
+    def log_message(self, *args):
+        pass
+
+
+class ServerMock(ThreadingHTTPServer):
+    """Server HTTP con le statistiche delle richieste ricevute."""
+
+    daemon_threads = True
+
+    def __init__(self, indirizzo, servizio, latenza_geocoding, latenza_overpass, errori):
+        super().__init__(indirizzo, _Gestore)
+        self.servizio = servizio
+        self.latenza_geocoding = latenza_geocoding
+        self.latenza_overpass = latenza_overpass
+        self.errori = errori
+        self.richieste = {'geocoding': 0, 'overpass': 0}
+        self._lock = threading.Lock()
+
+    def conta(self, servizio):
+        with self._lock:
+            self.richieste[servizio] += 1
+
+    @property
+    def url(self):
+        host, porta = self.server_address[:2]
+        return f"http://{host}:{porta}"
+
+
+def avvia_server(porta=0, latenza_geocoding=LATENZA_GEOCODING, latenza_overpass=LATENZA_OVERPASS,
+                 errori=0.0, servizio=None):
+    """Avvia il server in un thread in background e lo restituisce (porta 0 = porta libera)."""
+    server = ServerMock(('127.0.0.1', porta), servizio or ServizioMock(),
+                        latenza_geocoding, latenza_overpass, errori)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server locale che imita Google Geocoding e Overpass")
+    parser.add_argument('--porta', type=int, default=8765)
+    parser.add_argument('--latenza-geocoding', type=float, default=LATENZA_GEOCODING * 1000,
+                        help="Latenza media del geocoding in millisecondi")
+    parser.add_argument('--latenza-overpass', type=float, default=LATENZA_OVERPASS * 1000,
+                        help="Latenza media di Overpass in millisecondi")
+    parser.add_argument('--errori', type=float, default=0.0,
+                        help="Frazione di richieste che ricevono un errore di sovraccarico")
+    args = parser.parse_args()
+
+    server = avvia_server(args.porta, args.latenza_geocoding / 1000, args.latenza_overpass / 1000, args.errori)
+    print(f"Server di prova in ascolto su {server.url}")
+    print(f"  OVERPASS_URL={server.url}/api/interpreter")
+    print(f"  GOOGLE_MAPS_BASE_URL={server.url}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
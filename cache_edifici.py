@@ -0,0 +1,300 @@
+import json
+import math
+from array import array
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from coalescenza import Coalescenza
+from edifici import IndiceEdifici
+from metriche import incrementa
+
+# Livello di zoom dei tile (slippy map): a zoom 16 un tile è largo circa 430 metri in Italia
+ZOOM_TILE = 16
+
+# Percorso, durata e budget di memoria predefiniti, sovrascrivibili dal file .env
+PERCORSO_PREDEFINITO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'edifici_tile.sqlite')
+TTL_PREDEFINITO = 7 * 24 * 3600  # 7 giorni
+BUDGET_MB_PREDEFINITO = 256
+
+# Stima dell'occupazione per edificio di tag, indice a griglia e strutture Python
+BYTE_PER_EDIFICIO = 400
+
+# Tag OSM conservati per ogni edificio: gli unici usati per comporre i messaggi
+TAG_CONSERVATI = ('building', 'name')
+
+
+def tile_di(lat, lon, zoom=ZOOM_TILE):
+    """Restituisce il tile (zoom, x, y) della slippy map che contiene il punto."""
+    n = 2 ** zoom
+    x = int((lon + 180.0) / 360.0 * n)
+    lat_rad = math.radians(lat)
+    y = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
+    return zoom, min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def bbox_tile(tile, margine=0.0):
+    """Restituisce il bounding box (sud, ovest, nord, est) del tile, allargato di `margine` gradi."""
+    zoom, x, y = tile
+    n = 2 ** zoom
+
+    def latitudine(riga):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * riga / n))))
+
+    return (latitudine(y + 1) - margine, x / n * 360.0 - 180.0 - margine,
+            latitudine(y) + margine, (x + 1) / n * 360.0 - 180.0 + margine)
+
+
+def tile_copertura(sud, ovest, nord, est, zoom=ZOOM_TILE):
+    """Restituisce i tile che coprono il bounding box, riga per riga."""
+    _, x_min, y_min = tile_di(nord, ovest, zoom)
+    _, x_max, y_max = tile_di(sud, est, zoom)
+    return [(zoom, x, y) for y in range(y_min, y_max + 1) for x in range(x_min, x_max + 1)]
+
+
+class _WayTile:
+    """Sequenza di sola lettura che ricostruisce su richiesta le way nel formato Overpass."""
+
+    def __init__(self, edifici):
+        self._edifici = edifici
+
+    def __len__(self):
+        return len(self._edifici.ids)
+
+    def __getitem__(self, i):
+        return self._edifici.elemento(i)
+
+
+class EdificiTile:
+    """Edifici di un tile in forma compatta: id, tag e vertici impacchettati in array numpy.
+
+    L'indice spaziale viene costruito una volta sola, così che ogni punto che cade
+    nel tile possa essere risolto localmente.
+    """
+
+    def __init__(self, ids, tags, coordinate, offsets):
+        self.ids = ids
+        self.tags = tags
+        self.coordinate = coordinate
+        self.offsets = offsets
+        self.indice = IndiceEdifici.da_poligoni(_WayTile(self), coordinate, offsets)
+
+    @classmethod
+    def da_elementi(cls, elements):
+        """Crea il tile dalle way di una risposta Overpass, anche lette un elemento alla volta.
+
+        Di ogni way restano solo id, tag in `TAG_CONSERVATI` e vertici, accumulati
+        direttamente negli array compatti senza liste intermedie.
+        """
+        ids = array('q')
+        vertici = array('d')
+        offsets = array('q', [0])
+        tags = []
+        for element in elements:
+            geometria = element.get('geometry')
+            if element.get('type') != 'way' or not geometria:
+                continue
+            ids.append(element['id'])
+            tags_way = element.get('tags', {})
+            tags.append({k: tags_way[k] for k in TAG_CONSERVATI if k in tags_way})
+            for node in geometria:
+                vertici.append(node['lat'])
+                vertici.append(node['lon'])
+            offsets.append(len(vertici) // 2)
+        return cls(np.array(ids, dtype=np.int64), tags,
+                   np.array(vertici, dtype=np.float64).reshape(-1, 2), np.array(offsets, dtype=np.int64))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def elemento(self, i):
+        """Restituisce la way i nel formato di una risposta Overpass (`out geom`)."""
+        vertici = self.coordinate[self.offsets[i]:self.offsets[i + 1]]
+        return {
+            'type': 'way',
+            'id': int(self.ids[i]),
+            'tags': self.tags[i],
+            'geometry': [{'lat': lat, 'lon': lon} for lat, lon in vertici.tolist()]
+        }
+
+    def cerca_edificio(self, lat, lon, distanza_max=None):
+        """Come `IndiceEdifici.cerca_edificio`, limitato agli edifici del tile."""
+        return self.indice.cerca_edificio(lat, lon, distanza_max)
+
+    @property
+    def dimensione(self):
+        """Stima in byte della memoria occupata dal tile."""
+        # L'indice conserva anche i bounding box (4 float per edificio)
+        return (self.coordinate.nbytes + self.offsets.nbytes + self.ids.nbytes * 5
+                + len(self.ids) * BYTE_PER_EDIFICIO)
+
+
+class CacheEdifici:
+    """Cache degli edifici per tile, condivisa da tutte le sessioni e i thread del processo.
+
+    In memoria i tile sono conservati in ordine di utilizzo e, superato il budget
+    `budget_byte`, vengono rimossi quelli usati meno di recente. Se `percorso` è
+    indicato i tile vengono salvati anche in un database SQLite, così da essere
+    riutilizzati da altri processi e dopo un riavvio; su disco scadono dopo `ttl`
+    secondi.
+    """
+
+    def __init__(self, budget_byte=BUDGET_MB_PREDEFINITO * 1024 * 1024, percorso=None, ttl=TTL_PREDEFINITO):
+        self.budget_byte = budget_byte
+        self.percorso = percorso
+        self.ttl = ttl
+        self.hits = 0
+        self.hits_disco = 0
+        self.misses = 0
+        self.byte_usati = 0
+        self._tile = OrderedDict()
+        self._lock = threading.Lock()
+        self._locale = threading.local()
+        self._coalescenza = Coalescenza()
+        if percorso:
+            if percorso == ':memory:':
+                raise ValueError("Il database deve essere un file: "
+                                 "con ':memory:' ogni thread avrebbe il proprio, vuoto")
+            os.makedirs(os.path.dirname(percorso) or '.', exist_ok=True)
+            with self._connessione() as conn:
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS tile (
+                        zoom INTEGER NOT NULL,
+                        x INTEGER NOT NULL,
+                        y INTEGER NOT NULL,
+                        ids BLOB NOT NULL,
+                        offsets BLOB NOT NULL,
+                        coordinate BLOB NOT NULL,
+                        tags TEXT NOT NULL,
+                        creato REAL NOT NULL,
+                        PRIMARY KEY (zoom, x, y)
+                    )
+                """)
+                conn.execute("DELETE FROM tile WHERE creato < ?", (time.time() - ttl,))
+
+    def _connessione(self):
+        """Restituisce la connessione SQLite del thread corrente."""
+        conn = getattr(self._locale, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.percorso, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._locale.conn = conn
+        return conn
+
+    def _memorizza(self, tile, edifici):
+        """Inserisce il tile in memoria ed elimina quelli usati meno di recente oltre il budget."""
+        with self._lock:
+            precedente = self._tile.pop(tile, None)
+            if precedente is not None:
+                self.byte_usati -= precedente.dimensione
+            self._tile[tile] = edifici
+            self.byte_usati += edifici.dimensione
+            while self.byte_usati > self.budget_byte and len(self._tile) > 1:
+                _, rimosso = self._tile.popitem(last=False)
+                self.byte_usati -= rimosso.dimensione
+
+    def _leggi_disco(self, tile):
+        riga = self._connessione().execute(
+            "SELECT ids, offsets, coordinate, tags, creato FROM tile WHERE zoom = ? AND x = ? AND y = ?", tile
+        ).fetchone()
+        if riga is None or time.time() - riga[4] > self.ttl:
+            return None
+        ids, offsets, coordinate, tags, _ = riga
+        return EdificiTile(np.frombuffer(ids, dtype=np.int64), json.loads(tags),
+                           np.frombuffer(coordinate, dtype=np.float64).reshape(-1, 2),
+                           np.frombuffer(offsets, dtype=np.int64))
+
+    def leggi(self, tile):
+        """Restituisce gli edifici del tile, dalla memoria o dal disco, o None se assenti."""
+        with self._lock:
+            edifici = self._tile.get(tile)
+            if edifici is not None:
+                self._tile.move_to_end(tile)
+                self.hits += 1
+                incrementa('cache_totali', cache='edifici', esito='hit')
+                return edifici
+        edifici = self._leggi_disco(tile) if self.percorso else None
+        with self._lock:
+            if edifici is None:
+                self.misses += 1
+                incrementa('cache_totali', cache='edifici', esito='miss')
+                return None
+            self.hits_disco += 1
+            incrementa('cache_totali', cache='edifici', esito='hit_disco')
+        self._memorizza(tile, edifici)
+        return edifici
+
+    def scrivi(self, tile, edifici):
+        """Salva gli edifici del tile e restituisce l'`EdificiTile` corrispondente.
+
+        `edifici` è un `EdificiTile` oppure l'elenco delle way di una risposta Overpass.
+        """
+        if not isinstance(edifici, EdificiTile):
+            edifici = EdificiTile.da_elementi(edifici)
+        self._memorizza(tile, edifici)
+        if self.percorso:
+            with self._connessione() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO tile VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    tuple(tile) + (edifici.ids.tobytes(), edifici.offsets.tobytes(),
+                                   edifici.coordinate.tobytes(), json.dumps(edifici.tags), time.time())
+                )
+        return edifici
+
+    def edifici(self, tile, scarica):
+        """Restituisce gli edifici del tile, chiamando `scarica(tile)` solo se non sono in cache.
+
+        Le richieste contemporanee per lo stesso tile attendono un unico scaricamento.
+        """
+        edifici = self.leggi(tile)
+        if edifici is None:
+            edifici = self._coalescenza.esegui(tile, self._scarica, tile, scarica)
+        return edifici
+
+    def _scarica(self, tile, scarica):
+        # Un'altra richiesta potrebbe aver appena completato lo stesso tile
+        with self._lock:
+            edifici = self._tile.get(tile)
+        if edifici is None:
+            edifici = self.scrivi(tile, scarica(tile))
+        return edifici
+
+    def statistiche(self):
+        """Restituisce i contatori di hit/miss, le richieste condivise, i tile in memoria e i byte occupati."""
+        with self._lock:
+            richieste = self.hits + self.hits_disco + self.misses
+            return {
+                'hits': self.hits,
+                'hits_disco': self.hits_disco,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.hits_disco) / richieste if richieste else 0.0,
+                'condivise': self._coalescenza.condivise,
+                'tile': len(self._tile),
+                'byte_usati': self.byte_usati,
+                'budget_byte': self.budget_byte
+            }
+
+
+_cache_condivisa = None
+_cache_lock = threading.Lock()
+
+
+def cache_edifici_condivisa():
+    """Restituisce la cache degli edifici del processo, configurata dalle variabili d'ambiente.
+
+    `CACHE_EDIFICI_PATH` vuota disattiva il salvataggio su disco.
+    """
+    global _cache_condivisa
+    with _cache_lock:
+        if _cache_condivisa is None:
+            _cache_condivisa = CacheEdifici(
+                budget_byte=float(os.getenv('CACHE_EDIFICI_BUDGET_MB', BUDGET_MB_PREDEFINITO)) * 1024 * 1024,
+                percorso=os.getenv('CACHE_EDIFICI_PATH', PERCORSO_PREDEFINITO) or None,
+                ttl=float(os.getenv('CACHE_EDIFICI_TTL', TTL_PREDEFINITO))
+            )
+        return _cache_condivisa
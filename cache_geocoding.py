@@ -0,0 +1,189 @@
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+
+from coalescenza import Coalescenza
+from concorrenza import LimiteAdattivo, e_sovraccarico, GEOCODING_CONCORRENZA_INIZIALE, GEOCODING_CONCORRENZA_MAX
+from metriche import misura, incrementa
+from normalizzazione import normalizza_indirizzo
+
+# Percorso e limiti predefiniti, sovrascrivibili dal file .env
+PERCORSO_PREDEFINITO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'geocoding.sqlite')
+TTL_PREDEFINITO = 30 * 24 * 3600  # 30 giorni
+MAX_VOCI_PREDEFINITO = 100000
+
+# Scritture tra un controllo e l'altro del numero di voci, per non contarle a ogni inserimento
+SCRITTURE_PER_CONTROLLO = 100
+
+# Tentativi e attese dopo un OVER_QUERY_LIMIT: il client Google non ripete le richieste da solo,
+# così che il limite adattivo veda il sovraccarico e riduca le richieste contemporanee
+MAX_TENTATIVI = 5
+ATTESA_BASE = 0.5
+ATTESA_MASSIMA = 30.0
+
+
+def normalizza_chiave(indirizzo):
+    """Normalizza un indirizzo per usarlo come chiave della cache."""
+    return normalizza_indirizzo(indirizzo)
+
+
+class CacheGeocoding:
+    """Cache su disco (SQLite) delle risposte del geocoding di Google Maps.
+
+    La cache è condivisa tra processi (app Streamlit, CLI) e thread: ogni thread
+    usa una propria connessione e SQLite gestisce la concorrenza in modalità WAL,
+    per cui il percorso deve essere un file e non ':memory:'. Le voci scadono
+    dopo `ttl` secondi e, superato `max_voci` (controllato ogni
+    `SCRITTURE_PER_CONTROLLO` scritture), vengono rimosse quelle usate meno di
+    recente. Le chiamate a Google passano per il limite adattivo `concorrenza`,
+    che si riduce con OVER_QUERY_LIMIT; le richieste respinte per sovraccarico
+    vengono ripetute dopo un'attesa crescente.
+    """
+
+    def __init__(self, percorso=PERCORSO_PREDEFINITO, ttl=TTL_PREDEFINITO, max_voci=MAX_VOCI_PREDEFINITO,
+                 concorrenza=None):
+        self.percorso = percorso
+        self.ttl = ttl
+        self.max_voci = max_voci
+        self.concorrenza = concorrenza or LimiteAdattivo(GEOCODING_CONCORRENZA_INIZIALE,
+                                                         massimo=GEOCODING_CONCORRENZA_MAX)
+        self.hits = 0
+        self.misses = 0
+        self._scritture = 0
+        self._lock = threading.Lock()
+        self._locale = threading.local()
+        self._coalescenza = Coalescenza()
+        if percorso == ':memory:':
+            raise ValueError("Il database deve essere un file: con ':memory:' ogni thread avrebbe il proprio, vuoto")
+        os.makedirs(os.path.dirname(percorso) or '.', exist_ok=True)
+        with self._connessione() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS geocoding (
+                    chiave TEXT PRIMARY KEY,
+                    risultato TEXT NOT NULL,
+                    creato REAL NOT NULL,
+                    usato REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS geocoding_usato ON geocoding (usato)")
+
+    def _connessione(self):
+        """Restituisce la connessione SQLite del thread corrente."""
+        conn = getattr(self._locale, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.percorso, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._locale.conn = conn
+        return conn
+
+    def _conta(self, hit):
+        incrementa('cache_totali', cache='geocoding', esito='hit' if hit else 'miss')
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def leggi(self, indirizzo):
+        """Restituisce la risposta in cache per l'indirizzo, o None se assente o scaduta."""
+        chiave = normalizza_chiave(indirizzo)
+        adesso = time.time()
+        conn = self._connessione()
+        riga = conn.execute(
+            "SELECT risultato, creato FROM geocoding WHERE chiave = ?", (chiave,)
+        ).fetchone()
+        if riga is None or adesso - riga[1] > self.ttl:
+            if riga is not None:
+                with conn:
+                    conn.execute("DELETE FROM geocoding WHERE chiave = ?", (chiave,))
+            self._conta(False)
+            return None
+        with conn:
+            conn.execute("UPDATE geocoding SET usato = ? WHERE chiave = ?", (adesso, chiave))
+        self._conta(True)
+        return json.loads(riga[0])
+
+    def scrivi(self, indirizzo, risultato):
+        """Salva la risposta del geocoding ed elimina periodicamente le voci in eccesso."""
+        chiave = normalizza_chiave(indirizzo)
+        adesso = time.time()
+        with self._lock:
+            self._scritture += 1
+            controlla = self._scritture % SCRITTURE_PER_CONTROLLO == 0
+        conn = self._connessione()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO geocoding (chiave, risultato, creato, usato) VALUES (?, ?, ?, ?)",
+                (chiave, json.dumps(risultato), adesso, adesso)
+            )
+            if not controlla:
+                return
+            totale = conn.execute("SELECT COUNT(*) FROM geocoding").fetchone()[0]
+            if totale > self.max_voci:
+                # Rimuovi un 10% in più per non ripetere l'eliminazione a ogni controllo
+                da_rimuovere = totale - int(self.max_voci * 0.9)
+                conn.execute(
+                    "DELETE FROM geocoding WHERE chiave IN "
+                    "(SELECT chiave FROM geocoding ORDER BY usato LIMIT ?)",
+                    (da_rimuovere,)
+                )
+
+    def geocode(self, gmaps, indirizzo):
+        """Esegue `gmaps.geocode` solo se l'indirizzo non è già in cache.
+
+        Le richieste contemporanee per lo stesso indirizzo normalizzato, da thread
+        o sessioni diverse, attendono un'unica chiamata a Google.
+        """
+        return self._coalescenza.esegui(normalizza_chiave(indirizzo), self._geocode, gmaps, indirizzo)
+
+    def _geocode(self, gmaps, indirizzo):
+        risultato = self.leggi(indirizzo)
+        if risultato is None:
+            for tentativo in range(MAX_TENTATIVI):
+                try:
+                    with misura('geocoding_google'):
+                        risultato = self.concorrenza.esegui(gmaps.geocode, indirizzo)
+                    break
+                except Exception as e:
+                    incrementa('errori_servizi_totali', servizio='geocoding',
+                               tipo=getattr(e, 'status', None) or type(e).__name__)
+                    if not e_sovraccarico(e) or tentativo == MAX_TENTATIVI - 1:
+                        raise
+                    # Backoff esponenziale con jitter; il limite è già stato dimezzato
+                    time.sleep(random.uniform(0, min(ATTESA_MASSIMA, ATTESA_BASE * 2 ** tentativo)))
+            self.scrivi(indirizzo, risultato)
+        return risultato
+
+    def statistiche(self):
+        """Restituisce i contatori di hit/miss, le richieste condivise e il numero di voci salvate."""
+        voci = self._connessione().execute("SELECT COUNT(*) FROM geocoding").fetchone()[0]
+        with self._lock:
+            richieste = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / richieste if richieste else 0.0,
+                'condivise': self._coalescenza.condivise,
+                'voci': voci
+            }
+
+
+_cache_condivisa = None
+_cache_lock = threading.Lock()
+
+
+def cache_condivisa():
+    """Restituisce l'istanza di cache del processo, configurata dalle variabili d'ambiente."""
+    global _cache_condivisa
+    with _cache_lock:
+        if _cache_condivisa is None:
+            _cache_condivisa = CacheGeocoding(
+                percorso=os.getenv('GEOCODING_CACHE_PATH', PERCORSO_PREDEFINITO),
+                ttl=float(os.getenv('GEOCODING_CACHE_TTL', TTL_PREDEFINITO)),
+                max_voci=int(os.getenv('GEOCODING_CACHE_MAX_VOCI', MAX_VOCI_PREDEFINITO))
+            )
+        return _cache_condivisa
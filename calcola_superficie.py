@@ -1,10 +1,23 @@
-import requests
 import googlemaps
 from dotenv import load_dotenv
 import os
-import math
+import sys
+import time
+import argparse
+import multiprocessing
 import webbrowser
 import tempfile
+from cache_geocoding import cache_condivisa
+from concorrenza import LimiteAdattivo, GEOCODING_CONCORRENZA_INIZIALE, GEOCODING_CONCORRENZA_MAX
+from overpass import (calcola_superficie_punto, configura_client_condiviso,
+                      RICHIESTE_AL_SECONDO, SLOT_OVERPASS, SLOT_OVERPASS_MAX)
+from estratto_locale import backend_locale_attivo, estratto_condiviso, calcola_superfici_lotto
+from cache_edifici import ZOOM_TILE
+from censimento import Confine, confine_amministrativo, censisci, LIVELLO_COMUNE
+from journal import journal_condiviso
+from metriche import Metriche, metriche_condivise, cronometrato
+from pipeline import CONCORRENZA_GEOCODING, CONCORRENZA_EDIFICI
+from streaming import leggi_indirizzi, processa_file_streaming, unisci_porzioni
 
 # Carica le variabili d'ambiente
 load_dotenv()
@@ -19,11 +32,22 @@ if not os.getenv('GOOGLE_MAPS_API_KEY'):
 
 # Inizializza il client Google Maps
 try:
-    gmaps = googlemaps.Client(key=os.getenv('GOOGLE_MAPS_API_KEY'))
+    gmaps = googlemaps.Client(key=os.getenv('GOOGLE_MAPS_API_KEY'),
+                              base_url=os.getenv('GOOGLE_MAPS_BASE_URL', 'https://maps.googleapis.com'),
+                              queries_per_second=int(os.getenv('GOOGLE_MAPS_QPS', 60)),
+                              # OVER_QUERY_LIMIT arriva alla cache, che riduce il limite adattivo e ripete
+                              retry_over_query_limit=False)
 except Exception as e:
     print(f"❌ Errore nell'inizializzazione del client Google Maps: {str(e)}")
     exit(1)
 
+# Cache del geocoding condivisa con l'app e tra i processi
+cache_geocoding = cache_condivisa()
+
+# Secondi tra un invio e l'altro delle metriche dai processi di elaborazione
+INTERVALLO_METRICHE = 2
+
+@cronometrato('geocoding')
 def ottieni_coordinate(indirizzo):
     """Converte un indirizzo in coordinate geografiche usando Google Maps API."""
     try:
@@ -31,8 +55,8 @@ def ottieni_coordinate(indirizzo):
         if "italia" not in indirizzo.lower():
             indirizzo += ", Italia"
             
-        # Geocoding con Google Maps
-        result = gmaps.geocode(indirizzo)
+        # Geocoding con Google Maps (passando dalla cache su disco)
+        result = cache_geocoding.geocode(gmaps, indirizzo)
         
         if result and len(result) > 0:
             location = result[0]
@@ -47,6 +71,7 @@ def ottieni_coordinate(indirizzo):
         print(f"❌ Errore nel geocoding per l'indirizzo {indirizzo}: {str(e)}")
         return None, None, None, False
 
+@cronometrato('mappa')
 def genera_mappa_html(lat, lon, coordinates, area):
     """Genera una mappa HTML con il poligono dell'edificio usando Google Maps."""
     api_key = os.getenv('GOOGLE_MAPS_API_KEY')
@@ -119,99 +144,175 @@ def genera_mappa_html(lat, lon, coordinates, area):
         f.write(html)
     return path
 
-def calcola_superficie_edificio(lat, lon):
+@cronometrato('superficie_edificio')
+def calcola_superficie_edificio(lat, lon, preciso=True):
     """Calcola la superficie esatta di un edificio utilizzando OpenStreetMap Buildings."""
     try:
-        # Definisci il raggio di ricerca (in gradi)
-        radius = 0.001  # circa 100 metri
-
-        # Query Overpass API per ottenere i dati dell'edificio
-        overpass_url = "http://overpass-api.de/api/interpreter"
-        overpass_query = f"""
-        [out:json];
-        way(around:{int(radius * 111319.9)},{lat},{lon})[building];
-        (._;>;);
-        out geom;
-        """
-        
-        response = requests.post(overpass_url, data=overpass_query)
-        data = response.json()
-        
-        if not data.get('elements'):
-            return None, None, "Nessun edificio trovato a questo indirizzo."
-        
-        # Trova l'edificio più vicino alle coordinate date
-        closest_building = None
-        min_distance = float('inf')
-        
-        for element in data['elements']:
-            if element.get('type') == 'way' and element.get('geometry'):
-                # Calcola il centro dell'edificio
-                coords = element['geometry']
-                center_lat = sum(node['lat'] for node in coords) / len(coords)
-                center_lon = sum(node['lon'] for node in coords) / len(coords)
-                
-                # Calcola la distanza dal punto cercato
-                distance = math.sqrt((center_lat - lat)**2 + (center_lon - lon)**2)
-                
-                if distance < min_distance:
-                    min_distance = distance
-                    closest_building = element
-        
-        if not closest_building:
-            return None, None, "Impossibile calcolare l'area dell'edificio."
-        
-        # Estrai le coordinate dell'edificio
-        coordinates = [[node['lat'], node['lon']] for node in closest_building['geometry']]
-        
-        # Assicurati che il poligono sia chiuso
-        if coordinates[0] != coordinates[-1]:
-            coordinates.append(coordinates[0])
-        
-        # Calcola l'area usando la formula del poligono irregolare (formula di Gauss)
-        def calculate_area(coords):
-            def distance_between_points(lat1, lon1, lat2, lon2):
-                R = 6371000  # Raggio della Terra in metri
-                lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
-                dlat = lat2 - lat1
-                dlon = lon2 - lon1
-                a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon/2)**2
-                c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-                return R * c
-
-            area = 0
-            for i in range(len(coords) - 1):
-                lat1, lon1 = coords[i]
-                lat2, lon2 = coords[i + 1]
-                
-                # Calcola la base e l'altezza del triangolo formato
-                base = distance_between_points(lat1, lon1, lat1, lon2)
-                height = distance_between_points(lat1, lon2, lat2, lon2)
-                
-                # Aggiungi l'area del triangolo
-                area += base * height / 2
-
-            return area
+        # Backend offline: nessuna richiesta di rete
+        if backend_locale_attivo():
+            return estratto_condiviso().calcola_superficie_edificio(lat, lon, preciso)
 
-        area = calculate_area(coordinates)
-        
-        # Se l'edificio ha un nome in OSM, usalo
-        nome_edificio = closest_building.get('tags', {}).get('name', 'Edificio')
-        tipo_edificio = closest_building.get('tags', {}).get('building', '')
-        
-        # Aggiungi il tipo di edificio al messaggio se disponibile
-        if tipo_edificio:
-            messaggio = f"Superficie calcolata con successo per: {nome_edificio} (Tipo: {tipo_edificio})"
-        else:
-            messaggio = f"Superficie calcolata con successo per: {nome_edificio}"
-        
-        return area, coordinates, messaggio
+        # Un edificio già misurato viene riusato dall'archivio; gli altri vengono scaricati per
+        # tile e conservati nella cache degli edifici; senza numero civico la ricerca parte
+        # subito con un raggio ampio
+        return calcola_superficie_punto(lat, lon, preciso)
         
     except Exception as e:
         print(f"❌ Errore durante il calcolo della superficie: {str(e)}")
         return None, None, f"Errore durante il calcolo della superficie: {str(e)}"
 
-def main():
+def _elabora_porzione(sorgente, destinazione, porzione, processi, contatori, limiti, coda_metriche, opzioni):
+    """Elabora in un processo separato una porzione delle righe del file."""
+    k, _ = porzione
+    # I limiti verso Overpass e Google sono ripartiti tra i processi
+    client = configura_client_condiviso(tasso=RICHIESTE_AL_SECONDO / processi,
+                                        slot=max(1, SLOT_OVERPASS // processi),
+                                        slot_max=max(1, SLOT_OVERPASS_MAX // processi))
+    cache_geocoding.concorrenza = LimiteAdattivo(max(1, GEOCODING_CONCORRENZA_INIZIALE // processi),
+                                                 massimo=max(1, GEOCODING_CONCORRENZA_MAX // processi))
+
+    ultimo_invio = time.monotonic()
+
+    def aggiorna(scritte):
+        nonlocal ultimo_invio
+        contatori[k] = scritte
+        geocoding, overpass = cache_geocoding.concorrenza.stato(), client.concorrenza.stato()
+        limiti[4 * k:4 * k + 4] = [geocoding['limite'], geocoding['latenza_media'] or 0,
+                                   overpass['limite'], overpass['latenza_media'] or 0]
+        # Le metriche del processo vengono inviate periodicamente al processo principale
+        if time.monotonic() - ultimo_invio > INTERVALLO_METRICHE:
+            coda_metriche.put((k, metriche_condivise().istantanea()))
+            ultimo_invio = time.monotonic()
+
+    try:
+        processa_file_streaming(
+            sorgente, destinazione, ottieni_coordinate, calcola_superfici_lotto,
+            callback=aggiorna, journal=journal_condiviso(), ripeti_fallite=opzioni['ripeti_fallite'],
+            porzione=porzione, concorrenza_geocoding=opzioni['concorrenza_geocoding'],
+            concorrenza_edifici=opzioni['concorrenza_edifici']
+        )
+    finally:
+        coda_metriche.put((k, metriche_condivise().istantanea()))
+
+def _metriche_processi(coda_metriche, ultime, percorso):
+    """Raccoglie le ultime metriche di ogni processo, le somma e le scrive su `percorso`."""
+    while not coda_metriche.empty():
+        k, istantanea = coda_metriche.get()
+        ultime[k] = istantanea
+    metriche = Metriche()
+    for istantanea in ultime.values():
+        metriche.unisci(istantanea)
+    if percorso:
+        metriche.scrivi_file(percorso)
+    return metriche
+
+def _formatta_durata(secondi):
+    minuti, secondi = divmod(int(secondi), 60)
+    ore, minuti = divmod(minuti, 60)
+    return f"{ore:d}:{minuti:02d}:{secondi:02d}"
+
+def _media_ms(latenze):
+    return f"{sum(latenze) / len(latenze) * 1000:.0f} ms" if latenze else "-"
+
+def elabora_file(sorgente, destinazione, processi=1, concorrenza_geocoding=CONCORRENZA_GEOCODING,
+                 concorrenza_edifici=CONCORRENZA_EDIFICI, ripeti_fallite=False, metriche=None):
+    """Elabora un file di indirizzi senza interazione, ripartendo le righe su più processi.
+
+    Ogni processo scrive un file parziale; al termine i file vengono uniti in
+    `destinazione` (CSV o Parquet) mantenendo l'ordine originale delle righe.
+    Se `metriche` è un percorso, vi vengono scritte durante l'elaborazione le
+    metriche di tutti i processi nel formato testuale di Prometheus.
+    """
+    totale = sum(1 for _ in leggi_indirizzi(sorgente))
+    print(f"📄 {totale} indirizzi da elaborare con {processi} processi")
+
+    opzioni = {
+        'concorrenza_geocoding': concorrenza_geocoding,
+        'concorrenza_edifici': concorrenza_edifici,
+        'ripeti_fallite': ripeti_fallite
+    }
+    cartella = tempfile.mkdtemp(prefix='superfici_')
+    parti = [os.path.join(cartella, f"parte_{k}.csv") for k in range(processi)]
+    # "spawn": i processi aprono cache e journal SQLite da sé invece di ereditarne le connessioni
+    contesto = multiprocessing.get_context('spawn')
+    contatori = contesto.Array('q', processi, lock=False)
+    # Per ogni processo: limite e latenza media di geocoding e Overpass
+    limiti = contesto.Array('d', processi * 4, lock=False)
+    coda_metriche = contesto.Queue()
+    ultime_metriche = {}
+    workers = [
+        contesto.Process(target=_elabora_porzione,
+                         args=(sorgente, parti[k], (k, processi), processi, contatori, limiti,
+                               coda_metriche, opzioni))
+        for k in range(processi)
+    ]
+    inizio = time.monotonic()
+    for worker in workers:
+        worker.start()
+
+    # Mostra avanzamento, velocità e tempo stimato fino al termine dei processi
+    while any(worker.is_alive() for worker in workers):
+        time.sleep(1)
+        completate = sum(contatori)
+        trascorso = time.monotonic() - inizio
+        velocita = completate / trascorso if trascorso else 0
+        eta = (totale - completate) / velocita if velocita else 0
+        latenze_geocoding = [l for l in limiti[1::4] if l]
+        latenze_overpass = [l for l in limiti[3::4] if l]
+        print(f"\r⏱️  {completate}/{totale} righe | {velocita:.1f} righe/s | "
+              f"ETA {_formatta_durata(eta)} | "
+              f"geocoding {sum(limiti[0::4]):.0f} in parallelo "
+              f"({_media_ms(latenze_geocoding)}) | "
+              f"Overpass {sum(limiti[2::4]):.0f} in parallelo "
+              f"({_media_ms(latenze_overpass)})   ", end='', flush=True)
+        _metriche_processi(coda_metriche, ultime_metriche, metriche)
+    print()
+
+    # Riepilogo dei tempi per fase, per capire dove si concentra l'attesa
+    for fase in _metriche_processi(coda_metriche, ultime_metriche, metriche).riepilogo():
+        print(f"   {fase['Fase']}: {fase['Chiamate']} chiamate, {fase['Errori']} errori, "
+              f"p50 {fase['p50_ms']:.1f} ms, p99 {fase['p99_ms']:.1f} ms")
+
+    if any(worker.exitcode != 0 for worker in workers):
+        print("❌ Uno o più processi sono terminati con errore: rilancia il comando per riprendere")
+        return False
+
+    unisci_porzioni(parti, destinazione)
+    for parte in parti:
+        os.remove(parte)
+    os.rmdir(cartella)
+
+    trascorso = time.monotonic() - inizio
+    print(f"✅ {totale} righe elaborate in {_formatta_durata(trascorso)} "
+          f"({totale / trascorso if trascorso else 0:.1f} righe/s). Risultati in {destinazione}")
+    return True
+
+def censisci_area(confine, destinazione, processi=1, zoom=ZOOM_TILE):
+    """Censisce gli edifici dell'area mostrando l'avanzamento per tile (vedi `censimento.censisci`)."""
+    inizio = time.monotonic()
+
+    def aggiorna(completati, totale, edifici):
+        trascorso = time.monotonic() - inizio
+        velocita = completati / trascorso if trascorso else 0
+        eta = (totale - completati) / velocita if velocita else 0
+        print(f"\r⏱️  {completati}/{totale} tile | {edifici} edifici | "
+              f"{edifici / trascorso if trascorso else 0:.0f} edifici/s | ETA {_formatta_durata(eta)}   ",
+              end='', flush=True)
+
+    riepilogo = censisci(confine, destinazione, processi, zoom, callback=aggiorna)
+    print()
+    for tile, errore in riepilogo['tile_non_riusciti'].items():
+        print(f"❌ Tile {tile}: {errore}")
+    if riepilogo['tile_non_riusciti']:
+        print(f"❌ {len(riepilogo['tile_non_riusciti'])} tile non scaricati: i risultati sono incompleti")
+        return False
+
+    trascorso = time.monotonic() - inizio
+    print(f"✅ {riepilogo['edifici']} edifici ({riepilogo['superficie_m2']:,.0f} m²) censiti in "
+          f"{_formatta_durata(trascorso)} su {riepilogo['tile']} tile. Risultati in {destinazione}")
+    return True
+
+def modalita_interattiva():
     print("\n🏢 Calcolatore di Superficie Edifici")
     print("=" * 40)
     print("\n📌 Suggerimenti per un risultato migliore:")
@@ -224,6 +325,8 @@ def main():
         indirizzo = input("\n📍 Inserisci l'indirizzo dell'edificio (o 'q' per uscire): ")
         
         if indirizzo.lower() == 'q':
+            stats = cache_geocoding.statistiche()
+            print(f"\n💾 Cache geocoding: {stats['hits']} hit, {stats['misses']} miss")
             print("\n👋 Grazie per aver usato il calcolatore!")
             break
             
@@ -235,7 +338,7 @@ def main():
                 print("\n⚠️  Attenzione: il numero civico non è stato trovato con precisione.")
                 print("   L'edificio selezionato potrebbe non essere quello corretto.")
                 
-            area, coordinates, messaggio = calcola_superficie_edificio(lat, lon)
+            area, coordinates, messaggio = calcola_superficie_edificio(lat, lon, numero_civico_trovato)
             
             if area and coordinates:
                 print(f"\n📏 Superficie stimata: {area:.1f} m²")
@@ -249,5 +352,58 @@ def main():
         else:
             print("\n❌ Impossibile trovare le coordinate per questo indirizzo.")
 
+def main():
+    parser = argparse.ArgumentParser(description="Calcolatore di superficie edifici")
+    comandi = parser.add_subparsers(dest='comando')
+    batch = comandi.add_parser('batch', help="Elabora un file di indirizzi senza interazione")
+    batch.add_argument('input', help="File di indirizzi (CSV, XLSX o TXT)")
+    batch.add_argument('output', help="File dei risultati (.csv o .parquet)")
+    batch.add_argument('--processi', type=int, default=os.cpu_count() or 1,
+                       help="Numero di processi (predefinito: numero di CPU)")
+    batch.add_argument('--concorrenza-geocoding', type=int, default=CONCORRENZA_GEOCODING,
+                       help="Richieste di geocoding in parallelo per processo (al massimo)")
+    batch.add_argument('--concorrenza-edifici', type=int, default=CONCORRENZA_EDIFICI,
+                       help="Richieste di edifici in parallelo per processo")
+    batch.add_argument('--ripeti-fallite', action='store_true',
+                       help="Rielabora le righe non riuscite in un'esecuzione precedente")
+    batch.add_argument('--metriche', default=os.getenv('METRICHE_PATH'),
+                       help="File in cui scrivere le metriche in formato Prometheus")
+    censimento = comandi.add_parser('censimento',
+                                    help="Misura tutti gli edifici di un riquadro o di un'area amministrativa")
+    censimento.add_argument('output', help="File dei risultati (.parquet o .geojsonl)")
+    area = censimento.add_mutually_exclusive_group(required=True)
+    area.add_argument('--bbox', nargs=4, type=float, metavar=('SUD', 'OVEST', 'NORD', 'EST'),
+                      help="Riquadro in gradi")
+    area.add_argument('--area', help="Nome dell'area amministrativa in OpenStreetMap (ad esempio un comune)")
+    area.add_argument('--confine', help="File GeoJSON con il confine dell'area")
+    censimento.add_argument('--livello-amministrativo', type=int, default=LIVELLO_COMUNE,
+                            help="admin_level OSM dell'area indicata con --area (predefinito: 8, i comuni)")
+    censimento.add_argument('--processi', type=int, default=os.cpu_count() or 1,
+                            help="Numero di processi (predefinito: numero di CPU)")
+    censimento.add_argument('--zoom', type=int, default=ZOOM_TILE,
+                            help="Livello di zoom dei tile scaricati (predefinito: 16, circa 430 metri)")
+    args = parser.parse_args()
+
+    if args.comando == 'censimento':
+        try:
+            if args.bbox:
+                confine = Confine.da_riquadro(*args.bbox)
+            elif args.confine:
+                confine = Confine.da_geojson(args.confine)
+            else:
+                confine = confine_amministrativo(args.area, args.livello_amministrativo)
+        except ValueError as e:
+            print(f"❌ {e}")
+            sys.exit(1)
+        riuscito = censisci_area(confine, args.output, max(1, args.processi), args.zoom)
+        sys.exit(0 if riuscito else 1)
+    elif args.comando == 'batch':
+        riuscito = elabora_file(args.input, args.output, max(1, args.processi),
+                                args.concorrenza_geocoding, args.concorrenza_edifici, args.ripeti_fallite,
+                                args.metriche)
+        sys.exit(0 if riuscito else 1)
+    else:
+        modalita_interattiva()
+
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,153 @@
+import html
+
+import folium
+from branca.element import MacroElement, Template
+from folium.plugins import FastMarkerCluster
+
+# Zoom delle mappe del singolo edificio e zoom massimo quando si seleziona un edificio
+ZOOM_EDIFICIO = 19
+
+# Cifre decimali delle coordinate nel GeoJSON (7 ≈ 1 cm), per contenere le dimensioni della pagina
+CIFRE_COORDINATE = 7
+
+# Crea un marker per ogni riga [lat, lon, testo del popup] del cluster, interamente nel browser
+_MARKER_JS = """
+function (row) {
+    var marker = L.marker(new L.LatLng(row[0], row[1]));
+    marker.bindPopup(row[2]);
+    return marker;
+}
+"""
+
+
+def _popup(mappa):
+    return (f"<b>{html.escape(str(mappa['indirizzo']))}</b><br>"
+            f"Indirizzo inserito: {html.escape(str(mappa['indirizzo_input']))}<br>"
+            f"Superficie: {mappa['area']:.1f} m²")
+
+
+def mappa_edificio(mappa):
+    """Costruisce la mappa di un singolo risultato, con il punto cercato e il poligono dell'edificio."""
+    m = folium.Map(location=[mappa['lat'], mappa['lon']], zoom_start=ZOOM_EDIFICIO)
+    folium.Marker(
+        [mappa['lat'], mappa['lon']],
+        popup=f"Indirizzo: {mappa['indirizzo']}",
+        icon=folium.Icon(color="red", icon="info-sign"),
+    ).add_to(m)
+    folium.Polygon(
+        locations=mappa['coordinates'],
+        popup=f"Area: {mappa['area']:.1f} m²",
+        color="blue",
+        fill=True,
+        fill_color="blue",
+        fill_opacity=0.4,
+    ).add_to(m)
+    return m
+
+
+def geojson_edifici(mappe):
+    """Restituisce una FeatureCollection GeoJSON con il poligono di ogni risultato.
+
+    Le proprietà di ogni feature riportano la posizione nella lista (`n`),
+    gli indirizzi, la superficie e il testo del popup.
+    """
+    features = []
+    for n, mappa in enumerate(mappe):
+        anello = [[round(lon, CIFRE_COORDINATE), round(lat, CIFRE_COORDINATE)] for lat, lon in mappa['coordinates']]
+        if anello and anello[0] != anello[-1]:
+            anello.append(anello[0])
+        features.append({
+            'type': 'Feature',
+            'geometry': {'type': 'Polygon', 'coordinates': [anello]},
+            'properties': {
+                'n': n,
+                'indirizzo': mappa['indirizzo'],
+                'indirizzo_input': mappa['indirizzo_input'],
+                'area': round(mappa['area'], 1),
+                'popup': _popup(mappa)
+            }
+        })
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+class SelettoreEdifici(MacroElement):
+    """Controllo della mappa con l'elenco dei risultati: scegliendone uno la mappa si sposta
+    sull'edificio e ne apre il popup, senza richieste al server.
+
+    Collega anche a ogni poligono dello strato GeoJSON il proprio popup.
+    """
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        (function () {
+            var mappa = {{ this._parent.get_name() }};
+            var livelli = [];
+            {{ this.strato.get_name() }}.eachLayer(function (livello) {
+                livello.bindPopup(livello.feature.properties.popup);
+                livelli[livello.feature.properties.n] = livello;
+            });
+            var controllo = L.control({position: 'topright'});
+            controllo.onAdd = function () {
+                var div = L.DomUtil.create('div', 'leaflet-bar');
+                var elenco = L.DomUtil.create('select', '', div);
+                elenco.style.maxWidth = '320px';
+                elenco.add(new Option({{ this.etichetta|tojson }}, ''));
+                {{ this.opzioni|tojson }}.forEach(function (testo, n) {
+                    elenco.add(new Option(testo, n));
+                });
+                elenco.onchange = function () {
+                    var livello = livelli[this.value];
+                    if (!livello) { return; }
+                    mappa.fitBounds(livello.getBounds(), {maxZoom: {{ this.zoom }}});
+                    livello.openPopup();
+                };
+                L.DomEvent.disableClickPropagation(div);
+                L.DomEvent.disableScrollPropagation(div);
+                return div;
+            };
+            controllo.addTo(mappa);
+        })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, strato, opzioni, etichetta="Seleziona un edificio", zoom=ZOOM_EDIFICIO):
+        super().__init__()
+        self._name = 'SelettoreEdifici'
+        self.strato = strato
+        self.opzioni = opzioni
+        self.etichetta = etichetta
+        self.zoom = zoom
+
+
+def mappa_panoramica(mappe):
+    """Costruisce un'unica mappa con tutti i risultati.
+
+    I poligoni sono un solo strato GeoJSON, i punti cercati sono raggruppati in
+    cluster creati nel browser e un elenco permette di spostarsi su un edificio:
+    una volta generata, la mappa non richiede altro lavoro al server.
+    """
+    m = folium.Map(tiles='OpenStreetMap')
+    strato = folium.GeoJson(
+        geojson_edifici(mappe),
+        name="Edifici",
+        style_function=lambda feature: {'color': 'blue', 'fillColor': 'blue', 'fillOpacity': 0.4, 'weight': 2},
+        tooltip=folium.GeoJsonTooltip(fields=['indirizzo', 'area'], aliases=['Indirizzo', 'Superficie (m²)']),
+    ).add_to(m)
+    FastMarkerCluster(
+        [[mappa['lat'], mappa['lon'], _popup(mappa)] for mappa in mappe],
+        callback=_MARKER_JS,
+        name="Indirizzi cercati",
+    ).add_to(m)
+    opzioni = [f"{n + 1}. {mappa['indirizzo_input']} ({mappa['area']:.0f} m²)" for n, mappa in enumerate(mappe)]
+    m.add_child(SelettoreEdifici(strato, opzioni))
+    if mappe:
+        latitudini = [lat for mappa in mappe for lat, _ in mappa['coordinates']] + [mappa['lat'] for mappa in mappe]
+        longitudini = [lon for mappa in mappe for _, lon in mappa['coordinates']] + [mappa['lon'] for mappa in mappe]
+        m.fit_bounds([[min(latitudini), min(longitudini)], [max(latitudini), max(longitudini)]],
+                     max_zoom=ZOOM_EDIFICIO)
+    return m
+
+
+def html_mappa(m):
+    """Restituisce la pagina HTML completa della mappa, da mostrare in un iframe."""
+    return folium.Figure().add_child(m).render()
@@ -0,0 +1,381 @@
+import json
+import multiprocessing
+from itertools import islice
+
+import numpy as np
+import pandas as pd
+
+from cache_edifici import ZOOM_TILE, bbox_tile, tile_copertura
+from edifici import aree_poligoni, coordinate_edificio, impacchetta_poligoni
+from estratto_locale import backend_locale_attivo, estratto_condiviso
+from metriche import cronometrato
+from overpass import (client_condiviso, configura_client_condiviso, leggi_elementi, query_edifici,
+                      RICHIESTE_AL_SECONDO, SLOT_OVERPASS, SLOT_OVERPASS_MAX)
+from streaming import ScritturaParquet
+
+# Livello amministrativo OSM delle aree cercate per nome: 8 corrisponde ai comuni italiani
+LIVELLO_COMUNE = 8
+
+# Timeout (in secondi) della query Overpass per il confine di un'area amministrativa
+TIMEOUT_QUERY_CONFINE = 60
+
+# Punti esaminati insieme nel test di contenimento, per limitare la memoria della matrice punti × lati
+PUNTI_PER_BLOCCO = 1024
+
+# Colonne dell'output Parquet: i tag sono un oggetto JSON, la geometria è solo nell'output GeoJSON
+COLONNE_CENSIMENTO = [('id', 'int64'), ('latitudine', 'float64'), ('longitudine', 'float64'),
+                      ('superficie_m2', 'float64'), ('perimetro_m', 'float64'), ('building', 'string'),
+                      ('tags', 'string')]
+
+# Estensioni riconosciute per l'output GeoJSON con una feature per riga
+ESTENSIONI_GEOJSONL = ('.geojsonl', '.geojsons', '.jsonl', '.ndjson')
+
+
+class Confine:
+    """Confine di un'area come insieme di lati, per sapere quali punti vi cadono dentro.
+
+    I lati possono provenire da più anelli (parti separate e buchi) in qualsiasi
+    ordine: il ray casting conta gli attraversamenti di tutti i lati, quindi le
+    way di una relazione OSM non devono essere ricomposte in anelli.
+    """
+
+    def __init__(self, linee):
+        inizi, fini = [], []
+        for linea in linee:
+            vertici = np.asarray(linea, dtype=np.float64).reshape(-1, 2)
+            if len(vertici) >= 2:
+                inizi.append(vertici[:-1])
+                fini.append(vertici[1:])
+        if not inizi:
+            raise ValueError("Il confine dell'area non ha lati")
+        inizi, fini = np.concatenate(inizi), np.concatenate(fini)
+        self._y1, self._x1 = inizi[:, 0], inizi[:, 1]
+        self._y2, self._x2 = fini[:, 0], fini[:, 1]
+        self.bbox = (float(min(self._y1.min(), self._y2.min())), float(min(self._x1.min(), self._x2.min())),
+                     float(max(self._y1.max(), self._y2.max())), float(max(self._x1.max(), self._x2.max())))
+
+    @classmethod
+    def da_riquadro(cls, sud, ovest, nord, est):
+        """Crea il confine di un riquadro in gradi."""
+        if not (-90 <= sud < nord <= 90 and -180 <= ovest < est <= 180):
+            raise ValueError("Riquadro non valido: servono sud < nord e ovest < est, in gradi")
+        return cls([[(sud, ovest), (sud, est), (nord, est), (nord, ovest), (sud, ovest)]])
+
+    @classmethod
+    def da_relazione(cls, relazione):
+        """Crea il confine dalle way di una relazione letta da Overpass con `out geom`."""
+        return cls([[(nodo['lat'], nodo['lon']) for nodo in membro['geometry']]
+                    for membro in relazione.get('members', [])
+                    if membro.get('type') == 'way' and membro.get('geometry')])
+
+    @classmethod
+    def da_geojson(cls, percorso):
+        """Crea il confine dai Polygon e MultiPolygon di un file GeoJSON (coordinate lon/lat)."""
+        with open(percorso, encoding='utf-8') as f:
+            dati = json.load(f)
+        if dati.get('type') == 'FeatureCollection':
+            geometrie = [feature.get('geometry') or {} for feature in dati.get('features', [])]
+        else:
+            geometrie = [(dati.get('geometry') or {}) if dati.get('type') == 'Feature' else dati]
+        linee = []
+        for geometria in geometrie:
+            if geometria.get('type') == 'Polygon':
+                anelli = geometria['coordinates']
+            elif geometria.get('type') == 'MultiPolygon':
+                anelli = [anello for poligono in geometria['coordinates'] for anello in poligono]
+            else:
+                continue
+            for anello in anelli:
+                linea = [(lat, lon) for lon, lat, *_ in anello]
+                if linea and linea[0] != linea[-1]:
+                    linea.append(linea[0])
+                linee.append(linea)
+        return cls(linee)
+
+    def contiene(self, lat, lon):
+        """Restituisce per ogni punto (array di latitudini e longitudini) se cade dentro il confine."""
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        dentro = np.zeros(len(lat), dtype=bool)
+        for inizio in range(0, len(lat), PUNTI_PER_BLOCCO):
+            blocco_lat = lat[inizio:inizio + PUNTI_PER_BLOCCO]
+            blocco_lon = lon[inizio:inizio + PUNTI_PER_BLOCCO]
+            # Contano solo i lati nella fascia di latitudini dei punti e a est del più occidentale
+            lati = ((np.maximum(self._y1, self._y2) > blocco_lat.min())
+                    & (np.minimum(self._y1, self._y2) <= blocco_lat.max())
+                    & (np.maximum(self._x1, self._x2) > blocco_lon.min()))
+            y1, x1, y2, x2 = (v[lati][None, :] for v in (self._y1, self._x1, self._y2, self._x2))
+            y, x = blocco_lat[:, None], blocco_lon[:, None]
+            attraversa = (y1 > y) != (y2 > y)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x_intersezione = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+            dentro[inizio:inizio + PUNTI_PER_BLOCCO] = np.count_nonzero(attraversa & (x < x_intersezione), axis=1) % 2 == 1
+        return dentro
+
+    def interseca(self, sud, ovest, nord, est):
+        """Indica se il riquadro può contenere punti dell'area: se un lato lo attraversa o se è tutto interno."""
+        lati = ((np.maximum(self._y1, self._y2) >= sud) & (np.minimum(self._y1, self._y2) <= nord)
+                & (np.maximum(self._x1, self._x2) >= ovest) & (np.minimum(self._x1, self._x2) <= est))
+        if lati.any():
+            return True
+        return bool(self.contiene([(sud + nord) / 2], [(ovest + est) / 2])[0])
+
+
+def query_confine(nome, livello=LIVELLO_COMUNE, timeout=TIMEOUT_QUERY_CONFINE):
+    """Compone la query Overpass per il confine dell'area amministrativa con il nome indicato."""
+    nome = nome.replace('\\', '\\\\').replace('"', '\\"')
+    return (f"[out:json][timeout:{timeout}];"
+            f'relation["boundary"="administrative"]["admin_level"="{livello}"]["name"="{nome}"];'
+            f"out geom;")
+
+
+def confine_amministrativo(nome, livello=LIVELLO_COMUNE):
+    """Scarica da Overpass il confine dell'area amministrativa con il nome indicato.
+
+    Solleva ValueError se non esiste un'area con quel nome e livello o se ne
+    esiste più di una (comuni omonimi): in quel caso serve un file di confine.
+    """
+    relazioni = [e for e in client_condiviso().esegui(query_confine(nome, livello)).get('elements', [])
+                 if e.get('type') == 'relation']
+    if not relazioni:
+        raise ValueError(f"Nessuna area amministrativa di livello {livello} chiamata {nome!r} in OpenStreetMap")
+    if len(relazioni) > 1:
+        raise ValueError(f"{len(relazioni)} aree amministrative di livello {livello} chiamate {nome!r}: "
+                         "indica il confine con un file GeoJSON o un riquadro")
+    return Confine.da_relazione(relazioni[0])
+
+
+def tile_area(confine, zoom=ZOOM_TILE):
+    """Restituisce i tile che coprono l'area, esclusi quelli del riquadro che ne restano fuori."""
+    return [tile for tile in tile_copertura(*confine.bbox, zoom) if confine.interseca(*bbox_tile(tile))]
+
+
+def _way(blocchi):
+    return [elemento for elemento in leggi_elementi(blocchi) if elemento.get('type') == 'way']
+
+
+def edifici_tile_completi(tile):
+    """Restituisce le way degli edifici che intersecano il tile, con tutti i tag, dal backend configurato.
+
+    A differenza di `overpass.edifici_tile` non passa dalla cache degli edifici,
+    che conserva solo i tag usati per i messaggi.
+    """
+    sud, ovest, nord, est = bbox_tile(tile)
+    if backend_locale_attivo():
+        return estratto_condiviso().edifici_riquadro(sud, ovest, nord, est)
+    return client_condiviso().esegui(query_edifici(sud, ovest, nord, est), leggi=_way)
+
+
+def _nel_tile(lat, lon, tile):
+    """Versione vettoriale di `tile_di(lat, lon) == tile` per array di latitudini e longitudini."""
+    zoom, x, y = tile
+    n = 2 ** zoom
+    colonne = np.clip(((lon + 180.0) / 360.0 * n).astype(np.int64), 0, n - 1)
+    righe = np.clip(((1.0 - np.arcsinh(np.tan(np.radians(lat))) / np.pi) / 2.0 * n).astype(np.int64), 0, n - 1)
+    return (colonne == x) & (righe == y)
+
+
+@cronometrato('censimento_tile')
+def censisci_tile(tile, confine):
+    """Misura in blocco gli edifici del tile che appartengono all'area.
+
+    Ogni edificio è attribuito al tile del suo primo vertice, così che un edificio
+    a cavallo di più tile sia contato una volta sola, e appartiene all'area se vi
+    cade lo stesso vertice. Restituisce le colonne degli edifici trovati (id,
+    baricentro dei vertici, superficie, perimetro, tag, vertici impacchettati con
+    offset come in `impacchetta_poligoni`), o None se nel tile non ce ne sono.
+    """
+    ways = [way for way in edifici_tile_completi(tile) if len(way.get('geometry') or ()) >= 3]
+    if not ways:
+        return None
+    primi = np.array([(way['geometry'][0]['lat'], way['geometry'][0]['lon']) for way in ways])
+    scelti = _nel_tile(primi[:, 0], primi[:, 1], tile)
+    scelti[scelti] = confine.contiene(primi[scelti, 0], primi[scelti, 1])
+    ways = [way for way, scelto in zip(ways, scelti) if scelto]
+    if not ways:
+        return None
+    coordinate, offsets = impacchetta_poligoni([coordinate_edificio(way) for way in ways])
+    aree, perimetri = aree_poligoni(coordinate, offsets)
+    # Baricentro dei vertici, senza il vertice di chiusura ripetuto
+    somme = np.add.reduceat(coordinate, offsets[:-1]) - coordinate[offsets[1:] - 1]
+    centri = somme / (np.diff(offsets) - 1)[:, None]
+    return {
+        'id': np.array([way['id'] for way in ways], dtype=np.int64),
+        'latitudine': centri[:, 0],
+        'longitudine': centri[:, 1],
+        'superficie_m2': aree,
+        'perimetro_m': perimetri,
+        'tags': [way.get('tags', {}) for way in ways],
+        'coordinate': coordinate,
+        'offsets': offsets
+    }
+
+
+class ScritturaGeoJSONL:
+    """Scrive gli edifici censiti come GeoJSON lines: una Feature per riga, con tag e misure nelle proprietà."""
+
+    def __init__(self, destinazione):
+        self._file = open(destinazione, 'w', encoding='utf-8')
+
+    @staticmethod
+    def serializza(blocco):
+        """Converte le colonne restituite da `censisci_tile` nel testo da scrivere."""
+        righe = []
+        for i, tags in enumerate(blocco['tags']):
+            vertici = blocco['coordinate'][blocco['offsets'][i]:blocco['offsets'][i + 1]]
+            righe.append(json.dumps({
+                'type': 'Feature',
+                'id': int(blocco['id'][i]),
+                'geometry': {'type': 'Polygon', 'coordinates': [vertici[:, ::-1].tolist()]},
+                'properties': {
+                    'id': int(blocco['id'][i]),
+                    'latitudine': float(blocco['latitudine'][i]),
+                    'longitudine': float(blocco['longitudine'][i]),
+                    'superficie_m2': float(blocco['superficie_m2'][i]),
+                    'perimetro_m': float(blocco['perimetro_m'][i]),
+                    'tags': tags
+                }
+            }, ensure_ascii=False))
+        return ''.join(riga + '\n' for riga in righe)
+
+    def scrivi(self, serializzato):
+        self._file.write(serializzato)
+
+    def chiudi(self):
+        self._file.close()
+
+
+class ScritturaParquetCensimento(ScritturaParquet):
+    """Scrive gli edifici censiti su Parquet (richiede `pyarrow`), con le colonne `COLONNE_CENSIMENTO`.
+
+    Le colonne di più tile vengono accumulate e scritte insieme, in row group di
+    almeno `righe_per_gruppo` edifici.
+    """
+
+    def __init__(self, destinazione):
+        super().__init__(destinazione, colonne=COLONNE_CENSIMENTO)
+        self._righe = 0
+
+    @staticmethod
+    def serializza(blocco):
+        """Converte le colonne restituite da `censisci_tile` in quelle del file."""
+        colonne = {nome: blocco[nome] for nome, _ in COLONNE_CENSIMENTO if nome in blocco and nome != 'tags'}
+        colonne['building'] = [tags.get('building') for tags in blocco['tags']]
+        colonne['tags'] = [json.dumps(tags, ensure_ascii=False) for tags in blocco['tags']]
+        return colonne
+
+    def scrivi(self, colonne):
+        tabella = self._pa.Table.from_pydict(colonne, schema=self._schema)
+        self._buffer.append(tabella)
+        self._righe += tabella.num_rows
+        if self._righe >= self._righe_per_gruppo:
+            self._svuota()
+
+    def _svuota(self):
+        if self._buffer:
+            self._writer.write_table(self._pa.concat_tables(self._buffer))
+            self._buffer = []
+            self._righe = 0
+
+
+def formato_censimento(destinazione):
+    """Sceglie la classe di scrittura del censimento (Parquet o GeoJSON lines) dall'estensione del file."""
+    nome = destinazione.lower()
+    if nome.endswith('.parquet'):
+        return ScritturaParquetCensimento
+    if nome.endswith(ESTENSIONI_GEOJSONL):
+        return ScritturaGeoJSONL
+    raise ValueError(f"Formato non supportato per il censimento: {destinazione} "
+                     f"(usa .parquet o uno tra {', '.join(ESTENSIONI_GEOJSONL)})")
+
+
+def _censisci_tile_sicuro(tile, confine, serializza):
+    """Restituisce (tile, edifici, superficie, dati serializzati, errore).
+
+    I dati vengono serializzati da chi misura il tile, così che il processo che
+    scrive il file debba solo accodarli; un tile non riuscito non interrompe il
+    censimento.
+    """
+    try:
+        blocco = censisci_tile(tile, confine)
+    except Exception as e:
+        return tile, 0, 0.0, None, str(e)
+    if blocco is None:
+        return tile, 0, 0.0, None, None
+    return tile, len(blocco['id']), float(blocco['superficie_m2'].sum()), serializza(blocco), None
+
+
+_processo = {}
+
+
+def _inizializza_processo(confine, serializza, processi):
+    _processo.update(confine=confine, serializza=serializza)
+    # I limiti verso Overpass sono ripartiti tra i processi
+    configura_client_condiviso(tasso=RICHIESTE_AL_SECONDO / processi,
+                               slot=max(1, SLOT_OVERPASS // processi),
+                               slot_max=max(1, SLOT_OVERPASS_MAX // processi))
+
+
+def _censisci_tile_processo(tile):
+    return _censisci_tile_sicuro(tile, _processo['confine'], _processo['serializza'])
+
+
+def _tile_censiti(tiles, confine, serializza, processi):
+    """Genera il risultato di `_censisci_tile_sicuro` per ogni tile, nell'ordine in cui vengono completati."""
+    if processi <= 1 or len(tiles) <= 1:
+        for tile in tiles:
+            yield _censisci_tile_sicuro(tile, confine, serializza)
+        return
+    processi = min(processi, len(tiles))
+    # "spawn": i processi non ereditano i thread e i lock dell'app o della CLI
+    contesto = multiprocessing.get_context('spawn')
+    with contesto.Pool(processi, initializer=_inizializza_processo,
+                       initargs=(confine, serializza, processi)) as pool:
+        yield from pool.imap_unordered(_censisci_tile_processo, tiles)
+
+
+def censisci(confine, destinazione, processi=1, zoom=ZOOM_TILE, callback=None):
+    """Censisce tutti gli edifici dell'area scrivendoli su `destinazione` (Parquet o GeoJSON lines).
+
+    L'area viene coperta con i tile della slippy map; gli edifici di ogni tile sono
+    scaricati da Overpass (o letti dall'estratto locale), misurati e serializzati
+    in blocco da `processi` processi, mentre questo processo accoda i risultati al
+    file man mano, così che la memoria non cresca con il numero di edifici.
+    `callback`, se fornita, viene chiamata con (tile completati, tile totali,
+    edifici scritti). Restituisce il riepilogo con tile, edifici, superficie
+    totale e tile non riusciti.
+    """
+    formato = formato_censimento(destinazione)
+    scrittura = formato(destinazione)
+    riepilogo = {'tile': 0, 'edifici': 0, 'superficie_m2': 0.0, 'tile_non_riusciti': {}}
+    try:
+        tiles = tile_area(confine, zoom)
+        riepilogo['tile'] = len(tiles)
+        if callback:
+            callback(0, len(tiles), 0)
+        risultati = _tile_censiti(tiles, confine, formato.serializza, processi)
+        for completati, (tile, edifici, superficie, serializzato, errore) in enumerate(risultati, start=1):
+            if errore:
+                riepilogo['tile_non_riusciti'][tile] = errore
+            if serializzato is not None:
+                scrittura.scrivi(serializzato)
+            riepilogo['edifici'] += edifici
+            riepilogo['superficie_m2'] += superficie
+            if callback:
+                callback(completati, len(tiles), riepilogo['edifici'])
+    finally:
+        scrittura.chiudi()
+    return riepilogo
+
+
+def anteprima_censimento(percorso, righe=100):
+    """Legge i primi edifici di un file del censimento come DataFrame, senza geometria."""
+    if percorso.lower().endswith('.parquet'):
+        import pyarrow.parquet as pq
+        blocco = next(pq.ParquetFile(percorso).iter_batches(batch_size=righe), None)
+        return blocco.to_pandas() if blocco is not None else pd.DataFrame()
+    with open(percorso, encoding='utf-8') as f:
+        proprieta = [json.loads(riga)['properties'] for riga in islice(f, righe)]
+    for edificio in proprieta:
+        edificio['tags'] = json.dumps(edificio['tags'], ensure_ascii=False)
+    return pd.DataFrame(proprieta)
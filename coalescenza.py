@@ -0,0 +1,41 @@
+import threading
+from concurrent.futures import Future
+
+
+class Coalescenza:
+    """Unisce le richieste contemporanee con la stessa chiave in un'unica esecuzione.
+
+    Il primo chiamante per una chiave esegue la funzione; chi arriva mentre è
+    ancora in corso attende lo stesso risultato (o la stessa eccezione) invece di
+    ripetere la richiesta. Al termine la chiave viene liberata, così che le
+    richieste successive vengano eseguite di nuovo (tipicamente servite da una cache).
+    """
+
+    def __init__(self):
+        self.condivise = 0
+        self._in_corso = {}
+        self._lock = threading.Lock()
+
+    def esegui(self, chiave, funzione, *args):
+        """Esegue `funzione(*args)` una sola volta per tutti i chiamanti contemporanei con `chiave`."""
+        with self._lock:
+            future = self._in_corso.get(chiave)
+            proprietario = future is None
+            if proprietario:
+                future = self._in_corso[chiave] = Future()
+            else:
+                self.condivise += 1
+        if not proprietario:
+            return future.result()
+
+        try:
+            risultato = funzione(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(risultato)
+            return risultato
+        finally:
+            with self._lock:
+                del self._in_corso[chiave]
@@ -0,0 +1,144 @@
+import os
+import threading
+import time
+
+# Richieste di geocoding contemporanee: valore di partenza e massimo, sovrascrivibili dal file .env
+GEOCODING_CONCORRENZA_INIZIALE = int(os.getenv('GEOCODING_CONCORRENZA_INIZIALE', 5))
+GEOCODING_CONCORRENZA_MAX = int(os.getenv('GEOCODING_CONCORRENZA_MAX', 20))
+
+# Peso delle nuove misure nella media mobile esponenziale della latenza delle ultime richieste
+PESO_LATENZA = 0.2
+
+# Peso della media di ogni intervallo nella latenza di riferimento, che segue lentamente il servizio
+# e assorbe le normali oscillazioni dei tempi di risposta
+PESO_LATENZA_RIFERIMENTO = 0.1
+
+# Oltre questo multiplo della latenza di riferimento il servizio è considerato in affanno
+TOLLERANZA_LATENZA = 2.0
+
+# Intervalli di latenza consecutivi in affanno necessari prima di ridurre il limite
+INTERVALLI_IN_AFFANNO = 3
+
+# Fattori di riduzione del limite in caso di sovraccarico esplicito o di latenza in aumento
+RIDUZIONE_SOVRACCARICO = 0.5
+RIDUZIONE_LATENZA = 0.9
+
+
+def e_sovraccarico(errore):
+    """Indica se l'eccezione segnala che il servizio è sovraccarico (429 o OVER_QUERY_LIMIT)."""
+    if getattr(errore, 'status', None) == 'OVER_QUERY_LIMIT':
+        return True
+    risposta = getattr(errore, 'response', None)
+    codice = getattr(errore, 'status_code', None) or getattr(risposta, 'status_code', None)
+    return codice == 429
+
+
+class LimiteAdattivo:
+    """Limite di richieste contemporanee verso un servizio, regolato con AIMD.
+
+    Ogni richiesta completata con una latenza sana aumenta il limite di circa una
+    unità per "giro" di richieste (incremento additivo); un sovraccarico esplicito
+    (429, OVER_QUERY_LIMIT) lo dimezza (decremento moltiplicativo). La latenza
+    media delle ultime richieste viene confrontata con una media di lungo periodo:
+    se ne resta oltre `tolleranza` volte per `INTERVALLI_IN_AFFANNO` intervalli di
+    latenza consecutivi il limite si riduce gradualmente, mentre le oscillazioni
+    normali dei tempi di risposta non lo toccano. Le riduzioni sono applicate al
+    più una volta per intervallo, così che una raffica di errori della stessa
+    finestra conti una volta sola.
+    """
+
+    def __init__(self, iniziale, minimo=1, massimo=None, tolleranza=TOLLERANZA_LATENZA):
+        self.minimo = minimo
+        self.massimo = max(massimo or iniziale, minimo)
+        self.limite = float(min(max(iniziale, minimo), self.massimo))
+        self.tolleranza = tolleranza
+        self.in_uso = 0
+        self.richieste = 0
+        self.sovraccarichi = 0
+        self.latenza_media = None
+        self.latenza_riferimento = None
+        self._ultima_riduzione = 0.0
+        self._inizio_intervallo = None
+        self._intervalli_in_affanno = 0
+        self._condizione = threading.Condition()
+
+    def acquisisci(self):
+        """Attende un posto libero entro il limite corrente e restituisce l'istante di inizio."""
+        with self._condizione:
+            while self.in_uso >= int(self.limite):
+                self._condizione.wait()
+            self.in_uso += 1
+        return time.monotonic()
+
+    def _riduci(self, fattore, adesso):
+        if adesso - self._ultima_riduzione < (self.latenza_media or 1.0):
+            return
+        self.limite = max(self.minimo, self.limite * fattore)
+        self._ultima_riduzione = adesso
+
+    def rilascia(self, inizio, sovraccarico=False, errore=False):
+        """Libera il posto preso con `acquisisci` e aggiorna il limite con l'esito della richiesta."""
+        adesso = time.monotonic()
+        with self._condizione:
+            self.in_uso -= 1
+            self.richieste += 1
+            if sovraccarico:
+                self.sovraccarichi += 1
+                self._riduci(RIDUZIONE_SOVRACCARICO, adesso)
+            elif not errore:
+                latenza = adesso - inizio
+                if self.latenza_media is None:
+                    self.latenza_media = self.latenza_riferimento = latenza
+                    self._inizio_intervallo = adesso
+                else:
+                    self.latenza_media += PESO_LATENZA * (latenza - self.latenza_media)
+                in_affanno = self.latenza_media > self.tolleranza * self.latenza_riferimento
+                # L'affanno viene valutato una volta per intervallo e deve durare più intervalli
+                if adesso - self._inizio_intervallo >= self.latenza_media:
+                    self._intervalli_in_affanno = self._intervalli_in_affanno + 1 if in_affanno else 0
+                    self.latenza_riferimento += PESO_LATENZA_RIFERIMENTO * (self.latenza_media -
+                                                                          self.latenza_riferimento)
+                    self._inizio_intervallo = adesso
+                if self._intervalli_in_affanno >= INTERVALLI_IN_AFFANNO:
+                    self._riduci(RIDUZIONE_LATENZA, adesso)
+                elif not in_affanno:
+                    self.limite = min(self.massimo, self.limite + 1 / self.limite)
+            self._condizione.notify_all()
+
+    def esegui(self, funzione, *args):
+        """Esegue `funzione(*args)` entro il limite, registrandone latenza ed esito."""
+        inizio = self.acquisisci()
+        try:
+            risultato = funzione(*args)
+        except Exception as e:
+            self.rilascia(inizio, sovraccarico=e_sovraccarico(e), errore=True)
+            raise
+        self.rilascia(inizio)
+        return risultato
+
+    def stato(self):
+        """Restituisce limite corrente, richieste in corso e latenze osservate (in secondi)."""
+        with self._condizione:
+            return {
+                'limite': int(self.limite),
+                'massimo': self.massimo,
+                'in_uso': self.in_uso,
+                'richieste': self.richieste,
+                'sovraccarichi': self.sovraccarichi,
+                'latenza_media': self.latenza_media,
+                'latenza_riferimento': self.latenza_riferimento
+            }
+
+
+def riepilogo_limiti(limiti):
+    """Descrive in una riga lo stato dei limiti {nome del servizio: LimiteAdattivo}."""
+    parti = []
+    for nome, limite in limiti.items():
+        stato = limite.stato()
+        testo = f"{nome}: {stato['limite']}/{stato['massimo']} richieste contemporanee"
+        if stato['latenza_media'] is not None:
+            testo += f", latenza media {stato['latenza_media'] * 1000:.0f} ms"
+        if stato['sovraccarichi']:
+            testo += f", {stato['sovraccarichi']} sovraccarichi"
+        parti.append(testo)
+    return "; ".join(parti)
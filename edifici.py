@@ -0,0 +1,287 @@
+import math
+
+import numpy as np
+
+from metriche import cronometrato
+
+# Raggio medio della Terra in metri
+RAGGIO_TERRA = 6371000
+
+# Metri in un grado di latitudine (e di longitudine all'equatore)
+METRI_PER_GRADO = 111319.9
+
+# Lato delle celle dell'indice spaziale sugli edifici (in gradi, circa 50 metri)
+DIMENSIONE_CELLA_INDICE = 0.0005
+
+# Messaggi restituiti quando non è possibile determinare l'edificio
+MESSAGGIO_NESSUN_EDIFICIO = "Nessun edificio trovato a questo indirizzo."
+MESSAGGIO_AREA_NON_CALCOLABILE = "Impossibile calcolare l'area dell'edificio."
+
+
+def _celle_anello(riga, col, anello):
+    """Genera le celle sul bordo del quadrato di raggio `anello` centrato sulla cella data."""
+    if anello == 0:
+        yield riga, col
+        return
+    for c in range(col - anello, col + anello + 1):
+        yield riga - anello, c
+        yield riga + anello, c
+    for r in range(riga - anello + 1, riga + anello):
+        yield r, col - anello
+        yield r, col + anello
+
+
+def contiene_punto(vertici, lat, lon):
+    """Verifica con il ray casting se il punto cade dentro il poligono (array N×2 di lat, lon)."""
+    y, x = vertici[:, 0], vertici[:, 1]
+    y_succ, x_succ = np.roll(y, -1), np.roll(x, -1)
+    attraversa = (y > lat) != (y_succ > lat)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_intersezione = x + (lat - y) * (x_succ - x) / (y_succ - y)
+    return np.count_nonzero(attraversa & (lon < x_intersezione)) % 2 == 1
+
+
+class IndiceEdifici:
+    """Indice spaziale a griglia sulle way di una risposta Overpass.
+
+    I bounding box di tutte le way sono precalcolati e ogni way è registrata nelle
+    celle della griglia che il suo bounding box attraversa, così che la ricerca di
+    un punto esamini solo gli edifici delle celle vicine.
+    """
+
+    def __init__(self, elements, dimensione_cella=DIMENSIONE_CELLA_INDICE):
+        ways = [e for e in elements if e.get('type') == 'way' and e.get('geometry')]
+        coordinate, offsets = impacchetta_poligoni(
+            [[(node['lat'], node['lon']) for node in way['geometry']] for way in ways])
+        self._costruisci(ways, coordinate, offsets, dimensione_cella)
+
+    @classmethod
+    def da_poligoni(cls, ways, coordinate, offsets, dimensione_cella=DIMENSIONE_CELLA_INDICE):
+        """Costruisce l'indice da poligoni già impacchettati con `impacchetta_poligoni`.
+
+        `ways` è una sequenza qualsiasi (con `len` e accesso per indice) i cui elementi
+        vengono restituiti da `edificio_piu_vicino`.
+        """
+        indice = cls.__new__(cls)
+        indice._costruisci(ways, coordinate, offsets, dimensione_cella)
+        return indice
+
+    def _costruisci(self, ways, coordinate, offsets, dimensione_cella):
+        self.ways = ways
+        self.dimensione_cella = dimensione_cella
+        self.celle = {}
+        if not len(ways):
+            return
+
+        self.coordinate, self.offsets = coordinate, offsets
+        inizi = self.offsets[:-1]
+        self.min_lat = np.minimum.reduceat(self.coordinate[:, 0], inizi)
+        self.max_lat = np.maximum.reduceat(self.coordinate[:, 0], inizi)
+        self.min_lon = np.minimum.reduceat(self.coordinate[:, 1], inizi)
+        self.max_lon = np.maximum.reduceat(self.coordinate[:, 1], inizi)
+
+        for i in range(len(self.ways)):
+            riga_min, col_min = self._cella(self.min_lat[i], self.min_lon[i])
+            riga_max, col_max = self._cella(self.max_lat[i], self.max_lon[i])
+            for riga in range(riga_min, riga_max + 1):
+                for col in range(col_min, col_max + 1):
+                    self.celle.setdefault((riga, col), []).append(i)
+
+        righe = [cella[0] for cella in self.celle]
+        colonne = [cella[1] for cella in self.celle]
+        self._limiti = (min(righe), max(righe), min(colonne), max(colonne))
+
+    def _cella(self, lat, lon):
+        return math.floor(lat / self.dimensione_cella), math.floor(lon / self.dimensione_cella)
+
+    def _vertici(self, i):
+        return self.coordinate[self.offsets[i]:self.offsets[i + 1]]
+
+    def _contiene(self, i, lat, lon):
+        """Verifica se il punto cade dentro il poligono i."""
+        return contiene_punto(self._vertici(i), lat, lon)
+
+    def _distanze(self, candidati, lat, lon):
+        """Distanze in metri tra il punto e il lato più vicino di ciascun poligono candidato."""
+        candidati = np.asarray(candidati, dtype=np.int64)
+        lunghezze = self.offsets[candidati + 1] - self.offsets[candidati]
+        inizi = np.zeros(len(candidati), dtype=np.int64)
+        np.cumsum(lunghezze[:-1], out=inizi[1:])
+        posizioni = np.arange(lunghezze.sum()) + np.repeat(self.offsets[candidati] - inizi, lunghezze)
+        vertici = self.coordinate[posizioni]
+
+        scala = math.radians(1) * RAGGIO_TERRA
+        py = (vertici[:, 0] - lat) * scala
+        px = (vertici[:, 1] - lon) * scala * math.cos(math.radians(lat))
+        successivo = np.arange(len(vertici)) + 1
+        successivo[inizi + lunghezze - 1] = inizi
+        dx, dy = px[successivo] - px, py[successivo] - py
+
+        # Proiezione del punto su ogni lato, limitata agli estremi del segmento
+        lunghezza2 = dx * dx + dy * dy
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = np.where(lunghezza2 > 0, -(px * dx + py * dy) / lunghezza2, 0.0)
+        t = np.clip(t, 0.0, 1.0)
+        return np.minimum.reduceat(np.hypot(px + t * dx, py + t * dy), inizi)
+
+    def edificio_piu_vicino(self, lat, lon, distanza_max=None):
+        """Restituisce l'edificio che contiene il punto o, in mancanza, quello col lato più vicino.
+
+        Se `distanza_max` (in metri) è indicata, gli edifici più lontani vengono ignorati.
+        """
+        return self.cerca_edificio(lat, lon, distanza_max)[0]
+
+    @cronometrato('selezione_edificio')
+    def cerca_edificio(self, lat, lon, distanza_max=None):
+        """Come `edificio_piu_vicino`, ma restituisce la coppia (edificio, distanza in metri).
+
+        La distanza è 0 se l'edificio contiene il punto; (None, None) se non ce n'è nessuno.
+        """
+        if not len(self.ways):
+            return None, None
+
+        # 1) Edifici che contengono il punto; tra edifici annidati preferisci il più piccolo
+        contenenti = [
+            i for i in self.celle.get(self._cella(lat, lon), ())
+            if self.min_lat[i] <= lat <= self.max_lat[i] and self.min_lon[i] <= lon <= self.max_lon[i]
+            and self._contiene(i, lat, lon)
+        ]
+        if contenenti:
+            return self.ways[min(contenenti, key=lambda i: (self.max_lat[i] - self.min_lat[i]) *
+                                                           (self.max_lon[i] - self.min_lon[i]))], 0.0
+
+        # 2) Distanza dal lato più vicino, esplorando la griglia ad anelli crescenti
+        riga, col = self._cella(lat, lon)
+        riga_min, riga_max, col_min, col_max = self._limiti
+        max_anello = max(riga - riga_min, riga_max - riga, col - col_min, col_max - col)
+        lato_cella = self.dimensione_cella * math.radians(1) * RAGGIO_TERRA * math.cos(math.radians(lat))
+        if distanza_max is not None:
+            max_anello = min(max_anello, math.ceil(distanza_max / lato_cella) + 1)
+
+        migliore, distanza_migliore = None, float('inf')
+        visitati = set()
+        for anello in range(max_anello + 1):
+            candidati = []
+            for cella in _celle_anello(riga, col, anello):
+                for i in self.celle.get(cella, ()):
+                    if i not in visitati:
+                        visitati.add(i)
+                        candidati.append(i)
+            if candidati:
+                distanze = self._distanze(candidati, lat, lon)
+                j = int(np.argmin(distanze))
+                if distanze[j] < distanza_migliore:
+                    migliore, distanza_migliore = candidati[j], float(distanze[j])
+            # Gli edifici degli anelli successivi distano almeno `anello * lato_cella`
+            if migliore is not None and distanza_migliore <= anello * lato_cella:
+                break
+
+        if migliore is None or (distanza_max is not None and distanza_migliore > distanza_max):
+            return None, None
+        return self.ways[migliore], distanza_migliore
+
+
+def seleziona_edificio(elements, lat, lon, distanza_max=None):
+    """Trova l'edificio che contiene le coordinate date o, in mancanza, il più vicino."""
+    return IndiceEdifici(elements).edificio_piu_vicino(lat, lon, distanza_max)
+
+
+def impacchetta_poligoni(poligoni):
+    """Impacchetta una lista di poligoni [[lat, lon], ...] in un unico array con offset.
+
+    Restituisce `(coordinate, offsets)`: `coordinate` ha forma (N, 2) e i vertici del
+    poligono i sono `coordinate[offsets[i]:offsets[i + 1]]`.
+    """
+    lunghezze = np.fromiter((len(p) for p in poligoni), dtype=np.int64, count=len(poligoni))
+    offsets = np.zeros(len(poligoni) + 1, dtype=np.int64)
+    np.cumsum(lunghezze, out=offsets[1:])
+    if offsets[-1] == 0:
+        return np.empty((0, 2), dtype=np.float64), offsets
+    coordinate = np.array([v for p in poligoni for v in p], dtype=np.float64).reshape(-1, 2)
+    return coordinate, offsets
+
+
+@cronometrato('calcolo_area')
+def aree_poligoni(coordinate, offsets):
+    """Calcola in un solo passaggio vettoriale area (m²) e perimetro (m) di molti poligoni.
+
+    Ogni poligono viene proiettato localmente in metri (proiezione equirettangolare
+    centrata sul suo primo vertice) e l'area è calcolata con la formula di Gauss
+    (shoelace). I poligoni possono essere chiusi o aperti; quelli con meno di tre
+    vertici hanno area nulla.
+    """
+    coordinate = np.asarray(coordinate, dtype=np.float64).reshape(-1, 2)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    n_poligoni = len(offsets) - 1
+    aree = np.zeros(n_poligoni)
+    perimetri = np.zeros(n_poligoni)
+
+    lunghezze = np.diff(offsets)
+    validi = lunghezze >= 3
+    if not validi.any():
+        return aree, perimetri
+
+    # Considera solo i vertici dei poligoni validi
+    maschera = np.repeat(validi, lunghezze)
+    coords = coordinate[maschera]
+    lunghezze = lunghezze[validi]
+    inizi = np.zeros(len(lunghezze), dtype=np.int64)
+    np.cumsum(lunghezze[:-1], out=inizi[1:])
+    poligono = np.repeat(np.arange(len(lunghezze)), lunghezze)
+
+    # Proiezione locale in metri rispetto al primo vertice di ogni poligono
+    lat0 = coords[inizi, 0][poligono]
+    lon0 = coords[inizi, 1][poligono]
+    scala = math.radians(1) * RAGGIO_TERRA
+    y = (coords[:, 0] - lat0) * scala
+    x = (coords[:, 1] - lon0) * scala * np.cos(np.radians(lat0))
+
+    # Indice del vertice successivo, richiudendo ogni poligono sul suo primo vertice
+    successivo = np.arange(len(coords)) + 1
+    successivo[inizi + lunghezze - 1] = inizi
+    x_succ = x[successivo]
+    y_succ = y[successivo]
+
+    aree[validi] = np.abs(np.add.reduceat(x * y_succ - x_succ * y, inizi)) / 2
+    perimetri[validi] = np.add.reduceat(np.hypot(x_succ - x, y_succ - y), inizi)
+    return aree, perimetri
+
+
+def calculate_area(coords):
+    """Calcola l'area (m²) di un singolo poligono [[lat, lon], ...]."""
+    aree, _ = aree_poligoni(*impacchetta_poligoni([coords]))
+    return float(aree[0])
+
+
+def coordinate_edificio(element):
+    """Estrae le coordinate [lat, lon] della way chiudendo il poligono."""
+    coordinates = [[node['lat'], node['lon']] for node in element['geometry']]
+
+    # Assicurati che il poligono sia chiuso
+    if coordinates[0] != coordinates[-1]:
+        coordinates.append(coordinates[0])
+    return coordinates
+
+
+def messaggio_edificio(element):
+    """Compone il messaggio di esito usando nome e tipo dell'edificio in OSM."""
+    # Se l'edificio ha un nome in OSM, usalo
+    nome_edificio = element.get('tags', {}).get('name', 'Edificio')
+    tipo_edificio = element.get('tags', {}).get('building', '')
+
+    # Aggiungi il tipo di edificio al messaggio se disponibile
+    if tipo_edificio:
+        return f"Superficie calcolata con successo per: {nome_edificio} (Tipo: {tipo_edificio})"
+    return f"Superficie calcolata con successo per: {nome_edificio}"
+
+
+def risultato_edificio(element, con_area=True):
+    """Restituisce la tupla (area, coordinates, messaggio) per una way OSM.
+
+    Con `con_area=False` l'area resta None, per calcolarla poi in blocco con `aree_poligoni`.
+    """
+    if not element:
+        return None, None, MESSAGGIO_AREA_NON_CALCOLABILE
+    coordinates = coordinate_edificio(element)
+    area = calculate_area(coordinates) if con_area else None
+    return area, coordinates, messaggio_edificio(element)
@@ -0,0 +1,287 @@
+import json
+import math
+import os
+import re
+import sqlite3
+import sys
+import threading
+import xml.etree.ElementTree as ET
+from array import array
+
+from archivio_edifici import archivio_edifici_condiviso
+from edifici import seleziona_edificio, risultato_edificio, METRI_PER_GRADO, MESSAGGIO_NESSUN_EDIFICIO
+from metriche import cronometrato
+from overpass import RAGGIO_RICERCA, calcola_superfici_raggruppate, raggi_ricerca
+
+# Backend per la ricerca degli edifici: "overpass" (predefinito) o "locale"
+BACKEND_PREDEFINITO = 'overpass'
+
+# Nodi di un file OSM XML salvati insieme nella tabella temporanea, e letti insieme per ogni way
+NODI_PER_BLOCCO = 100000
+NODI_PER_QUERY = 500
+
+
+def backend_locale_attivo():
+    """Indica se è configurato il backend offline basato su un estratto OSM locale."""
+    return os.getenv('BACKEND_EDIFICI', BACKEND_PREDEFINITO).lower() == 'locale'
+
+
+def _crea_schema(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS edifici (
+            id INTEGER PRIMARY KEY,
+            tags TEXT NOT NULL,
+            geometria BLOB NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS indice_edifici
+        USING rtree(id, min_lat, max_lat, min_lon, max_lon)
+    """)
+
+
+def _inserisci(conn, way_id, tags, coords):
+    """Salva una way come coordinate lat/lon impacchettate e ne indicizza il bounding box."""
+    if len(coords) < 3:
+        return
+    lats = [c[0] for c in coords]
+    lons = [c[1] for c in coords]
+    geometria = array('d', [v for c in coords for v in c]).tobytes()
+    conn.execute("INSERT OR REPLACE INTO edifici (id, tags, geometria) VALUES (?, ?, ?)",
+                 (way_id, json.dumps(tags), geometria))
+    conn.execute("INSERT OR REPLACE INTO indice_edifici VALUES (?, ?, ?, ?, ?)",
+                 (way_id, min(lats), max(lats), min(lons), max(lons)))
+
+
+def _posizioni_nodi(conn, refs):
+    """Restituisce {id: (lat, lon)} dei nodi indicati, letti dalla tabella temporanea `nodi`."""
+    posizioni = {}
+    for inizio in range(0, len(refs), NODI_PER_QUERY):
+        blocco = refs[inizio:inizio + NODI_PER_QUERY]
+        segnaposto = ','.join('?' * len(blocco))
+        for id, lat, lon in conn.execute(f"SELECT id, lat, lon FROM nodi WHERE id IN ({segnaposto})", blocco):
+            posizioni[id] = (lat, lon)
+    return posizioni
+
+
+def _leggi_osm_xml(percorso, conn):
+    """Estrae le way con tag building da un file OSM XML.
+
+    Le coordinate dei nodi vengono appoggiate in una tabella temporanea di `conn`
+    e gli elementi già letti vengono staccati dalla radice, così che la memoria
+    non cresca con la dimensione dell'estratto.
+    """
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS nodi (id INTEGER PRIMARY KEY, lat REAL NOT NULL, lon REAL NOT NULL)")
+    nodi = []
+    elementi = ET.iterparse(percorso, events=('start', 'end'))
+    _, radice = next(elementi)
+    for evento, elem in elementi:
+        if evento != 'end' or elem.tag not in ('node', 'way', 'relation'):
+            continue
+        if elem.tag == 'node':
+            nodi.append((int(elem.get('id')), float(elem.get('lat')), float(elem.get('lon'))))
+            if len(nodi) >= NODI_PER_BLOCCO:
+                conn.executemany("INSERT OR REPLACE INTO nodi VALUES (?, ?, ?)", nodi)
+                nodi = []
+        elif elem.tag == 'way':
+            if nodi:
+                conn.executemany("INSERT OR REPLACE INTO nodi VALUES (?, ?, ?)", nodi)
+                nodi = []
+            tags = {tag.get('k'): tag.get('v') for tag in elem.iter('tag')}
+            if 'building' in tags:
+                refs = [int(nd.get('ref')) for nd in elem.iter('nd')]
+                posizioni = _posizioni_nodi(conn, refs)
+                coords = [posizioni[ref] for ref in refs if ref in posizioni]
+                yield int(elem.get('id')), tags, coords
+        # Gli elementi completati restano figli della radice finché non vengono rimossi
+        radice.clear()
+    conn.execute("DROP TABLE IF EXISTS temp.nodi")
+
+
+def _leggi_osm_pbf(percorso):
+    """Estrae le way con tag building da un file PBF (richiede il pacchetto `osmium`)."""
+    try:
+        import osmium
+    except ImportError:
+        raise ImportError("Per leggere file .pbf installa il pacchetto 'osmium' (pip install osmium)")
+
+    edifici = []
+
+    class Gestore(osmium.SimpleHandler):
+        def way(self, w):
+            if 'building' in w.tags:
+                coords = [(n.lat, n.lon) for n in w.nodes if n.location.valid()]
+                edifici.append((w.id, {t.k: t.v for t in w.tags}, coords))
+
+    Gestore().apply_file(percorso, locations=True)
+    return edifici
+
+
+def _id_feature(feature, progressivo):
+    """Ricava l'id OSM di una feature GeoJSON (es. "way/123"), altrimenti un id progressivo."""
+    props = feature.get('properties') or {}
+    for valore in (feature.get('id'), props.get('@id'), props.get('id'), props.get('osm_id')):
+        if valore is not None:
+            match = re.search(r'(\d+)$', str(valore))
+            if match:
+                return int(match.group(1))
+    return progressivo
+
+
+def _leggi_geojson(percorso):
+    """Estrae i poligoni degli edifici da un file GeoJSON (coordinate lon/lat)."""
+    with open(percorso, encoding='utf-8') as f:
+        dati = json.load(f)
+    for progressivo, feature in enumerate(dati.get('features', []), start=1):
+        geometria = feature.get('geometry') or {}
+        tags = {k: str(v) for k, v in (feature.get('properties') or {}).items() if v is not None}
+        tags.setdefault('building', 'yes')
+        if geometria.get('type') == 'Polygon':
+            anelli = [geometria['coordinates'][0]]
+        elif geometria.get('type') == 'MultiPolygon':
+            anelli = [poligono[0] for poligono in geometria['coordinates']]
+        else:
+            continue
+        # Per i MultiPolygon conserva l'anello esterno più esteso
+        anello = max(anelli, key=len)
+        yield _id_feature(feature, progressivo), tags, [(lat, lon) for lon, lat, *_ in anello]
+
+
+def importa_estratto(percorso_sorgente, percorso_indice):
+    """Importa gli edifici di un estratto OSM (XML, PBF o GeoJSON) in un indice SQLite con R-tree.
+
+    Restituisce il numero di edifici importati.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(percorso_indice)), exist_ok=True)
+    conn = sqlite3.connect(percorso_indice)
+    try:
+        nome = percorso_sorgente.lower()
+        if nome.endswith('.pbf'):
+            edifici = _leggi_osm_pbf(percorso_sorgente)
+        elif nome.endswith('.geojson') or nome.endswith('.json'):
+            edifici = _leggi_geojson(percorso_sorgente)
+        else:
+            edifici = _leggi_osm_xml(percorso_sorgente, conn)
+        _crea_schema(conn)
+        with conn:
+            for way_id, tags, coords in edifici:
+                _inserisci(conn, way_id, tags, coords)
+        return conn.execute("SELECT COUNT(*) FROM edifici").fetchone()[0]
+    finally:
+        conn.close()
+
+
+class EstrattoLocale:
+    """Backend offline: risponde alle ricerche di edifici usando l'indice SQLite locale."""
+
+    def __init__(self, percorso_indice):
+        if not os.path.exists(percorso_indice):
+            raise FileNotFoundError(f"Indice dell'estratto OSM non trovato: {percorso_indice}")
+        self.percorso_indice = percorso_indice
+        self._locale = threading.local()
+
+    def _connessione(self):
+        """Restituisce la connessione in sola lettura del thread corrente."""
+        conn = getattr(self._locale, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{self.percorso_indice}?mode=ro", uri=True)
+            self._locale.conn = conn
+        return conn
+
+    @cronometrato('estratto_locale')
+    def edifici_vicini(self, lat, lon, raggio=RAGGIO_RICERCA):
+        """Restituisce gli edifici entro il raggio (in gradi di latitudine) nel formato degli elementi Overpass."""
+        delta_lon = raggio / max(math.cos(math.radians(lat)), 0.01)
+        return self.edifici_riquadro(lat - raggio, lon - delta_lon, lat + raggio, lon + delta_lon)
+
+    def edifici_riquadro(self, sud, ovest, nord, est):
+        """Restituisce gli edifici il cui bounding box interseca il riquadro, nel formato degli elementi Overpass."""
+        righe = self._connessione().execute("""
+            SELECT e.id, e.tags, e.geometria
+            FROM indice_edifici i JOIN edifici e ON e.id = i.id
+            WHERE i.max_lat >= ? AND i.min_lat <= ? AND i.max_lon >= ? AND i.min_lon <= ?
+        """, (sud, nord, ovest, est)).fetchall()
+
+        elements = []
+        for way_id, tags, geometria in righe:
+            valori = array('d')
+            valori.frombytes(geometria)
+            elements.append({
+                'type': 'way',
+                'id': way_id,
+                'tags': json.loads(tags),
+                'geometry': [{'lat': valori[i], 'lon': valori[i + 1]} for i in range(0, len(valori), 2)]
+            })
+        return elements
+
+    def edificio_vicino(self, lat, lon, preciso=True):
+        """Cerca l'edificio con raggi crescenti, leggendo dall'indice solo gli edifici necessari."""
+        for raggio in raggi_ricerca(preciso):
+            elements = self.edifici_vicini(lat, lon, raggio)
+            edificio = seleziona_edificio(elements, lat, lon, raggio * METRI_PER_GRADO) if elements else None
+            if edificio:
+                return edificio
+        return None
+
+    def calcola_superficie_edificio(self, lat, lon, preciso=True, con_area=True):
+        """Stesso contratto (area, coordinates, messaggio) del backend Overpass, senza rete."""
+        edificio = self.edificio_vicino(lat, lon, preciso)
+        if not edificio:
+            return None, None, MESSAGGIO_NESSUN_EDIFICIO
+        _archivia([edificio])
+        return risultato_edificio(edificio, con_area)
+
+    def calcola_superfici(self, punti, callback=None, con_area=True):
+        """Calcola le superfici per molti punti {indice: (lat, lon)} o {indice: (lat, lon, preciso)}.
+
+        Come `calcola_superfici_raggruppate`, restituisce {indice: (area, coordinates, messaggio, edificio_id)}.
+        """
+        risultati = {}
+        trovati = []
+        for completati, (idx, punto) in enumerate(punti.items(), start=1):
+            edificio = self.edificio_vicino(punto[0], punto[1], punto[2] if len(punto) > 2 else True)
+            if edificio:
+                trovati.append(edificio)
+                risultati[idx] = risultato_edificio(edificio, con_area) + (edificio['id'],)
+            else:
+                risultati[idx] = (None, None, MESSAGGIO_NESSUN_EDIFICIO, None)
+            if callback:
+                callback(completati)
+        _archivia(trovati)
+        return risultati
+
+
+def _archivia(edifici):
+    # L'estratto è già locale: l'archivio serve solo a raccogliere gli edifici per le analisi
+    archivio = archivio_edifici_condiviso()
+    if archivio and edifici:
+        archivio.registra(edifici)
+
+
+_estratto_condiviso = None
+_estratto_lock = threading.Lock()
+
+
+def estratto_condiviso():
+    """Restituisce il backend locale del processo, configurato da ESTRATTO_OSM_INDICE."""
+    global _estratto_condiviso
+    with _estratto_lock:
+        if _estratto_condiviso is None:
+            _estratto_condiviso = EstrattoLocale(os.getenv('ESTRATTO_OSM_INDICE', 'edifici.sqlite'))
+        return _estratto_condiviso
+
+
+@cronometrato('edifici_lotto')
+def calcola_superfici_lotto(punti):
+    """Restituisce le geometrie degli edifici per un lotto di punti dal backend configurato."""
+    if backend_locale_attivo():
+        return estratto_condiviso().calcola_superfici(punti, con_area=False)
+    return calcola_superfici_raggruppate(punti, con_area=False)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Uso: python estratto_locale.py <estratto.osm|.pbf|.geojson> <indice.sqlite>")
+        sys.exit(1)
+    totale = importa_estratto(sys.argv[1], sys.argv[2])
+    print(f"✅ Importati {totale} edifici in {sys.argv[2]}")
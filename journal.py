@@ -0,0 +1,252 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from normalizzazione import normalizza_indirizzo
+from pipeline import esegui_pipeline, riga_risultato
+
+PERCORSO_PREDEFINITO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'lavori.sqlite')
+
+STATO_CALCOLATO = "✅ Calcolato"
+
+# Età oltre la quale un indirizzo calcolato in un altro lavoro non viene più riusato, così che
+# gli edifici cambiati in OpenStreetMap vengano ricalcolati
+TTL_RIUSO_PREDEFINITO = 30 * 24 * 3600  # 30 giorni
+
+# Tempo dall'ultima riga registrata oltre il quale un lavoro viene cancellato dal journal
+CONSERVAZIONE_PREDEFINITA = 30 * 24 * 3600  # 30 giorni
+
+# Righe registrate tra una pulizia dei lavori scaduti e l'altra, oltre a quella all'apertura
+RIGHE_PER_PULIZIA = 10000
+
+
+def id_lavoro(sorgente):
+    """Identifica un lavoro tramite l'hash SHA-256 del contenuto del file di input.
+
+    `sorgente` può essere un percorso o un file aperto; in quest'ultimo caso la
+    posizione di lettura viene riportata all'inizio.
+    """
+    hash_contenuto = hashlib.sha256()
+    if isinstance(sorgente, str):
+        with open(sorgente, 'rb') as f:
+            for blocco in iter(lambda: f.read(1 << 20), b''):
+                hash_contenuto.update(blocco)
+    else:
+        sorgente.seek(0)
+        for blocco in iter(lambda: sorgente.read(1 << 20), b''):
+            hash_contenuto.update(blocco)
+        sorgente.seek(0)
+    return hash_contenuto.hexdigest()
+
+
+def chiave_riga(indirizzo):
+    """Hash del contenuto di una riga: lo stesso indirizzo, anche scritto diversamente, ha la stessa chiave."""
+    return hashlib.sha256(normalizza_indirizzo(indirizzo).encode('utf-8')).hexdigest()
+
+
+class JournalLavori:
+    """Registro durevole (SQLite) delle righe completate di ogni lavoro.
+
+    Ogni riga completata viene salvata subito con geocoding, id dell'edificio,
+    geometria, area e stato, così che un lavoro interrotto possa riprendere
+    dalle sole righe mancanti. Per ogni indirizzo calcolato con successo viene
+    ricordata anche l'ultima riga che lo contiene (tramite `chiave_riga`), così
+    che un file modificato rielabori solo gli indirizzi nuovi o cambiati; gli
+    indirizzi calcolati da più di `ttl_riuso` secondi non vengono più riusati.
+    I lavori senza nuove righe da più di `conservazione` secondi vengono
+    cancellati all'apertura e periodicamente, così che il file non cresca a
+    ogni caricamento.
+    """
+
+    def __init__(self, percorso=PERCORSO_PREDEFINITO, ttl_riuso=TTL_RIUSO_PREDEFINITO,
+                 conservazione=CONSERVAZIONE_PREDEFINITA):
+        self.percorso = percorso
+        self.ttl_riuso = ttl_riuso
+        self.conservazione = conservazione
+        self._registrate = 0
+        self._lock = threading.Lock()
+        self._locale = threading.local()
+        if percorso == ':memory:':
+            raise ValueError("Il database deve essere un file: con ':memory:' ogni thread avrebbe il proprio, vuoto")
+        os.makedirs(os.path.dirname(percorso) or '.', exist_ok=True)
+        with self._connessione() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS righe (
+                    lavoro TEXT NOT NULL,
+                    idx INTEGER NOT NULL,
+                    indirizzo TEXT,
+                    indirizzo_completo TEXT,
+                    lat REAL,
+                    lon REAL,
+                    edificio_id INTEGER,
+                    coordinates TEXT,
+                    area REAL,
+                    perimetro REAL,
+                    messaggio TEXT,
+                    stato TEXT NOT NULL,
+                    PRIMARY KEY (lavoro, idx)
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS indirizzi (
+                    chiave TEXT PRIMARY KEY,
+                    lavoro TEXT NOT NULL,
+                    idx INTEGER NOT NULL,
+                    registrato REAL NOT NULL DEFAULT 0
+                )
+            """)
+            # Nei journal meno recenti gli indirizzi non hanno data: restano, ma non vengono più riusati
+            colonne = [colonna[1] for colonna in conn.execute("PRAGMA table_info(indirizzi)")]
+            if 'registrato' not in colonne:
+                conn.execute("ALTER TABLE indirizzi ADD COLUMN registrato REAL NOT NULL DEFAULT 0")
+            conn.execute("CREATE INDEX IF NOT EXISTS indirizzi_lavoro ON indirizzi (lavoro)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS lavori (
+                    lavoro TEXT PRIMARY KEY,
+                    aggiornato REAL NOT NULL
+                )
+            """)
+            # I lavori registrati prima di questa tabella vengono conservati a partire da adesso
+            conn.execute("INSERT OR IGNORE INTO lavori SELECT DISTINCT lavoro, ? FROM righe", (time.time(),))
+        self.pulisci()
+
+    def _connessione(self):
+        """Restituisce la connessione SQLite del thread corrente."""
+        conn = getattr(self._locale, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.percorso, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._locale.conn = conn
+        return conn
+
+    def registra(self, lavoro, riga, stato):
+        """Salva in modo durevole una riga completata della pipeline."""
+        coordinates = riga.get('coordinates')
+        with self._lock:
+            self._registrate += 1
+            pulizia = self._registrate % RIGHE_PER_PULIZIA == 0
+        with self._connessione() as conn:
+            conn.execute("INSERT OR REPLACE INTO lavori VALUES (?, ?)", (lavoro, time.time()))
+            conn.execute(
+                "INSERT OR REPLACE INTO righe VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (lavoro, riga['idx'], riga.get('indirizzo'), riga.get('indirizzo_completo'),
+                 riga.get('lat'), riga.get('lon'), riga.get('edificio_id'),
+                 json.dumps(coordinates) if coordinates else None,
+                 riga.get('area'), riga.get('perimetro'), riga.get('messaggio'), stato)
+            )
+            if stato == STATO_CALCOLATO and riga.get('indirizzo'):
+                conn.execute("INSERT OR REPLACE INTO indirizzi VALUES (?, ?, ?, ?)",
+                             (chiave_riga(riga['indirizzo']), lavoro, riga['idx'], time.time()))
+        if pulizia:
+            self.pulisci()
+
+    def stati(self, lavoro):
+        """Restituisce {idx: stato} per le righe già completate del lavoro."""
+        return dict(self._connessione().execute(
+            "SELECT idx, stato FROM righe WHERE lavoro = ?", (lavoro,)
+        ).fetchall())
+
+    def leggi(self, lavoro, idx):
+        """Ricostruisce una riga completata nel formato prodotto dalla pipeline."""
+        cursore = self._connessione().execute(
+            "SELECT idx, indirizzo, indirizzo_completo, lat, lon, edificio_id, coordinates, "
+            "area, perimetro, messaggio FROM righe WHERE lavoro = ? AND idx = ?", (lavoro, idx)
+        )
+        valori = cursore.fetchone()
+        if valori is None:
+            return None
+        riga = dict(zip([colonna[0] for colonna in cursore.description], valori))
+        riga['coordinates'] = json.loads(riga['coordinates']) if riga['coordinates'] else None
+        return riga
+
+    def precedente(self, indirizzo):
+        """Restituisce l'ultima riga calcolata con successo per lo stesso indirizzo, in qualsiasi lavoro, o None.
+
+        Le righe calcolate da più di `ttl_riuso` secondi non vengono restituite.
+        """
+        riferimento = self._connessione().execute(
+            "SELECT lavoro, idx FROM indirizzi WHERE chiave = ? AND registrato >= ?",
+            (chiave_riga(indirizzo), time.time() - self.ttl_riuso)
+        ).fetchone()
+        return self.leggi(*riferimento) if riferimento else None
+
+    def elimina(self, lavoro):
+        """Cancella tutte le righe registrate per il lavoro e i riferimenti per riusarle."""
+        with self._connessione() as conn:
+            conn.execute("DELETE FROM righe WHERE lavoro = ?", (lavoro,))
+            conn.execute("DELETE FROM indirizzi WHERE lavoro = ?", (lavoro,))
+            conn.execute("DELETE FROM lavori WHERE lavoro = ?", (lavoro,))
+
+    def pulisci(self):
+        """Cancella i lavori senza nuove righe da più di `conservazione` secondi; restituisce quanti."""
+        scaduti = "SELECT lavoro FROM lavori WHERE aggiornato < ?"
+        limite = (time.time() - self.conservazione,)
+        with self._connessione() as conn:
+            conn.execute(f"DELETE FROM righe WHERE lavoro IN ({scaduti})", limite)
+            conn.execute(f"DELETE FROM indirizzi WHERE lavoro IN ({scaduti})", limite)
+            return conn.execute("DELETE FROM lavori WHERE aggiornato < ?", limite).rowcount
+
+
+def esegui_con_journal(journal, lavoro, indirizzi, geocodifica, calcola_superfici, al_completamento,
+                       ripeti_fallite=False, **opzioni_pipeline):
+    """Esegue la pipeline saltando le righe già registrate nel journal per il lavoro.
+
+    Le righe già completate vengono rilette dal journal e passate ad
+    `al_completamento` senza rielaborarle; quelle non riuscite vengono rielaborate
+    solo con `ripeti_fallite=True`. Anche gli indirizzi già calcolati con successo
+    in altri lavori (ad esempio una versione precedente dello stesso file) vengono
+    riusati: si elaborano solo le righe nuove o modificate. Le righe non rielaborate
+    hanno `ripresa=True`. Restituisce le statistiche della pipeline con in più il
+    numero di righe `riprese` dal lavoro stesso e `riusate` da altri lavori.
+    """
+    stati = journal.stati(lavoro)
+    riprese = riusate = 0
+
+    def da_elaborare():
+        nonlocal riprese, riusate
+        for idx, indirizzo in indirizzi:
+            stato = stati.get(idx)
+            if stato is not None and (stato == STATO_CALCOLATO or not ripeti_fallite):
+                riga = journal.leggi(lavoro, idx)
+                if riga is not None and riga['indirizzo'] == indirizzo:
+                    riprese += 1
+                    riga['ripresa'] = True
+                    al_completamento(riga)
+                    continue
+            riga = journal.precedente(indirizzo)
+            if riga is not None:
+                riusate += 1
+                riga.update(idx=idx, indirizzo=indirizzo, ripresa=True)
+                al_completamento(riga)
+                continue
+            yield idx, indirizzo
+
+    def registra(riga):
+        journal.registra(lavoro, riga, riga_risultato(riga)['Stato'])
+        al_completamento(riga)
+
+    statistiche = esegui_pipeline(da_elaborare(), geocodifica, calcola_superfici, registra, **opzioni_pipeline)
+    statistiche['riprese'] = riprese
+    statistiche['riusate'] = riusate
+    return statistiche
+
+
+_journal_condiviso = None
+_journal_lock = threading.Lock()
+
+
+def journal_condiviso():
+    """Restituisce il journal del processo, configurato dalle variabili d'ambiente JOURNAL_*."""
+    global _journal_condiviso
+    with _journal_lock:
+        if _journal_condiviso is None:
+            _journal_condiviso = JournalLavori(
+                os.getenv('JOURNAL_PATH', PERCORSO_PREDEFINITO),
+                ttl_riuso=float(os.getenv('JOURNAL_TTL_RIUSO', TTL_RIUSO_PREDEFINITO)),
+                conservazione=float(os.getenv('JOURNAL_CONSERVAZIONE', CONSERVAZIONE_PREDEFINITA))
+            )
+        return _journal_condiviso
@@ -0,0 +1,282 @@
+import os
+import queue
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import pandas as pd
+
+from archivio_mappe import ArchivioMappe
+from censimento import Confine, censisci, confine_amministrativo
+from journal import esegui_con_journal
+from pipeline import riga_risultato
+from streaming import processa_file_streaming
+
+# Elaborazioni di file eseguite contemporaneamente nel processo, per tutti gli utenti
+LAVORI_CONTEMPORANEI = int(os.getenv('LAVORI_CONTEMPORANEI', 2))
+
+# Processi usati da ogni censimento di un'area avviato dall'app
+PROCESSI_CENSIMENTO = int(os.getenv('PROCESSI_CENSIMENTO', 2))
+
+# Lavori terminati conservati in memoria, per chi si ricollega o ricarica lo stesso file
+MAX_LAVORI_CONSERVATI = int(os.getenv('LAVORI_CONSERVATI', 20))
+
+STATO_IN_CODA = 'in coda'
+STATO_IN_CORSO = 'in corso'
+STATO_COMPLETATO = 'completato'
+STATO_ERRORE = 'errore'
+
+# Unità in cui è misurato l'avanzamento: (nome, participio per la descrizione)
+UNITA_RIGHE = ('righe', 'elaborate')
+UNITA_TILE = ('tile', 'censiti')
+
+
+class Lavoro:
+    """Elaborazione eseguita in background, con avanzamento e righe completate.
+
+    Lo stato viene aggiornato dal thread che esegue il lavoro e letto dalle
+    sessioni dell'interfaccia, che possono ricollegarsi in qualsiasi momento.
+    """
+
+    def __init__(self, id, nome, totale=None, tipo=None, unita=UNITA_RIGHE):
+        self.id = id
+        self.nome = nome
+        self.totale = totale
+        self.tipo = tipo
+        self.unita = unita
+        self.stato = STATO_IN_CODA
+        self.completate = 0
+        self.risultato = None
+        self.errore = None
+        self.creato = time.time()
+        self.iniziato = None
+        self.terminato = None
+        self.percorso_risultati = None
+        self.file_temporanei = []
+        self._risultati = {}
+        self._mappe = ArchivioMappe()
+        self._lock = threading.Lock()
+        self._fine = threading.Event()
+
+    def avanza(self, completate):
+        """Aggiorna il numero di righe completate (per i lavori che non registrano le righe)."""
+        self.completate = completate
+
+    def registra_riga(self, riga):
+        """Registra una riga completata dalla pipeline, subito visibile in `tabella`."""
+        risultato = riga_risultato(riga)
+        # Distingue le righe elaborate in questo lavoro da quelle riprese o riusate dal journal
+        risultato['Ricalcolata'] = not riga.get('ripresa')
+        with self._lock:
+            if riga['idx'] in self._risultati:
+                self._risultati[riga['idx']] = risultato
+                return
+            self.completate += 1
+            self._risultati[riga['idx']] = risultato
+            if riga.get('coordinates'):
+                self._mappe.aggiungi(riga['idx'], riga['lat'], riga['lon'], riga['coordinates'], riga['area'],
+                                     riga['indirizzo_completo'], riga['indirizzo'], riga.get('edificio_id'))
+
+    def file_temporaneo(self, suffisso):
+        """Crea un file temporaneo del lavoro, eliminato con `elimina_file_temporanei`."""
+        fd, percorso = tempfile.mkstemp(suffix=suffisso)
+        os.close(fd)
+        self.file_temporanei.append(percorso)
+        return percorso
+
+    def elimina_file_temporanei(self):
+        """Elimina i file temporanei del lavoro, compresi i risultati scritti su disco."""
+        for percorso in self.file_temporanei:
+            if percorso == self.percorso_risultati:
+                self.percorso_risultati = None
+            try:
+                os.remove(percorso)
+            except FileNotFoundError:
+                pass
+        self.file_temporanei = []
+
+    @property
+    def finito(self):
+        return self.stato in (STATO_COMPLETATO, STATO_ERRORE)
+
+    def attendi(self, timeout=None):
+        """Attende la fine del lavoro; restituisce False se il tempo scade prima."""
+        return self._fine.wait(timeout)
+
+    def tabella(self, limite=None):
+        """Restituisce (risultati_df, mappe) con le righe completate finora, nell'ordine del file.
+
+        Con `limite` la tabella contiene solo le prime `limite` righe completate.
+        """
+        with self._lock:
+            indici = sorted(self._risultati)
+            risultati = [self._risultati[idx] for idx in indici[:limite]]
+        return pd.DataFrame(risultati), self.mappe()
+
+    def mappe(self):
+        """Restituisce le mappe degli edifici trovati finora, nell'ordine del file (vedi `ArchivioMappe`)."""
+        return self._mappe.vista()
+
+    def csv_risultati(self):
+        """Restituisce il CSV delle righe completate finora, anche a lavoro in corso."""
+        if self.percorso_risultati:
+            with open(self.percorso_risultati, 'rb') as f:
+                contenuto = f.read()
+            # Durante la scrittura l'ultima riga del file può essere incompleta
+            return contenuto if self.finito else contenuto[:contenuto.rfind(b'\n') + 1]
+        return self.tabella()[0].to_csv(index=False)
+
+    def descrizione(self):
+        """Descrive in una riga stato e avanzamento del lavoro."""
+        if self.stato == STATO_ERRORE:
+            return f"❌ Elaborazione di {self.nome} non riuscita: {self.errore}"
+        avanzamento = f"{self.completate}/{self.totale}" if self.totale else f"{self.completate}"
+        unita, participio = self.unita
+        durata = (self.terminato or time.time()) - (self.iniziato or time.time())
+        if self.stato == STATO_COMPLETATO:
+            return f"✅ {self.nome}: {avanzamento} {unita} {participio} in {durata:.0f} s"
+        if self.stato == STATO_IN_CORSO:
+            velocita = f", {self.completate / durata:.1f} {unita}/s" if durata > 0 else ""
+            return f"⌛ {self.nome}: {avanzamento} {unita} {participio}{velocita}"
+        return f"🕒 {self.nome}: in attesa che si liberi un posto"
+
+
+class CodaLavori:
+    """Coda dei lavori in background del processo, condivisa da tutte le sessioni.
+
+    Al più `lavoratori` lavori sono eseguiti contemporaneamente, qualunque sia
+    il numero di utenti; gli altri attendono in coda nell'ordine di invio. Un
+    lavoro continua anche se la sessione che l'ha inviato si disconnette e resta
+    consultabile tramite il suo id finché non viene rimosso per fare posto ai più
+    recenti (ne vengono conservati al più `max_conservati` terminati): i file
+    temporanei di un lavoro vengono eliminati quando è rimosso o non riesce.
+    """
+
+    def __init__(self, lavoratori=LAVORI_CONTEMPORANEI, max_conservati=MAX_LAVORI_CONSERVATI):
+        self.lavoratori = lavoratori
+        self.max_conservati = max_conservati
+        self._lavori = OrderedDict()
+        self._coda = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = []
+
+    def invia(self, id, nome, totale, funzione, *args, tipo=None, unita=UNITA_RIGHE):
+        """Accoda `funzione(lavoro, *args)` e restituisce il `Lavoro` creato.
+
+        Se un lavoro con lo stesso id è già in coda o in corso, viene restituito
+        quello invece di eseguirne un altro; un lavoro terminato con lo stesso id
+        viene invece sostituito, perché inviarlo di nuovo chiede un nuovo calcolo. `tipo` è un'etichetta
+        libera con cui chi invia il lavoro ne riconosce il risultato; `unita` è
+        l'unità dell'avanzamento mostrata nella descrizione.
+        """
+        with self._lock:
+            lavoro = self._lavori.pop(id, None)
+            if lavoro is not None and not lavoro.finito:
+                self._lavori[id] = lavoro
+                return lavoro
+            if lavoro is not None:
+                lavoro.elimina_file_temporanei()
+            lavoro = self._lavori[id] = Lavoro(id, nome, totale, tipo, unita)
+            self._coda.put((lavoro, funzione, args))
+            if len(self._thread) < self.lavoratori:
+                thread = threading.Thread(target=self._lavora, daemon=True, name=f"lavori-{len(self._thread)}")
+                self._thread.append(thread)
+                thread.start()
+            self._rimuovi_vecchi()
+            return lavoro
+
+    def lavoro(self, id):
+        """Restituisce il lavoro con l'id indicato, o None se non esiste (più)."""
+        with self._lock:
+            return self._lavori.get(id)
+
+    def lavori(self):
+        """Restituisce i lavori conosciuti, dal meno recente."""
+        with self._lock:
+            return list(self._lavori.values())
+
+    def posizione(self, id):
+        """Restituisce quanti lavori in coda precedono quello indicato."""
+        with self._lock:
+            in_coda = [l.id for l in self._lavori.values() if l.stato == STATO_IN_CODA]
+        return in_coda.index(id) if id in in_coda else 0
+
+    def _rimuovi_vecchi(self):
+        terminati = [id for id, lavoro in self._lavori.items() if lavoro.finito]
+        for id in terminati[:max(0, len(terminati) - self.max_conservati)]:
+            self._lavori.pop(id).elimina_file_temporanei()
+
+    def _lavora(self):
+        while True:
+            lavoro, funzione, args = self._coda.get()
+            lavoro.stato = STATO_IN_CORSO
+            lavoro.iniziato = time.time()
+            try:
+                lavoro.risultato = funzione(lavoro, *args)
+                lavoro.stato = STATO_COMPLETATO
+            except Exception as e:
+                lavoro.errore = str(e)
+                lavoro.stato = STATO_ERRORE
+                lavoro.elimina_file_temporanei()
+            lavoro.terminato = time.time()
+            lavoro._fine.set()
+            with self._lock:
+                self._rimuovi_vecchi()
+
+
+def elabora_indirizzi(lavoro, journal, chiave, indirizzi, geocodifica, calcola_superfici, ripeti_fallite=False):
+    """Corpo di un lavoro: elabora le coppie (indice, indirizzo) registrando le righe nel lavoro.
+
+    Le righe già completate nel journal con la stessa `chiave` vengono riprese
+    come in `esegui_con_journal`.
+    """
+    return esegui_con_journal(journal, chiave, indirizzi, geocodifica, calcola_superfici,
+                              lavoro.registra_riga, ripeti_fallite)
+
+
+def elabora_file_su_disco(lavoro, journal, sorgente, geocodifica, calcola_superfici, ripeti_fallite=False,
+                          destinazione=None):
+    """Corpo di un lavoro: elabora un file in streaming scrivendo i risultati su `destinazione`.
+
+    Senza `destinazione` i risultati vengono scritti su un CSV temporaneo del lavoro.
+    Restituisce (destinazione, righe elaborate).
+    """
+    if destinazione is None:
+        destinazione = lavoro.file_temporaneo('.csv')
+    # Il CSV viene scritto in ordine e svuotato periodicamente: può essere scaricato a metà
+    lavoro.percorso_risultati = destinazione
+    righe = processa_file_streaming(sorgente, destinazione, geocodifica, calcola_superfici,
+                                    callback=lavoro.avanza, journal=journal, ripeti_fallite=ripeti_fallite)
+    return destinazione, righe
+
+
+def elabora_censimento(lavoro, area, formato='.geojsonl', processi=PROCESSI_CENSIMENTO):
+    """Corpo di un lavoro: censisce gli edifici di un'area, con l'avanzamento in tile.
+
+    `area` è un riquadro (sud, ovest, nord, est) o il nome di un comune, il cui
+    confine viene scaricato da Overpass. I risultati vengono scritti su un file
+    temporaneo del lavoro nel `formato` indicato dall'estensione (vedi `censimento.censisci`).
+    Restituisce (destinazione, riepilogo).
+    """
+    confine = confine_amministrativo(area) if isinstance(area, str) else Confine.da_riquadro(*area)
+    destinazione = lavoro.file_temporaneo(formato)
+
+    def aggiorna(completati, totale, edifici):
+        lavoro.totale = totale
+        lavoro.avanza(completati)
+
+    return destinazione, censisci(confine, destinazione, processi, callback=aggiorna)
+
+
+_coda_condivisa = None
+_coda_lock = threading.Lock()
+
+
+def coda_lavori_condivisa():
+    """Restituisce la coda dei lavori del processo, configurata da LAVORI_CONTEMPORANEI."""
+    global _coda_condivisa
+    with _coda_lock:
+        if _coda_condivisa is None:
+            _coda_condivisa = CodaLavori()
+        return _coda_condivisa
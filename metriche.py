@@ -0,0 +1,246 @@
+import functools
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Limiti superiori (in secondi) dei bucket degli istogrammi di durata
+BUCKET_DURATA = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Prefisso comune dei nomi delle metriche esportate
+PREFISSO = 'coesa'
+
+
+class Istogramma:
+    """Istogramma cumulativo a bucket fissi, nel formato usato da Prometheus."""
+
+    def __init__(self, bucket=BUCKET_DURATA):
+        self.bucket = bucket
+        self.conteggi = [0] * (len(bucket) + 1)  # l'ultimo è il bucket +Inf
+        self.conteggio = 0
+        self.somma = 0.0
+
+    def osserva(self, valore):
+        for i, limite in enumerate(self.bucket):
+            if valore <= limite:
+                break
+        else:
+            i = len(self.bucket)
+        self.conteggi[i] += 1
+        self.conteggio += 1
+        self.somma += valore
+
+    def unisci(self, altro):
+        self.conteggi = [a + b for a, b in zip(self.conteggi, altro.conteggi)]
+        self.conteggio += altro.conteggio
+        self.somma += altro.somma
+
+    def quantile(self, q):
+        """Stima il quantile q interpolando linearmente all'interno del bucket."""
+        if not self.conteggio:
+            return None
+        obiettivo = q * self.conteggio
+        cumulato = 0
+        for i, conteggio in enumerate(self.conteggi):
+            if cumulato + conteggio >= obiettivo and conteggio:
+                inferiore = self.bucket[i - 1] if i > 0 else 0.0
+                superiore = self.bucket[i] if i < len(self.bucket) else self.bucket[-1]
+                return inferiore + (superiore - inferiore) * (obiettivo - cumulato) / conteggio
+            cumulato += conteggio
+        return self.bucket[-1]
+
+
+def _chiave(nome, etichette):
+    return nome, tuple(sorted(etichette.items()))
+
+
+def _formatta_etichette(etichette, extra=()):
+    coppie = list(etichette) + list(extra)
+    if not coppie:
+        return ''
+    return '{' + ','.join(f'{k}="{str(v)}"' for k, v in coppie) + '}'
+
+
+class Metriche:
+    """Registro leggero di contatori e istogrammi di durata, esportabile per Prometheus.
+
+    Le durate sono registrate per fase (geocoding, richiesta Overpass, selezione
+    dell'edificio, calcolo dell'area, mappa...) con `misura` o `cronometrato`;
+    i contatori (hit delle cache, errori dei servizi esterni...) con `incrementa`.
+    Tutti i metodi sono sicuri rispetto ai thread.
+    """
+
+    def __init__(self):
+        self._contatori = {}
+        self._istogrammi = {}
+        self._lock = threading.Lock()
+
+    def incrementa(self, nome, valore=1, **etichette):
+        """Incrementa il contatore `nome` con le etichette indicate."""
+        chiave = _chiave(nome, etichette)
+        with self._lock:
+            self._contatori[chiave] = self._contatori.get(chiave, 0) + valore
+
+    def osserva(self, fase, secondi):
+        """Registra una durata per la fase indicata."""
+        chiave = _chiave('durata_secondi', {'fase': fase})
+        with self._lock:
+            istogramma = self._istogrammi.get(chiave)
+            if istogramma is None:
+                istogramma = self._istogrammi[chiave] = Istogramma()
+            istogramma.osserva(secondi)
+
+    @contextmanager
+    def misura(self, fase):
+        """Misura la durata del blocco; le eccezioni sono contate come errori della fase."""
+        inizio = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.incrementa('errori_totali', fase=fase)
+            raise
+        finally:
+            self.osserva(fase, time.perf_counter() - inizio)
+
+    def cronometrato(self, fase):
+        """Decoratore che misura ogni chiamata della funzione come fase `fase`."""
+        def decoratore(funzione):
+            @functools.wraps(funzione)
+            def avvolta(*args, **kwargs):
+                with self.misura(fase):
+                    return funzione(*args, **kwargs)
+            return avvolta
+        return decoratore
+
+    def istantanea(self):
+        """Restituisce una copia dei dati raccolti, da trasferire ad esempio tra processi."""
+        with self._lock:
+            istogrammi = {}
+            for chiave, istogramma in self._istogrammi.items():
+                copia = Istogramma(istogramma.bucket)
+                copia.unisci(istogramma)
+                istogrammi[chiave] = copia
+            return {'contatori': dict(self._contatori), 'istogrammi': istogrammi}
+
+    def unisci(self, istantanea):
+        """Somma al registro i dati di un'istantanea (ad esempio di un altro processo)."""
+        with self._lock:
+            for chiave, valore in istantanea['contatori'].items():
+                self._contatori[chiave] = self._contatori.get(chiave, 0) + valore
+            for chiave, istogramma in istantanea['istogrammi'].items():
+                if chiave not in self._istogrammi:
+                    self._istogrammi[chiave] = Istogramma(istogramma.bucket)
+                self._istogrammi[chiave].unisci(istogramma)
+
+    def riepilogo(self):
+        """Restituisce una riga per fase con conteggio, errori, media, p50 e p99 in millisecondi."""
+        with self._lock:
+            righe = []
+            for (_, etichette), istogramma in sorted(self._istogrammi.items()):
+                fase = dict(etichette)['fase']
+                errori = self._contatori.get(_chiave('errori_totali', {'fase': fase}), 0)
+                righe.append({
+                    'Fase': fase,
+                    'Chiamate': istogramma.conteggio,
+                    'Errori': errori,
+                    'Media_ms': istogramma.somma / istogramma.conteggio * 1000 if istogramma.conteggio else None,
+                    'p50_ms': (istogramma.quantile(0.5) or 0) * 1000,
+                    'p99_ms': (istogramma.quantile(0.99) or 0) * 1000
+                })
+            return righe
+
+    def contatori(self):
+        """Restituisce i contatori come lista di (nome, etichette, valore)."""
+        with self._lock:
+            return [(nome, dict(etichette), valore) for (nome, etichette), valore in sorted(self._contatori.items())]
+
+    def testo_prometheus(self):
+        """Esporta le metriche nel formato testuale di Prometheus."""
+        righe = []
+        with self._lock:
+            nomi = sorted({nome for nome, _ in self._contatori})
+            for nome in nomi:
+                righe.append(f"# TYPE {PREFISSO}_{nome} counter")
+                for (n, etichette), valore in sorted(self._contatori.items()):
+                    if n == nome:
+                        righe.append(f"{PREFISSO}_{nome}{_formatta_etichette(etichette)} {valore}")
+            if self._istogrammi:
+                nome = f"{PREFISSO}_durata_secondi"
+                righe.append(f"# TYPE {nome} histogram")
+                for (_, etichette), istogramma in sorted(self._istogrammi.items()):
+                    cumulato = 0
+                    for limite, conteggio in zip(istogramma.bucket + ('+Inf',), istogramma.conteggi):
+                        cumulato += conteggio
+                        righe.append(f"{nome}_bucket{_formatta_etichette(etichette, [('le', limite)])} {cumulato}")
+                    righe.append(f"{nome}_sum{_formatta_etichette(etichette)} {istogramma.somma}")
+                    righe.append(f"{nome}_count{_formatta_etichette(etichette)} {istogramma.conteggio}")
+        return '\n'.join(righe) + '\n'
+
+    def scrivi_file(self, percorso):
+        """Scrive le metriche su file in modo atomico (ad esempio per il textfile collector)."""
+        os.makedirs(os.path.dirname(os.path.abspath(percorso)), exist_ok=True)
+        temporaneo = f"{percorso}.tmp"
+        with open(temporaneo, 'w', encoding='utf-8') as f:
+            f.write(self.testo_prometheus())
+        os.replace(temporaneo, percorso)
+
+    def avvia_server(self, porta, host='0.0.0.0'):
+        """Espone le metriche su http://host:porta/metrics in un thread in background."""
+        registro = self
+
+        class Gestore(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                corpo = registro.testo_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(corpo)))
+                self.end_headers()
+                self.wfile.write(corpo)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, porta), Gestore)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+_metriche_condivise = Metriche()
+_server_lock = threading.Lock()
+_server = None
+
+
+def metriche_condivise():
+    """Restituisce il registro delle metriche del processo."""
+    return _metriche_condivise
+
+
+def misura(fase):
+    """Come `Metriche.misura`, sul registro del processo."""
+    return _metriche_condivise.misura(fase)
+
+
+def cronometrato(fase):
+    """Come `Metriche.cronometrato`, sul registro del processo."""
+    return _metriche_condivise.cronometrato(fase)
+
+
+def incrementa(nome, valore=1, **etichette):
+    """Come `Metriche.incrementa`, sul registro del processo."""
+    _metriche_condivise.incrementa(nome, valore, **etichette)
+
+
+def avvia_server_condiviso():
+    """Avvia, una sola volta per processo, l'endpoint indicato dalla variabile METRICHE_PORTA."""
+    global _server
+    porta = os.getenv('METRICHE_PORTA')
+    if not porta:
+        return None
+    with _server_lock:
+        if _server is None:
+            _server = _metriche_condivise.avvia_server(int(porta))
+        return _server
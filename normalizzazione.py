@@ -0,0 +1,147 @@
+import re
+import unicodedata
+
+# Abbreviazioni dei tipi di strada più comuni negli indirizzi italiani
+ABBREVIAZIONI_STRADA = {
+    'v': 'via',
+    'v.le': 'viale',
+    'vle': 'viale',
+    'p.za': 'piazza',
+    'p.zza': 'piazza',
+    'pza': 'piazza',
+    'pzza': 'piazza',
+    'p.le': 'piazzale',
+    'ple': 'piazzale',
+    'p.tta': 'piazzetta',
+    'c.so': 'corso',
+    'cso': 'corso',
+    'l.go': 'largo',
+    'lgo': 'largo',
+    'vic': 'vicolo',
+    'v.lo': 'vicolo',
+    'str': 'strada',
+    'sda': 'strada',
+    'lungot': 'lungotevere',
+    'b.go': 'borgo',
+    'loc': 'localita',
+    'fraz': 'frazione',
+    'contr': 'contrada',
+    'c.da': 'contrada',
+    'sal': 'salita',
+}
+
+# Abbreviazioni che precedono un nome proprio (es. "Via S. Marco" → "via san marco")
+ABBREVIAZIONI_NOMI = {
+    's': 'san',
+}
+
+# Tipi di strada per esteso, dopo i quali "Italia" fa parte del nome della via (es. "Corso Italia")
+TIPI_STRADA = set(ABBREVIAZIONI_STRADA.values())
+
+# Preposizioni che possono precedere "Italia" nel nome della via (es. "Piazza Unità d'Italia")
+PREPOSIZIONI = {'d', 'di', 'del', 'dell', 'della'}
+
+# Sigle delle province italiane
+SIGLE_PROVINCE = {
+    'ag', 'al', 'an', 'ao', 'ap', 'aq', 'ar', 'at', 'av', 'ba', 'bg', 'bi', 'bl', 'bn', 'bo',
+    'br', 'bs', 'bt', 'bz', 'ca', 'cb', 'ce', 'ch', 'cl', 'cn', 'co', 'cr', 'cs', 'ct', 'cz',
+    'en', 'fc', 'fe', 'fg', 'fi', 'fm', 'fr', 'ge', 'go', 'gr', 'im', 'is', 'kr', 'lc', 'le',
+    'li', 'lo', 'lt', 'lu', 'mb', 'mc', 'me', 'mi', 'mn', 'mo', 'ms', 'mt', 'na', 'no', 'nu',
+    'or', 'pa', 'pc', 'pd', 'pe', 'pg', 'pi', 'pn', 'po', 'pr', 'pt', 'pu', 'pv', 'pz', 'ra',
+    'rc', 're', 'rg', 'ri', 'rm', 'rn', 'ro', 'sa', 'si', 'so', 'sp', 'sr', 'ss', 'su', 'sv',
+    'ta', 'te', 'tn', 'to', 'tp', 'tr', 'ts', 'tv', 'ud', 'va', 'vb', 'vc', 've', 'vi', 'vr',
+    'vt', 'vv',
+}
+
+# Parole che precedono il numero civico e che vanno ignorate
+PREFISSI_CIVICO = r'(?:n\.?|nr\.?|num\.?|numero|civico|civ\.?|n°|nº)'
+
+_CAP = re.compile(r'\b(\d{5})\b')
+_PROVINCIA = re.compile(r'\(\s*([a-z]{2})\s*\)')
+_CIVICO = re.compile(r'\b' + PREFISSI_CIVICO + r'\s*(?=\d)')
+# Esponente del civico: dopo una barra, o staccato ma seguito da una separazione (non in "2 S Giovanni")
+_CIVICO_ESPONENTE = re.compile(r'\b(\d+)\s*(?:/\s*([a-z])\b|\s+([a-z])(?=\s*(?:[,;-]|$)))')
+_NUMERO_CIVICO = re.compile(r'\d+[a-z]?')
+
+
+def _rimuovi_accenti(testo):
+    return ''.join(c for c in unicodedata.normalize('NFKD', testo) if not unicodedata.combining(c))
+
+
+def _parole(testo):
+    """Divide il testo in parole senza punteggiatura, espandendo le abbreviazioni scritte con il punto."""
+    parole = []
+    for grezza in re.split(r'[\s,;]+', testo):
+        abbreviazione = grezza.rstrip('.')
+        if '.' in grezza and abbreviazione in ABBREVIAZIONI_STRADA:
+            parole.append(ABBREVIAZIONI_STRADA[abbreviazione])
+        elif '.' in grezza and abbreviazione in ABBREVIAZIONI_NOMI:
+            parole.append(ABBREVIAZIONI_NOMI[abbreviazione])
+        else:
+            parole.extend(re.sub(r'[^\w\s]', ' ', grezza).split())
+    return parole
+
+
+def normalizza_indirizzo(indirizzo):
+    """Restituisce la forma canonica di un indirizzo italiano, da usare come chiave.
+
+    Uniforma maiuscole, accenti, spazi e punteggiatura, espande le abbreviazioni
+    dei tipi di strada (es. "P.zza" → "piazza") e di "S." ("san"), ripulisce il
+    numero civico ("n. 12/A" → "12a") e sposta in fondo CAP e sigla della
+    provincia, ignorando l'indicazione del paese. La chiave è costruita dalle
+    sole parole, quindi non dipende da dove cadono le virgole: la via termina
+    all'ultimo numero civico e quel che segue è la località.
+    """
+    testo = _rimuovi_accenti(str(indirizzo)).lower().strip()
+    # "S.Marco" come "S. Marco"
+    testo = re.sub(r'\b(' + '|'.join(map(re.escape, ABBREVIAZIONI_NOMI)) + r')\.(?=[a-z])', r'\1. ', testo)
+
+    # CAP e provincia tra parentesi vengono estratti e accodati in forma fissa; al loro
+    # posto resta una virgola, che separa l'eventuale esponente del civico dalla località
+    cap = _CAP.search(testo)
+    testo = _CAP.sub(',', testo)
+    provincia = None
+
+    def estrai_provincia(match):
+        nonlocal provincia
+        if match.group(1) not in SIGLE_PROVINCE:
+            return match.group(0)
+        provincia = match.group(1)
+        return ','
+
+    testo = _PROVINCIA.sub(estrai_provincia, testo)
+
+    # Numero civico: togli i prefissi e unisci l'eventuale esponente
+    testo = _CIVICO.sub('', testo)
+    testo = _CIVICO_ESPONENTE.sub(lambda m: m.group(1) + (m.group(2) or m.group(3)), testo)
+
+    parole = _parole(testo)
+    civici = [i for i, parola in enumerate(parole) if i > 0 and _NUMERO_CIVICO.fullmatch(parola)]
+    civico = civici[-1] if civici else None
+
+    # Le abbreviazioni senza punto si espandono solo all'inizio della via e della località
+    for i in (0, civico + 1 if civico is not None else None):
+        if i is not None and i < len(parole):
+            parole[i] = ABBREVIAZIONI_STRADA.get(parole[i], parole[i])
+    for i, parola in enumerate(parole[:-1]):
+        parole[i] = ABBREVIAZIONI_NOMI.get(parola, parola)
+
+    # Il paese in fondo si ignora, a meno che non faccia parte del nome della via
+    if (len(parole) > 2 and parole[-1] in ('italia', 'italy')
+            and parole[-2] not in TIPI_STRADA and parole[-2] not in PREPOSIZIONI):
+        parole.pop()
+
+    # Una sigla senza parentesi è la provincia solo in fondo, dopo il civico o con il CAP (es. non in "Via Po")
+    if (provincia is None and len(parole) > 1 and parole[-1] in SIGLE_PROVINCE
+            and (cap or (civico is not None and civico < len(parole) - 1))):
+        provincia = parole.pop()
+
+    if civico is None or civico + 1 >= len(parole):
+        parti = [' '.join(parole)] if parole else []
+    else:
+        parti = [' '.join(parole[:civico + 1]), ' '.join(parole[civico + 1:])]
+    if cap:
+        parti.append(cap.group(1))
+    if provincia:
+        parti.append(provincia)
+    return ', '.join(parti)
@@ -0,0 +1,393 @@
+import codecs
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from concorrenza import LimiteAdattivo
+from cache_edifici import cache_edifici_condivisa, tile_di, bbox_tile, tile_copertura, EdificiTile, ZOOM_TILE
+from archivio_edifici import archivio_edifici_condiviso
+from edifici import risultato_edificio, messaggio_edificio, METRI_PER_GRADO, MESSAGGIO_NESSUN_EDIFICIO
+from metriche import misura, incrementa
+
+OVERPASS_URL = os.getenv('OVERPASS_URL', "http://overpass-api.de/api/interpreter")
+
+# Limiti del servizio pubblico: richieste al secondo e richieste contemporanee (slot).
+# Gli slot partono da SLOT_OVERPASS e si adattano fino a SLOT_OVERPASS_MAX.
+RICHIESTE_AL_SECONDO = float(os.getenv('OVERPASS_RICHIESTE_AL_SECONDO', 1.0))
+SLOT_OVERPASS = int(os.getenv('OVERPASS_SLOT', 2))
+SLOT_OVERPASS_MAX = int(os.getenv('OVERPASS_SLOT_MAX', max(SLOT_OVERPASS, 4)))
+
+# Tentativi e attese per gli errori temporanei (429 e 5xx)
+MAX_TENTATIVI = 5
+ATTESA_BASE = 1.0
+ATTESA_MASSIMA = 60.0
+TIMEOUT_RICHIESTA = 90
+
+# Limiti dichiarati nelle query sugli edifici: tempo di esecuzione (s) e memoria (byte) sul server.
+# Valori bassi rispetto ai predefiniti (180 s, 512 MiB) fanno accettare prima le query dal servizio.
+TIMEOUT_QUERY = 25
+MAXSIZE_QUERY = 64 * 1024 * 1024
+
+# Dimensione dei blocchi in cui viene letta la risposta
+DIMENSIONE_BLOCCO = 64 * 1024
+
+_REMARK = re.compile(r'"remark"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+# Raggi di ricerca crescenti attorno a ogni punto (in gradi, circa 20, 50 e 100 metri): si passa
+# al successivo solo se entro il precedente non c'è alcun edificio
+RAGGI_RICERCA = (0.0002, 0.0005, 0.001)
+RAGGIO_RICERCA = RAGGI_RICERCA[-1]
+
+# Raggio usato subito per i punti imprecisi (geocoding senza numero civico), circa 250 metri
+RAGGIO_RICERCA_AMPIO = 0.0025
+
+# Margine (in gradi, circa 20 metri) con cui viene scaricato ogni tile: la ricerca più stretta
+# non richiede i tile adiacenti, scaricati solo quando il raggio utile esce dal margine
+MARGINE_TILE = RAGGI_RICERCA[0]
+
+
+class LimitatoreRichieste:
+    """Token bucket: consente in media `tasso` richieste al secondo, con raffiche fino a `capacita`."""
+
+    def __init__(self, tasso, capacita=1):
+        self.tasso = tasso
+        self.capacita = capacita
+        self._gettoni = capacita
+        self._ultimo = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquisisci(self):
+        """Attende finché non è disponibile un gettone e lo consuma."""
+        while True:
+            with self._lock:
+                adesso = time.monotonic()
+                self._gettoni = min(self.capacita, self._gettoni + (adesso - self._ultimo) * self.tasso)
+                self._ultimo = adesso
+                if self._gettoni >= 1:
+                    self._gettoni -= 1
+                    return
+                attesa = (1 - self._gettoni) / self.tasso
+            time.sleep(attesa)
+
+
+class ClientOverpass:
+    """Client HTTP condiviso per Overpass.
+
+    Riusa le connessioni (keep-alive) tramite una `requests.Session`, rispetta il
+    limite di richieste al secondo del servizio e ripete le richieste fallite con
+    429/5xx con un'attesa esponenziale con jitter, rispettando l'header
+    Retry-After quando presente. Le richieste contemporanee partono da `slot` e
+    sono regolate da un `LimiteAdattivo` fino a `slot_max`: 429 e 504 (server
+    sovraccarico) riducono il limite.
+    """
+
+    def __init__(self, url=OVERPASS_URL, tasso=RICHIESTE_AL_SECONDO, slot=SLOT_OVERPASS,
+                 slot_max=SLOT_OVERPASS_MAX, max_tentativi=MAX_TENTATIVI, timeout=TIMEOUT_RICHIESTA):
+        self.url = url
+        self.max_tentativi = max_tentativi
+        self.timeout = timeout
+        self.limitatore = LimitatoreRichieste(tasso, capacita=slot)
+        self.concorrenza = LimiteAdattivo(slot, massimo=slot_max)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(slot_max, 10))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _attesa(self, tentativo, response=None):
+        """Calcola l'attesa prima del prossimo tentativo (backoff esponenziale con jitter)."""
+        if response is not None:
+            retry_after = response.headers.get('Retry-After')
+            if retry_after and retry_after.isdigit():
+                return min(float(retry_after), ATTESA_MASSIMA)
+        return random.uniform(0, min(ATTESA_MASSIMA, ATTESA_BASE * 2 ** tentativo))
+
+    def esegui(self, query, leggi=None):
+        """Esegue una query Overpass e restituisce la risposta JSON decodificata.
+
+        Se è indicata `leggi`, la risposta viene letta a blocchi man mano che arriva
+        e viene restituito `leggi(blocchi)`, senza decodificare l'intero JSON.
+        """
+        for tentativo in range(self.max_tentativi):
+            self.limitatore.acquisisci()
+            inizio = self.concorrenza.acquisisci()
+            risultato = None
+            try:
+                with misura('overpass_richiesta'):
+                    response = self.session.post(self.url, data=query, timeout=self.timeout,
+                                                 stream=leggi is not None)
+                    # Il posto resta occupato finché la risposta non è stata letta tutta
+                    if leggi is not None and response.status_code < 400:
+                        with response:
+                            risultato = leggi(response.iter_content(DIMENSIONE_BLOCCO))
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                self.concorrenza.rilascia(inizio, errore=True)
+                incrementa('errori_servizi_totali', servizio='overpass', tipo=type(e).__name__)
+                if tentativo == self.max_tentativi - 1:
+                    raise
+                time.sleep(self._attesa(tentativo))
+                continue
+            except Exception:
+                self.concorrenza.rilascia(inizio, errore=True)
+                raise
+            self.concorrenza.rilascia(inizio, sovraccarico=response.status_code in (429, 504),
+                                      errore=response.status_code >= 400)
+
+            if response.status_code >= 400:
+                response.close()
+                incrementa('errori_servizi_totali', servizio='overpass', tipo=str(response.status_code))
+            if response.status_code == 429 or response.status_code >= 500:
+                if tentativo == self.max_tentativi - 1:
+                    response.raise_for_status()
+                time.sleep(self._attesa(tentativo, response))
+                continue
+
+            response.raise_for_status()
+            if leggi is not None:
+                return risultato
+            with misura('overpass_json'):
+                return response.json()
+
+
+_client_condiviso = None
+_client_lock = threading.Lock()
+
+
+def client_condiviso():
+    """Restituisce il client Overpass del processo, condiviso da tutti i thread."""
+    global _client_condiviso
+    with _client_lock:
+        if _client_condiviso is None:
+            _client_condiviso = ClientOverpass()
+        return _client_condiviso
+
+
+def configura_client_condiviso(**opzioni):
+    """Sostituisce il client Overpass del processo con uno creato con le opzioni indicate."""
+    global _client_condiviso
+    with _client_lock:
+        _client_condiviso = ClientOverpass(**opzioni)
+        return _client_condiviso
+
+
+def raggruppa_punti(punti, zoom=ZOOM_TILE):
+    """Raggruppa i punti {indice: (lat, lon, ...)} per tile della slippy map.
+
+    Restituisce un dizionario {tile: [indici]}, con un elemento per tile occupato.
+    """
+    tiles = {}
+    for idx, punto in punti.items():
+        tiles.setdefault(tile_di(punto[0], punto[1], zoom), []).append(idx)
+    return tiles
+
+
+def query_edifici(sud, ovest, nord, est, timeout=TIMEOUT_QUERY, maxsize=MAXSIZE_QUERY):
+    """Compone la query Overpass per gli edifici nel bounding box.
+
+    Chiede solo id, tag e geometria delle way (`out tags geom`), senza la lista degli
+    id dei nodi, con limiti di tempo e memoria ridotti sul server.
+    """
+    return (f"[out:json][timeout:{timeout}][maxsize:{maxsize}];"
+            f"way({sud},{ovest},{nord},{est})[building];"
+            f"out tags geom qt;")
+
+
+def _testo(blocchi):
+    """Decodifica in UTF-8 i blocchi di byte della risposta, anche se un carattere è spezzato."""
+    decodificatore = codecs.getincrementaldecoder('utf-8')()
+    for blocco in blocchi:
+        testo = decodificatore.decode(blocco)
+        if testo:
+            yield testo
+    testo = decodificatore.decode(b'', final=True)
+    if testo:
+        yield testo
+
+
+def _controlla_remark(remark):
+    """Solleva RuntimeError se il commento della risposta riporta un errore di esecuzione della query."""
+    if remark and 'runtime error' in remark:
+        raise RuntimeError(f"Overpass: {remark}")
+
+
+def leggi_elementi(blocchi):
+    """Decodifica uno alla volta gli elementi di una risposta Overpass letta a blocchi.
+
+    Ogni elemento viene restituito appena il suo JSON è completo, così che la
+    risposta non sia mai in memoria per intero. Solleva RuntimeError se Overpass
+    segnala un errore di esecuzione (timeout o `maxsize` superati), che
+    renderebbe incompleto l'elenco degli edifici.
+    """
+    decodificatore = json.JSONDecoder()
+    testi = _testo(blocchi)
+    buffer = ''
+
+    # Cerca l'inizio dell'array "elements"
+    while True:
+        chiave = buffer.find('"elements"')
+        parentesi = buffer.find('[', chiave) if chiave >= 0 else -1
+        if parentesi >= 0:
+            break
+        testo = next(testi, None)
+        if testo is None:
+            # Nessun elemento: la risposta è piccola e può essere decodificata per intero
+            _controlla_remark(json.loads(buffer).get('remark'))
+            return
+        buffer += testo
+
+    pos = parentesi + 1
+    while True:
+        while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+            pos += 1
+        if pos < len(buffer):
+            if buffer[pos] == ']':
+                break
+            try:
+                elemento, pos = decodificatore.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                pass
+            else:
+                yield elemento
+                continue
+        # Blocco esaurito o elemento spezzato tra due blocchi: serve il blocco successivo
+        testo = next(testi, None)
+        if testo is None:
+            raise ValueError("Risposta Overpass incompleta")
+        buffer = buffer[pos:] + testo
+        pos = 0
+
+    remark = _REMARK.search(buffer[pos + 1:] + ''.join(testi))
+    _controlla_remark(remark and remark.group(1))
+
+
+def leggi_edifici(blocchi):
+    """Legge a blocchi una risposta Overpass e ne ricava direttamente un `EdificiTile`."""
+    return EdificiTile.da_elementi(leggi_elementi(blocchi))
+
+
+def scarica_edifici_bbox(sud, ovest, nord, est):
+    """Scarica da Overpass gli edifici nel bounding box e li restituisce come `EdificiTile`."""
+    return client_condiviso().esegui(query_edifici(sud, ovest, nord, est), leggi=leggi_edifici)
+
+
+def raggi_ricerca(preciso=True):
+    """Restituisce i raggi da provare in ordine: crescenti per un punto preciso, subito ampio altrimenti."""
+    return RAGGI_RICERCA if preciso else (RAGGIO_RICERCA_AMPIO,)
+
+
+def edifici_tile(tile):
+    """Restituisce gli edifici del tile dalla cache condivisa, scaricandoli se mancano."""
+    return cache_edifici_condivisa().edifici(tile, lambda t: scarica_edifici_bbox(*bbox_tile(t, MARGINE_TILE)))
+
+
+def _tile_adiacenti(tile, lat, lon, raggio):
+    """Restituisce i tile adiacenti raggiunti dal cerchio di `raggio` gradi oltre il margine del tile."""
+    delta_lon = raggio / max(math.cos(math.radians(lat)), 0.01)
+    sud, ovest, nord, est = bbox_tile(tile, MARGINE_TILE)
+    if sud <= lat - raggio and nord >= lat + raggio and ovest <= lon - delta_lon and est >= lon + delta_lon:
+        return []
+    return [t for t in tile_copertura(lat - raggio, lon - delta_lon, lat + raggio, lon + delta_lon, tile[0])
+            if t != tile]
+
+
+def cerca_edificio(lat, lon, preciso=True, zoom=ZOOM_TILE):
+    """Trova l'edificio che contiene il punto o il più vicino, allargando la ricerca solo se serve.
+
+    Si parte dagli edifici del tile del punto con il raggio più stretto; i tile
+    adiacenti vengono consultati (e scaricati) solo se il cerchio entro cui un
+    edificio potrebbe essere più vicino esce dal tile, e il raggio cresce solo se
+    non è stato trovato nessun edificio.
+    """
+    tile = tile_di(lat, lon, zoom)
+    for raggio in raggi_ricerca(preciso):
+        distanza_max = raggio * METRI_PER_GRADO
+        edificio, distanza = edifici_tile(tile).cerca_edificio(lat, lon, distanza_max)
+        if edificio is None or distanza > 0:
+            limite = distanza if edificio is not None else distanza_max
+            for adiacente in _tile_adiacenti(tile, lat, lon, limite / METRI_PER_GRADO):
+                candidato, distanza = edifici_tile(adiacente).cerca_edificio(lat, lon, limite)
+                if candidato is not None and distanza < limite:
+                    edificio, limite = candidato, distanza
+        if edificio is not None:
+            incrementa('ricerche_edificio_totali', raggio_m=round(distanza_max))
+            return edificio
+    incrementa('ricerche_edificio_totali', raggio_m='nessuno')
+    return None
+
+
+def assegna_edifici(punti, indici, zoom=ZOOM_TILE, con_area=True):
+    """Assegna a ogni punto l'edificio che lo contiene o il più vicino.
+
+    I valori di `punti` sono (lat, lon) oppure (lat, lon, preciso): i punti imprecisi
+    vengono cercati subito con il raggio ampio. I punti che cadono in un edificio
+    dell'archivio lo riusano senza cercarlo tra gli edifici del tile; gli edifici
+    trovati vengono aggiunti all'archivio.
+    """
+    archivio = archivio_edifici_condiviso()
+    risultati = {}
+    trovati = []
+    for idx in indici:
+        punto = punti[idx]
+        # Un punto dentro un edificio già archiviato non richiede gli edifici del tile
+        archiviato = archivio.edificio_in(punto[0], punto[1]) if archivio else None
+        if archiviato:
+            risultati[idx] = (archiviato['area'] if con_area else None, archiviato['coordinates'],
+                              messaggio_edificio(archiviato), archiviato['id'])
+            continue
+        edificio = cerca_edificio(punto[0], punto[1], punto[2] if len(punto) > 2 else True, zoom)
+        if not edificio:
+            risultati[idx] = (None, None, MESSAGGIO_NESSUN_EDIFICIO, None)
+            continue
+        trovati.append(edificio)
+        risultati[idx] = risultato_edificio(edificio, con_area) + (edificio.get('id'),)
+    if archivio and trovati:
+        archivio.registra(trovati)
+    return risultati
+
+
+def calcola_superficie_punto(lat, lon, preciso=True, con_area=True):
+    """Calcola la superficie dell'edificio in un punto usando gli edifici per tile.
+
+    Restituisce la tupla (area, coordinates, messaggio).
+    """
+    return assegna_edifici({0: (lat, lon, preciso)}, [0], con_area=con_area)[0][:3]
+
+
+def calcola_superfici_raggruppate(punti, zoom=ZOOM_TILE, max_workers=SLOT_OVERPASS_MAX, callback=None,
+                                   con_area=True):
+    """Calcola le superfici per molti punti con al più una query Overpass per tile.
+
+    `punti` è un dizionario {indice: (lat, lon)} o {indice: (lat, lon, preciso)}; restituisce
+    {indice: (area, coordinates, messaggio, edificio_id)}, dove `edificio_id` è l'id della way OSM.
+    I tile già presenti nella cache degli edifici non vengono riscaricati.
+    `callback`, se fornita, viene chiamata con il numero di punti completati. Con
+    `con_area=False` restituisce solo le geometrie, da misurare poi con `aree_poligoni`.
+    """
+    tiles = raggruppa_punti(punti, zoom)
+    risultati = {}
+    completati = 0
+
+    def elabora(tile, indici):
+        return assegna_edifici(punti, indici, zoom, con_area)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(elabora, tile, indici): indici for tile, indici in tiles.items()}
+        for future in as_completed(futures):
+            indici = futures[future]
+            try:
+                risultati.update(future.result())
+            except Exception as e:
+                for idx in indici:
+                    risultati[idx] = (None, None, f"Errore durante il calcolo della superficie: {str(e)}", None)
+            completati += len(indici)
+            if callback:
+                callback(completati)
+
+    return risultati
@@ -0,0 +1,214 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from concorrenza import GEOCODING_CONCORRENZA_MAX
+from edifici import impacchetta_poligoni, aree_poligoni
+from normalizzazione import normalizza_indirizzo
+
+# Parallelismo massimo per stadio, sovrascrivibile dal file .env. Le richieste
+# effettive verso ciascun servizio sono regolate dal rispettivo limite adattivo.
+CONCORRENZA_GEOCODING = int(os.getenv('CONCORRENZA_GEOCODING', GEOCODING_CONCORRENZA_MAX))
+CONCORRENZA_EDIFICI = int(os.getenv('CONCORRENZA_EDIFICI', 2))
+
+# Numero massimo di punti per richiesta di edifici e attesa massima per riempire un lotto
+LOTTO_EDIFICI = 50
+ATTESA_LOTTO = 0.2
+
+# Capienza delle code tra uno stadio e l'altro
+DIMENSIONE_CODA = 100
+
+# Indirizzi già elaborati conservati per servire i duplicati successivi
+MAX_DUPLICATI_RICORDATI = 10000
+
+_FINE = object()
+
+
+def riga_risultato(riga):
+    """Converte una riga elaborata dalla pipeline nel formato della tabella dei risultati."""
+    if riga.get('lat') is None or riga.get('lon') is None:
+        return {
+            'Indirizzo_Input': riga['indirizzo'],
+            'Indirizzo_Trovato': None,
+            'Latitudine': None,
+            'Longitudine': None,
+            'Superficie_m2': None,
+            'Perimetro_m': None,
+            'Stato': '❌ Indirizzo non trovato'
+        }
+
+    area = riga.get('area')
+    if (riga.get('messaggio') or '').startswith("Errore"):
+        stato = '❌ Errore nel calcolo'
+    else:
+        stato = "✅ Calcolato" if area else "❌ Calcolo non riuscito"
+    return {
+        'Indirizzo_Input': riga['indirizzo'],
+        'Indirizzo_Trovato': riga['indirizzo_completo'],
+        'Latitudine': riga['lat'],
+        'Longitudine': riga['lon'],
+        'Superficie_m2': area if area else None,
+        'Perimetro_m': riga.get('perimetro') if area else None,
+        'Stato': stato
+    }
+
+
+async def _preleva_lotto(coda, dimensione, attesa):
+    """Preleva dalla coda fino a `dimensione` elementi, attendendo al più `attesa` secondi.
+
+    Restituisce il lotto e un flag che indica se è stato raggiunto il segnale di fine.
+    """
+    lotto = []
+    primo = await coda.get()
+    if primo is _FINE:
+        return lotto, True
+    lotto.append(primo)
+    scadenza = time.monotonic() + attesa
+    while len(lotto) < dimensione:
+        try:
+            elemento = coda.get_nowait()
+        except asyncio.QueueEmpty:
+            residuo = scadenza - time.monotonic()
+            if residuo <= 0:
+                break
+            try:
+                elemento = await asyncio.wait_for(coda.get(), residuo)
+            except asyncio.TimeoutError:
+                break
+        if elemento is _FINE:
+            return lotto, True
+        lotto.append(elemento)
+    return lotto, False
+
+
+async def _pipeline(indirizzi, geocodifica, calcola_superfici, al_completamento,
+                    concorrenza_geocoding, concorrenza_edifici, lotto_edifici, dimensione_coda,
+                    deduplica, statistiche):
+    loop = asyncio.get_running_loop()
+    coda_geocoding = asyncio.Queue(dimensione_coda)
+    coda_edifici = asyncio.Queue(dimensione_coda)
+    coda_aree = asyncio.Queue(dimensione_coda)
+    esecutore_geocoding = ThreadPoolExecutor(max_workers=concorrenza_geocoding)
+    esecutore_edifici = ThreadPoolExecutor(max_workers=concorrenza_edifici)
+
+    # Righe duplicate in attesa del rappresentante in corso e risultati recenti per chiave
+    in_corso = {}
+    completate = OrderedDict()
+
+    def completa(riga):
+        """Consegna la riga e la replica sulle righe duplicate dello stesso indirizzo."""
+        al_completamento(riga)
+        chiave = riga.get('chiave')
+        if chiave is None:
+            return
+        for idx, indirizzo in in_corso.pop(chiave, ()):
+            al_completamento(dict(riga, idx=idx, indirizzo=indirizzo))
+        # Gli errori temporanei non vengono riutilizzati per i duplicati successivi
+        if not (riga.get('messaggio') or '').startswith("Errore"):
+            completate[chiave] = riga
+            if len(completate) > MAX_DUPLICATI_RICORDATI:
+                completate.popitem(last=False)
+
+    async def produttore():
+        for idx, indirizzo in indirizzi:
+            statistiche['righe'] += 1
+            chiave = normalizza_indirizzo(indirizzo) if deduplica else None
+            if chiave is not None:
+                if chiave in completate:
+                    completate.move_to_end(chiave)
+                    al_completamento(dict(completate[chiave], idx=idx, indirizzo=indirizzo))
+                    continue
+                if chiave in in_corso:
+                    in_corso[chiave].append((idx, indirizzo))
+                    continue
+                in_corso[chiave] = []
+            statistiche['elaborate'] += 1
+            await coda_geocoding.put({'idx': idx, 'indirizzo': indirizzo, 'chiave': chiave})
+        for _ in range(concorrenza_geocoding):
+            await coda_geocoding.put(_FINE)
+
+    async def stadio_geocoding():
+        while True:
+            riga = await coda_geocoding.get()
+            if riga is _FINE:
+                return
+            try:
+                esito = await loop.run_in_executor(esecutore_geocoding, geocodifica, riga['indirizzo'])
+                riga['lat'], riga['lon'], riga['indirizzo_completo'] = esito[:3]
+                riga['preciso'] = esito[3] if len(esito) > 3 else True
+            except Exception as e:
+                riga['lat'] = riga['lon'] = riga['indirizzo_completo'] = None
+                riga['messaggio'] = f"Errore nel geocoding: {str(e)}"
+            if riga['lat'] is not None and riga['lon'] is not None:
+                await coda_edifici.put(riga)
+            else:
+                completa(riga)
+
+    async def stadio_edifici():
+        fine = False
+        while not fine:
+            lotto, fine = await _preleva_lotto(coda_edifici, lotto_edifici, ATTESA_LOTTO)
+            if not lotto:
+                continue
+            punti = {riga['idx']: (riga['lat'], riga['lon'], riga.get('preciso', True)) for riga in lotto}
+            try:
+                superfici = await loop.run_in_executor(esecutore_edifici, calcola_superfici, punti)
+            except Exception as e:
+                superfici = {idx: (None, None, f"Errore durante il calcolo della superficie: {str(e)}", None)
+                             for idx in punti}
+            for riga in lotto:
+                _, riga['coordinates'], riga['messaggio'], riga['edificio_id'] = superfici[riga['idx']]
+                await coda_aree.put(riga)
+
+    async def stadio_aree():
+        fine = False
+        while not fine:
+            lotto, fine = await _preleva_lotto(coda_aree, dimensione_coda, 0)
+            con_poligono = [riga for riga in lotto if riga.get('coordinates')]
+            aree, perimetri = aree_poligoni(*impacchetta_poligoni([riga['coordinates'] for riga in con_poligono]))
+            for riga, area, perimetro in zip(con_poligono, aree, perimetri):
+                riga['area'], riga['perimetro'] = float(area), float(perimetro)
+            for riga in lotto:
+                completa(riga)
+
+    async def esegui_stadio(stadio, concorrenza, coda_successiva, uscite):
+        await asyncio.gather(*(stadio() for _ in range(concorrenza)))
+        for _ in range(uscite):
+            await coda_successiva.put(_FINE)
+
+    try:
+        await asyncio.gather(
+            produttore(),
+            esegui_stadio(stadio_geocoding, concorrenza_geocoding, coda_edifici, concorrenza_edifici),
+            esegui_stadio(stadio_edifici, concorrenza_edifici, coda_aree, 1),
+            stadio_aree()
+        )
+    finally:
+        esecutore_geocoding.shutdown(wait=False)
+        esecutore_edifici.shutdown(wait=False)
+
+
+def esegui_pipeline(indirizzi, geocodifica, calcola_superfici, al_completamento,
+                    concorrenza_geocoding=CONCORRENZA_GEOCODING, concorrenza_edifici=CONCORRENZA_EDIFICI,
+                    lotto_edifici=LOTTO_EDIFICI, dimensione_coda=DIMENSIONE_CODA, deduplica=True):
+    """Elabora gli indirizzi in streaming: geocoding → ricerca edificio → area.
+
+    `indirizzi` è un iterabile di coppie (indice, indirizzo). Ogni riga passa allo
+    stadio successivo appena completato il precedente, attraverso code limitate.
+    - `geocodifica(indirizzo)` restituisce una tupla che inizia con (lat, lon, indirizzo_completo),
+      seguita facoltativamente da un booleano che indica se il punto è preciso (numero civico trovato);
+    - `calcola_superfici({indice: (lat, lon, preciso)})` restituisce {indice: (area, coordinates, messaggio, edificio_id)};
+    - `al_completamento(riga)` viene chiamata per ogni riga completata, in ordine di completamento.
+
+    Con `deduplica=True` gli indirizzi con la stessa forma normalizzata vengono
+    elaborati una sola volta e il risultato è replicato su tutte le righe
+    corrispondenti. Restituisce {'righe': ..., 'elaborate': ...}, cioè le righe
+    lette e quelle effettivamente elaborate.
+    """
+    statistiche = {'righe': 0, 'elaborate': 0}
+    asyncio.run(_pipeline(indirizzi, geocodifica, calcola_superfici, al_completamento,
+                          concorrenza_geocoding, concorrenza_edifici, lotto_edifici, dimensione_coda,
+                          deduplica, statistiche))
+    return statistiche
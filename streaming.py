@@ -0,0 +1,240 @@
+import csv
+import heapq
+import time
+import zlib
+from collections import deque
+
+import pandas as pd
+
+from journal import id_lavoro, esegui_con_journal
+from normalizzazione import normalizza_indirizzo
+from pipeline import esegui_pipeline, riga_risultato
+
+# Righe lette dal file di input per ogni blocco
+DIMENSIONE_BLOCCO = 10000
+
+# Righe accumulate prima di scrivere un row group Parquet
+RIGHE_PER_GRUPPO_PARQUET = 10000
+
+COLONNE_RISULTATI = ['Indirizzo_Input', 'Indirizzo_Trovato', 'Latitudine', 'Longitudine',
+                     'Superficie_m2', 'Perimetro_m', 'Stato']
+COLONNE_NUMERICHE = {'Latitudine', 'Longitudine', 'Superficie_m2', 'Perimetro_m'}
+
+# Secondi massimi tra due scritture su disco del CSV, che resta leggibile durante l'elaborazione
+INTERVALLO_SVUOTAMENTO_CSV = 1.0
+
+# Colonna con l'indice della riga nei file parziali scritti da ogni processo
+COLONNA_INDICE = '_idx'
+
+
+def trova_colonna_indirizzi(colonne):
+    """Individua la colonna con gli indirizzi, altrimenti usa la prima."""
+    for col in colonne:
+        if 'indirizzo' in str(col).lower() or 'address' in str(col).lower():
+            return col
+    return colonne[0]
+
+
+def _nome(sorgente):
+    return sorgente if isinstance(sorgente, str) else getattr(sorgente, 'name', '')
+
+
+def leggi_indirizzi(sorgente, dimensione_blocco=DIMENSIONE_BLOCCO):
+    """Legge gli indirizzi a blocchi da un file CSV, XLSX o di testo.
+
+    `sorgente` può essere un percorso o un file aperto (con attributo `name`).
+    Restituisce un generatore di coppie (indice, indirizzo) senza caricare
+    l'intero file in memoria. Le celle vuote vengono saltate, ma l'indice resta
+    quello della riga nel file.
+    """
+    nome = _nome(sorgente).lower()
+    idx = 0
+    if nome.endswith('.xlsx'):
+        from openpyxl import load_workbook
+
+        # In sola lettura il file resta aperto finché la cartella non viene chiusa
+        cartella = load_workbook(sorgente, read_only=True)
+        try:
+            righe = cartella.active.iter_rows(values_only=True)
+            intestazione = next(righe, None)
+            if intestazione is None:
+                return
+            colonna = list(intestazione).index(trova_colonna_indirizzi(list(intestazione)))
+            for riga in righe:
+                valore = riga[colonna] if colonna < len(riga) else None
+                if valore is not None and str(valore).strip():
+                    yield idx, str(valore).strip()
+                idx += 1
+        finally:
+            cartella.close()
+        return
+
+    if nome.endswith('.csv'):
+        blocchi = pd.read_csv(sorgente, chunksize=dimensione_blocco)
+    else:  # Assume che sia un file di testo
+        blocchi = pd.read_csv(sorgente, header=None, names=['Indirizzo'], chunksize=dimensione_blocco)
+    colonna = None
+    for blocco in blocchi:
+        if colonna is None:
+            colonna = trova_colonna_indirizzi(list(blocco.columns))
+        for valore in blocco[colonna]:
+            if not pd.isna(valore) and str(valore).strip():
+                yield idx, str(valore).strip()
+            idx += 1
+
+
+class ScritturaCSV:
+    """Scrive le righe dei risultati su un CSV man mano che arrivano.
+
+    Il file viene svuotato su disco almeno ogni `intervallo` secondi, così che
+    le righe già scritte possano essere lette (e scaricate) prima della fine.
+    """
+
+    def __init__(self, destinazione, colonna_indice=False, intervallo=INTERVALLO_SVUOTAMENTO_CSV):
+        colonne = [COLONNA_INDICE] + COLONNE_RISULTATI if colonna_indice else COLONNE_RISULTATI
+        self._file = open(destinazione, 'w', newline='', encoding='utf-8')
+        self._writer = csv.DictWriter(self._file, fieldnames=colonne)
+        self._writer.writeheader()
+        self._intervallo = intervallo
+        self._svuotato = time.monotonic()
+
+    def scrivi(self, riga):
+        self._writer.writerow(riga)
+        adesso = time.monotonic()
+        if adesso - self._svuotato >= self._intervallo:
+            self._file.flush()
+            self._svuotato = adesso
+
+    def chiudi(self):
+        self._file.close()
+
+
+class ScritturaParquet:
+    """Scrive le righe dei risultati su un file Parquet a row group (richiede `pyarrow`).
+
+    `colonne` è la lista di coppie (nome, tipo pyarrow come 'string' o 'float64').
+    """
+
+    def __init__(self, destinazione, righe_per_gruppo=RIGHE_PER_GRUPPO_PARQUET, colonne=None):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Per scrivere file Parquet installa il pacchetto 'pyarrow' (pip install pyarrow)")
+        self._pa = pa
+        if colonne is None:
+            colonne = [(c, 'float64' if c in COLONNE_NUMERICHE else 'string') for c in COLONNE_RISULTATI]
+        self._schema = pa.schema([(nome, pa.type_for_alias(tipo)) for nome, tipo in colonne])
+        self._writer = pq.ParquetWriter(destinazione, self._schema)
+        self._righe_per_gruppo = righe_per_gruppo
+        self._buffer = []
+
+    def scrivi(self, riga):
+        self._buffer.append(riga)
+        if len(self._buffer) >= self._righe_per_gruppo:
+            self._svuota()
+
+    def _svuota(self):
+        if self._buffer:
+            self._writer.write_table(self._pa.Table.from_pylist(self._buffer, schema=self._schema))
+            self._buffer = []
+
+    def chiudi(self):
+        self._svuota()
+        self._writer.close()
+
+
+def apri_scrittura(destinazione):
+    """Sceglie il formato di output (CSV o Parquet) dall'estensione del file."""
+    if destinazione.lower().endswith('.parquet'):
+        return ScritturaParquet(destinazione)
+    return ScritturaCSV(destinazione)
+
+
+def appartiene_a_porzione(indirizzo, porzione):
+    """Indica se l'indirizzo spetta alla porzione (k, n), in modo stabile tra processi."""
+    k, n = porzione
+    return zlib.crc32(normalizza_indirizzo(indirizzo).encode('utf-8')) % n == k
+
+
+def processa_file_streaming(sorgente, destinazione, geocodifica, calcola_superfici,
+                            callback=None, journal=None, ripeti_fallite=False, porzione=None,
+                            **opzioni_pipeline):
+    """Elabora un file di indirizzi di qualsiasi dimensione con memoria costante.
+
+    Le righe sono lette a blocchi, attraversano la pipeline e vengono scritte su
+    `destinazione` (CSV o Parquet) nell'ordine originale appena disponibili: solo le
+    righe ancora in elaborazione restano in memoria. `callback`, se fornita, viene
+    chiamata con il numero di righe scritte. Restituisce il numero di righe elaborate.
+
+    Con un `journal` le righe già completate in un'esecuzione precedente sullo
+    stesso file vengono riprese dal journal invece di essere rielaborate.
+
+    Con `porzione=(k, n)` vengono elaborate solo le righe la cui forma normalizzata
+    appartiene alla porzione k di n (così gli indirizzi duplicati finiscono nello
+    stesso processo) e il CSV di output contiene anche la colonna `_idx`, così che
+    i file parziali di più processi possano essere riuniti con `unisci_porzioni`.
+    """
+    if porzione:
+        scrittura = ScritturaCSV(destinazione, colonna_indice=True)
+    else:
+        scrittura = apri_scrittura(destinazione)
+    # Indici letti e non ancora scritti, nell'ordine del file
+    da_scrivere = deque()
+    in_attesa = {}
+    scritte = 0
+
+    def indirizzi():
+        for idx, indirizzo in leggi_indirizzi(sorgente):
+            if porzione and not appartiene_a_porzione(indirizzo, porzione):
+                continue
+            da_scrivere.append(idx)
+            yield idx, indirizzo
+
+    def al_completamento(riga):
+        nonlocal scritte
+        risultato = riga_risultato(riga)
+        if porzione:
+            risultato[COLONNA_INDICE] = riga['idx']
+        in_attesa[riga['idx']] = risultato
+        # Scrivi in ordine tutte le righe contigue già completate
+        while da_scrivere and da_scrivere[0] in in_attesa:
+            scrittura.scrivi(in_attesa.pop(da_scrivere.popleft()))
+            scritte += 1
+        if callback:
+            callback(scritte)
+
+    try:
+        if journal is not None:
+            esegui_con_journal(journal, id_lavoro(sorgente), indirizzi(), geocodifica,
+                               calcola_superfici, al_completamento, ripeti_fallite, **opzioni_pipeline)
+        else:
+            esegui_pipeline(indirizzi(), geocodifica, calcola_superfici, al_completamento, **opzioni_pipeline)
+    finally:
+        scrittura.chiudi()
+    return scritte
+
+
+def _leggi_porzione(percorso):
+    """Legge un file parziale restituendo le righe con i valori numerici convertiti."""
+    with open(percorso, newline='', encoding='utf-8') as f:
+        for riga in csv.DictReader(f):
+            riga[COLONNA_INDICE] = int(riga[COLONNA_INDICE])
+            for colonna in COLONNE_RISULTATI:
+                if riga[colonna] == '':
+                    riga[colonna] = None
+                elif colonna in COLONNE_NUMERICHE:
+                    riga[colonna] = float(riga[colonna])
+            yield riga
+
+
+def unisci_porzioni(percorsi, destinazione):
+    """Unisce in ordine di riga i file parziali scritti da più processi, in streaming."""
+    scrittura = apri_scrittura(destinazione)
+    try:
+        for riga in heapq.merge(*(_leggi_porzione(p) for p in percorsi), key=lambda r: r[COLONNA_INDICE]):
+            del riga[COLONNA_INDICE]
+            scrittura.scrivi(riga)
+    finally:
+        scrittura.chiudi()
+
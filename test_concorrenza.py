@@ -0,0 +1,54 @@
+import random
+
+import pytest
+
+import concorrenza
+from concorrenza import LimiteAdattivo
+
+
+@pytest.fixture
+def orologio(monkeypatch):
+    """Orologio simulato al posto di `time.monotonic`, fatto avanzare dalla simulazione."""
+    adesso = [0.0]
+    monkeypatch.setattr(concorrenza.time, 'monotonic', lambda: adesso[0])
+    return adesso
+
+
+def simula(orologio, latenza, giri=300, iniziale=5, massimo=20):
+    """Esegue `giri` gruppi di richieste contemporanee, tante quante il limite corrente.
+
+    `latenza(giro)` restituisce la durata di una richiesta; restituisce i limiti dopo ogni giro.
+    """
+    limite = LimiteAdattivo(iniziale, massimo=massimo)
+    limiti = []
+    for giro in range(giri):
+        contemporanee = int(limite.limite)
+        inizio = orologio[0]
+        for _ in range(contemporanee):
+            limite.acquisisci()
+        for durata in sorted(latenza(giro) for _ in range(contemporanee)):
+            orologio[0] = inizio + durata
+            limite.rilascia(inizio)
+        limiti.append(int(limite.limite))
+    return limiti
+
+
+def test_oscillazioni_normali_non_riducono_il_limite(orologio):
+    casuale = random.Random(0)
+    limiti = simula(orologio, lambda giro: 0.12 * casuale.uniform(0.4, 1.6))
+    assert min(limiti) >= 5
+    assert limiti[-1] == 20
+
+
+def test_latenza_in_aumento_prolungato_riduce_il_limite(orologio):
+    casuale = random.Random(0)
+    limiti = simula(orologio, lambda giro: 0.12 * casuale.uniform(0.8, 1.2) * (4 if giro >= 100 else 1))
+    assert limiti[99] == 20
+    assert min(limiti[100:]) < 20
+
+
+def test_sovraccarico_dimezza_il_limite(orologio):
+    limite = LimiteAdattivo(10, massimo=20)
+    orologio[0] = 5.0
+    limite.rilascia(limite.acquisisci(), sovraccarico=True, errore=True)
+    assert int(limite.limite) == 5
@@ -0,0 +1,22 @@
+import pytest
+
+from normalizzazione import normalizza_indirizzo
+
+
+@pytest.mark.parametrize('indirizzo, chiave', [
+    ("Via Roma 1, Milano", "via roma 1, milano"),
+    ("via  roma 1 milano", "via roma 1, milano"),
+    ("Via Roma, 1, Milano", "via roma 1, milano"),
+    ("Via S. Marco 10", "via san marco 10"),
+    ("via S.Marco 10", "via san marco 10"),
+    ("P.zza Duomo n. 12/A - 20121 Milano (MI), Italia", "piazza duomo 12a, milano, 20121, mi"),
+    ("Piazza Duomo 12 A, 20121 Milano MI", "piazza duomo 12a, milano, 20121, mi"),
+    ("Via Roma 12 B", "via roma 12b"),
+    ("Via Roma 12 b 20100 Milano", "via roma 12b, milano, 20100"),
+    ("Via Garibaldi 2 S Giovanni", "via garibaldi 2, san giovanni"),
+    ("Via Garibaldi 2, S. Giovanni", "via garibaldi 2, san giovanni"),
+    ("Corso Italia 5, Milano", "corso italia 5, milano"),
+    ("Via Po", "via po"),
+])
+def test_normalizza_indirizzo(indirizzo, chiave):
+    assert normalizza_indirizzo(indirizzo) == chiave